@@ -16,8 +16,8 @@ from .utils import progress, setup_distribution, set_seed, env, \
     _GenerationStreamer, BaseMonitor, StepTimeMonitor, TGSMonitor, \
     MemoryMonitor, LossMonitor, EvalMonitor, LRMonitor, dict_as_params, \
     DashProvider, is_static_method, auto_param_call, NetworkIOMonitor, \
-    DiskIOMonitor, CPUMemoryMonitor, ColliePadder, get_keys_to_not_convert, \
-    concat_tensor
+    DiskIOMonitor, CPUMemoryMonitor, DataWaitTimeMonitor, ColliePadder, \
+    get_keys_to_not_convert, concat_tensor
 from .module import PipelineGenerationMixin, ColumnParallelLinear, \
     RowParallelLinearWithoutBias, LinearWithHiddenStates, \
     ColumnParallelLMHead, GPTLMLoss
@@ -26,9 +26,10 @@ from .controller import Trainer, Evaluator, EvaluatorForPerplexity, \
 from .config import CollieConfig
 from .metrics import BaseMetric, DecodeMetric, AccuracyMetric, \
     PPLMetric, BleuMetric, ClassifyFPreRecMetric
-from .data import CollieDatasetForClassification, CollieBatchSampler, \
+from .data import CollieDatasetForClassification, CollieBatchSampler, CollieDistributedSampler, \
     CollieDataLoader, CollieDatasetForTraining, CollieDatasetForGeneration, \
-        CollieDatasetForPerplexity
+        CollieDatasetForPerplexity, ColliePackedDataset, CollieStreamingDataset, \
+        CollieTokenBatchSampler
 from .optim import Lomo, Lion, SophiaG, Adan
 
 __all__ = [
@@ -98,6 +99,7 @@ __all__ = [
     "NetworkIOMonitor",
     "DiskIOMonitor",
     "CPUMemoryMonitor",
+    "DataWaitTimeMonitor",
     "ColliePadder",
     "get_keys_to_not_convert",
     
@@ -112,10 +114,14 @@ __all__ = [
     #data
     'CollieDatasetForClassification', 
     'CollieBatchSampler', 
+    'CollieDistributedSampler',
+    'CollieTokenBatchSampler',
     'CollieDataLoader', 
     'CollieDatasetForTraining',
     'CollieDatasetForGeneration',
     'CollieDatasetForPerplexity',
+    'ColliePackedDataset',
+    'CollieStreamingDataset',
     
     # optim
     "Lomo",
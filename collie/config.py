@@ -45,9 +45,41 @@ class CollieConfig:
         值。在流水线并行中，该项代表流水线的 micro batch 的数目。
     :param eval_batch_size: 验证时的 batch 大小。在流水线中代表验证时一个 micro
         batch 的大小。
+    :param train_max_tokens: 不为 0 时训练按 token 数目组 batch，每个（micro）
+        batch 中 padding 后的 token 数不超过该值，此时 ``train_micro_batch_size``
+        不再决定 batch 的大小。详见 :class:`~collie.data.CollieTokenBatchSampler`。
+    :param eval_max_tokens: 不为 0 时验证按 token 数目组 batch，此时
+        ``eval_batch_size`` 不再决定 batch 的大小。
+    :param group_by_length: 训练时是否将长度接近的样本分到同一个 batch 中以减少
+        padding。样本长度来自 ``train_dataset.lengths``，不存在时会遍历一次数据集
+        计算。
     :param checkpointing: 是否使用梯度检查点，该设置可以节省显存。
+    :param checkpointing_policy: 使用梯度检查点的方式，可选的值有：
+
+        * ``'full'`` - 对整个层使用检查点；
+        * ``'attention'`` / ``'mlp'`` - 只对层中的 attention 或 MLP 子模块使用检查
+          点，不支持划分子模块的层会对整个层使用检查点；
+        * ``'auto'`` - 在第一次训练的前向中测量每一层需要保存的激活的大小，之后在
+          ``checkpointing_budget`` 内让尽可能多的层不使用检查点。
+
+        仅对 LLaMA、InternLM、MOSS 和 ChatGLM 系列模型有效，默认为 ``'full'``。
+    :param checkpointing_interval: 每隔多少层使用一次检查点，即只有层号整除该值的层
+        使用检查点。对 ``'auto'`` 无效。
+    :param checkpointing_budget: ``checkpointing_policy`` 为 ``'auto'`` 时，每张卡上
+        一个 micro batch 的激活可以使用的显存大小，单位为 GB。
     :param use_flash: 是否使用 `FlashAttention <https://github.com/HazyResearch/flash-attention>`_ 。
         仅对部分模型有效。
+    :param attention_backend: 不使用 FlashAttention 时 attention 的实现方式，可选
+        ``'eager'`` 或 ``'sdpa'``，默认为 ``'eager'``，即显式地计算 attention 矩阵。
+        ``'sdpa'`` 使用 :func:`torch.nn.functional.scaled_dot_product_attention`，
+        在 CPU 和 GPU 上都可以使用 memory efficient 或 math kernel，数值上与
+        ``'eager'`` 存在浮点误差级别的差异。仅对 LLaMA、InternLM、MOSS 和 ChatGLM
+        模型有效；ChatGLM2 在 PyTorch 2 上始终使用 sdpa。
+    :param lm_loss_chunk_size: 大于 0 时，训练中 lm_head 与交叉熵损失按该数量的
+        token 分块融合计算，反向传播时重新计算每一块的 logits，不会生成完整的
+        ``[B, T, V]`` 大小的 logits，详见 :func:`~collie.module.chunked_lm_loss`。
+        此时模型的输出中只有 ``loss`` 而没有 ``logits``，``loss_fn`` 需要能够接收
+        ``loss``（如 :class:`~collie.module.GPTLMLoss`）。默认为 0，即不融合。
     :param dropout: :class:`Dropout` 的概率。仅对部分模型有效。
     :param init_method: 初始化方法。必须是一个接收一个 ``torch.Tensor``
         并返回一个 ``torch.Tensor`` 的可调用对象。
@@ -90,12 +122,54 @@ class CollieConfig:
     eval_batch_size: int = field(
         default=1, metadata={"help": "Batch size for evaluation."}
     )
+    train_max_tokens: int = field(
+        default=0, metadata={"help": "Token budget of one (micro) batch for training. 0 means disabled."}
+    )
+    eval_max_tokens: int = field(
+        default=0, metadata={"help": "Token budget of one (micro) batch for evaluation. 0 means disabled."}
+    )
+    group_by_length: bool = field(
+        default=False,
+        metadata={"help": "Whether to group samples of similar length into the same batch."},
+    )
     checkpointing: bool = field(
         default=True, metadata={"help": "Whether to use activation checkpointing."}
     )
+    checkpointing_policy: str = field(
+        default="full",
+        metadata={
+            "help": "How activation checkpointing is applied. Possible values are "
+            "'full', 'attention', 'mlp' and 'auto'."
+        },
+    )
+    checkpointing_interval: int = field(
+        default=1,
+        metadata={"help": "Checkpoint every k-th layer only."},
+    )
+    checkpointing_budget: float = field(
+        default=0.0,
+        metadata={
+            "help": "Activation memory budget per device and micro batch in GB "
+            "for the 'auto' checkpointing policy."
+        },
+    )
     use_flash: bool = field(
         default=True, metadata={"help": "Whether to use flash attention."}
     )
+    attention_backend: str = field(
+        default="eager",
+        metadata={
+            "help": "Attention implementation used when flash attention is off. "
+            "Possible values are 'eager' and 'sdpa'."
+        },
+    )
+    lm_loss_chunk_size: int = field(
+        default=0,
+        metadata={
+            "help": "Number of tokens per chunk when fusing the lm head with the "
+            "cross entropy loss during training. 0 disables the fusion."
+        },
+    )
     dropout: float = field(default=0.0, metadata={"help": "Dropout probability."})
     init_method: dict = field(
         default_factory=lambda: {'init_func': torch.nn.init.normal_, 'init_kwargs': {'mean': 0.0, 'std': 0.02}},
@@ -114,6 +188,13 @@ class CollieConfig:
     dataloader_num_workers: int = field(
         default=0, metadata={"help": "Number of workers for dataloader."}
     )
+    dataloader_prefetch_batches: int = field(
+        default=0,
+        metadata={
+            "help": "Number of batches prefetched and moved to the device by a "
+            "background thread. 0 (default) disables prefetching."
+        },
+    )
     ds_config: Union[str, dict] = field(
         default_factory=lambda: {}, metadata={"help": "DeepSpeed configuration file."}
     )
@@ -185,6 +266,11 @@ class CollieConfig:
                 load_config(self.quantization_config)
             )
         self.model_config.gradient_checkpointing = self.checkpointing
+        assert self.attention_backend in ("eager", "sdpa"), self.attention_backend
+        assert self.lm_loss_chunk_size >= 0, self.lm_loss_chunk_size
+        assert self.checkpointing_policy in ("full", "attention", "mlp", "auto"), \
+            self.checkpointing_policy
+        assert self.checkpointing_interval >= 1, self.checkpointing_interval
         assert isinstance(self.ds_config, dict), self.ds_config
         os.environ["COLLIE_SEED"] = str(self.seed)
 
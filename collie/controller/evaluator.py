@@ -144,6 +144,8 @@ class Evaluator:
                 shuffle=False,
                 collate_fn=self.collate_fn,
                 num_workers=self.config.dataloader_num_workers,
+                max_tokens=self.config.eval_max_tokens or None,
+                prefetch_batches=self.config.dataloader_prefetch_batches,
             )
             self.eval_steps = len(self.eval_dataloader)
         eval_dataloader = self.eval_dataloader
@@ -172,6 +174,9 @@ class Evaluator:
                     batch["past_key_values"] = None
                     result = self.eval_fn(self, batch)
                 self.metric_wrapper.update(result)
+        # 释放预取线程中尚未使用的 batch
+        if isinstance(eval_dataloader, CollieDataLoader):
+            eval_dataloader.close()
         with self.monitor as item:
             metric_results = self.metric_wrapper.get_metric()
             for key in list(metric_results.keys()):
@@ -354,6 +359,152 @@ class EvaluatorForClassfication(EvaluatorForPerplexity):
         self.only_latin = only_latin
         self.max_new_tokens = max_new_tokens
 
+    @staticmethod
+    def _align(mask: torch.Tensor, padding_left: bool) -> torch.Tensor:
+        """返回将 padding 移动到左侧或右侧、同时保持有效 token 顺序的下标。"""
+        mask = mask.bool()
+        key = mask if padding_left else ~mask
+        return torch.sort(key.int(), dim=1, stable=True).indices
+
+    @staticmethod
+    def _split_shared_prefix(batch: Dict) -> Tuple[Dict, List[Dict]]:
+        """将前缀的 padding 移到左侧、各选项后缀的 padding 移到右侧，使两者直接相接。"""
+        order = EvaluatorForClassfication._align(batch["attention_mask"], True)
+        prefix = {
+            "input_ids": batch["input_ids"].gather(1, order),
+            "attention_mask": batch["attention_mask"].gather(1, order),
+        }
+        options = []
+        for ids, mask, labels in zip(
+            batch["option_ids"], batch["option_attention_mask"], batch["option_labels"]
+        ):
+            order = EvaluatorForClassfication._align(mask, False)
+            options.append(
+                {
+                    "input_ids": ids.gather(1, order),
+                    "attention_mask": mask.gather(1, order),
+                    "labels": labels.masked_fill(~mask.bool(), -100).gather(1, order),
+                }
+            )
+        return prefix, options
+
+    @staticmethod
+    def _can_share_prefix(evaluator) -> bool:
+        model = evaluator.engine.module
+        if isinstance(model, PeftModel):
+            return False
+        return evaluator.config.pp_size == 1 and hasattr(model, "set_cache")
+
+    @staticmethod
+    def _expand_shared_prefix(batch: Dict) -> Dict:
+        """将 ``shared_prefix`` 格式的 batch 还原为每个选项一个完整序列的格式。"""
+        prefix, options = EvaluatorForClassfication._split_shared_prefix(batch)
+        prefix_labels = torch.full_like(prefix["input_ids"], -100)
+        return {
+            "input_ids": [
+                torch.cat([prefix["input_ids"], option["input_ids"]], dim=1)
+                for option in options
+            ],
+            "attention_mask": [
+                torch.cat([prefix["attention_mask"], option["attention_mask"]], dim=1)
+                for option in options
+            ],
+            "labels": [
+                torch.cat([prefix_labels, option["labels"]], dim=1) for option in options
+            ],
+            "target": batch["target"],
+        }
+
+    @staticmethod
+    def _option_scores(
+        loss_fn: Callable, logits: torch.Tensor, labels: torch.Tensor
+    ) -> torch.Tensor:
+        """计算 batch 中每个样本的 ``loss_fn``，作为选项的得分。
+
+        ``loss_fn`` 为 :class:`~collie.module.GPTLMLoss` 时，整个 batch 只进行一次规约，
+        结果与逐样本调用 ``loss_fn`` 相同；其它的 ``loss_fn`` 仍逐样本调用。得分保留
+        在 ``logits`` 所在的设备上，不会触发同步。
+
+        :return: 形状为 ``(batch_size,)`` 的张量
+        """
+        labels = labels.to(logits.device)
+        if not isinstance(loss_fn, GPTLMLoss) or type(loss_fn).forward is not GPTLMLoss.forward:
+            return torch.stack(
+                [
+                    loss_fn(logits[i : i + 1], labels[i : i + 1]).detach().reshape(())
+                    for i in range(logits.shape[0])
+                ]
+            )
+        ignore_index = loss_fn.ignore_index
+        shift_logits = logits[:, :-1].float()
+        shift_labels = labels[:, 1:]
+        loss = torch.nn.functional.cross_entropy(
+            shift_logits.reshape(-1, shift_logits.shape[-1]),
+            shift_labels.reshape(-1),
+            ignore_index=ignore_index,
+            reduction="none",
+        ).view(shift_labels.shape)
+        valid = (shift_labels != ignore_index).sum(dim=1)
+        # 没有有效 token 的样本与 GPTLMLoss 一致地得到 nan
+        return loss.sum(dim=1) / valid
+
+    @staticmethod
+    def _position_ids(attention_mask: torch.Tensor) -> torch.Tensor:
+        """根据 ``attention_mask`` 计算每个有效 token 的位置，padding 处置为 1。"""
+        position_ids = attention_mask.long().cumsum(-1) - 1
+        return position_ids.masked_fill(attention_mask == 0, 1)
+
+    @staticmethod
+    def _score_shared_prefix(evaluator, batch: Dict) -> torch.Tensor:
+        """对前缀进行一次前向传播，再基于前缀的 ``past_key_values`` 对每个选项打分。
+
+        ``position_ids`` 由拼接后的 ``attention_mask`` 得到，使每个 token 的位置与
+        padding 的长度无关。
+
+        :return: 形状为 ``(batch_size, num_options)`` 的得分
+        """
+        model = evaluator.engine.module
+        device = next(model.parameters()).device
+        prefix, options = EvaluatorForClassfication._split_shared_prefix(batch)
+        prefix_mask = prefix["attention_mask"].to(device)
+        ignore_index = getattr(evaluator.loss_fn, "ignore_index", -100)
+        scores = []
+        model.set_cache(True)
+        try:
+            output = evaluator.engine(
+                input_ids=prefix["input_ids"].to(device),
+                attention_mask=prefix_mask,
+                position_ids=EvaluatorForClassfication._position_ids(prefix_mask),
+            )
+            past_key_values = output["past_key_values"]
+            # 前缀最后一个位置的 logits 用于预测每个选项的第一个 token
+            last_logits = output["logits"][:, -1:]
+            model.set_cache(False)
+            for idx, option in enumerate(options):
+                input_ids = option["input_ids"].to(device)
+                attention_mask = torch.cat(
+                    [prefix_mask, option["attention_mask"].to(device)], dim=1
+                )
+                logits = evaluator.engine(
+                    input_ids=input_ids,
+                    attention_mask=attention_mask,
+                    position_ids=EvaluatorForClassfication._position_ids(attention_mask)[
+                        :, -input_ids.shape[1] :
+                    ],
+                    past_key_values=past_key_values,
+                )["logits"]
+                logits = torch.cat([last_logits, logits], dim=1)
+                labels = option["labels"].to(device)
+                labels = torch.cat(
+                    [torch.full_like(labels[:, :1], ignore_index), labels], dim=1
+                )
+                scores.append(
+                    EvaluatorForClassfication._option_scores(evaluator.loss_fn, logits, labels)
+                )
+        finally:
+            model.clean_cache()
+        return torch.stack(scores, dim=1)
+
     @staticmethod
     @torch.no_grad()
     def eval_fn(evaluator, batch: Dict) -> Any:
@@ -372,8 +523,23 @@ class EvaluatorForClassfication(EvaluatorForPerplexity):
                 "target": torch.tensor([[0]])
             }
 
+        当 ``batch`` 来自 ``shared_prefix`` 模式的
+        :class:`~collie.data.CollieDatasetForClassification` 时，前缀只会进行一次前向
+        传播，各选项的后缀基于前缀的 ``past_key_values`` 打分。
+
         :return: 一次验证的结果，为 `Dict` 类型，该结果会被传入 `metric` 的 `update` 方法中
         """
+        if "option_ids" in batch.keys():
+            if EvaluatorForClassfication._can_share_prefix(evaluator):
+                pred = EvaluatorForClassfication._score_shared_prefix(
+                    evaluator, batch
+                ).argmin(dim=1)
+                return {
+                    "pred": pred,
+                    "target": batch["target"].squeeze(1).to(pred.device),
+                }
+            # 流水线等情况下拼接回完整的序列
+            batch = EvaluatorForClassfication._expand_shared_prefix(batch)
         if "output" not in batch.keys():
             assert isinstance(
                 batch["input_ids"], Sequence
@@ -381,9 +547,7 @@ class EvaluatorForClassfication(EvaluatorForPerplexity):
             assert isinstance(
                 batch["attention_mask"], Sequence
             ), f"input_ids must be a list for classification task. But got {type(batch['attention_mask'])}."
-            pred = torch.zeros(
-                (batch["input_ids"][0].shape[0], len(batch["input_ids"]))
-            )
+            scores = []
             for idx, input_ids in enumerate(batch["input_ids"]):
                 assert isinstance(
                     input_ids, torch.Tensor
@@ -427,17 +591,13 @@ class EvaluatorForClassfication(EvaluatorForPerplexity):
                     logits = evaluator.engine.module(**inputs)["logits"]
                 else:
                     logits = evaluator.engine(**inputs)["logits"]
-                for sample_idx in range(input_ids.shape[0]):
-                    pred[sample_idx, idx] = (
-                        evaluator.loss_fn(
-                            logits[sample_idx : sample_idx + 1, :],
-                            inputs["labels"][sample_idx : sample_idx + 1, :],
-                        )
-                        .detach()
-                        .cpu()
-                        .item()
+                scores.append(
+                    EvaluatorForClassfication._option_scores(
+                        evaluator.loss_fn, logits, inputs["labels"]
                     )
-            pred = pred.argmin(dim=1)
+                )
+            # 所有选项的得分一次性在设备上比较，避免逐样本同步
+            pred = torch.stack(scores, dim=1).argmin(dim=1)
         else:
             assert isinstance(
                 batch["output"], Sequence
@@ -243,14 +243,50 @@ class Trainer(TrainerEventTrigger):
         self.batch_idx = 0
 
     def state_dict(self):
-        """获取优化器的自身状态字典"""
-        return {"epoch_idx": self.epoch_idx, "batch_idx": self.batch_idx}
+        """获取优化器的自身状态字典
+
+        状态字典中包含所有数据并行 rank 上训练数据的读取进度。当训练数据集为流式数据集
+        时，各 rank 的读取进度需要通过通信收集，此时需要在所有进程上调用该函数。
+        """
+        state_dict = {"epoch_idx": self.epoch_idx, "batch_idx": self.batch_idx}
+        if self._resumable_dataloader():
+            dataloader_state = self.train_dataloader.state_dict()
+            if self.train_dataloader.streaming:
+                dataloader_states = [None for _ in range(env.dp_size)]
+                dist.all_gather_object(
+                    dataloader_states, dataloader_state, group=env.dp_group
+                )
+            else:
+                # map-style 数据集在各个 rank 上的读取进度相同
+                dataloader_states = [dataloader_state] * env.dp_size
+            state_dict["dataloader_states"] = dataloader_states
+        return state_dict
 
     def load_state_dict(self, state_dict: dict):
         """加载优化器的自身状态"""
         self.epoch_idx = state_dict["epoch_idx"]
         self.trained_batch_idx = state_dict["batch_idx"]
         self.resume_from_checkpoint = True
+        if self._resumable_dataloader():
+            if "dataloader_states" in state_dict:
+                dataloader_state = state_dict["dataloader_states"][env.dp_rank]
+            elif not self.train_dataloader.streaming:
+                # 兼容没有保存读取进度的断点
+                dataloader_state = {
+                    "epoch": self.epoch_idx,
+                    "batch_idx": self.trained_batch_idx + 1,
+                }
+            else:
+                return
+            # 直接从断点处继续读取，不需要逐个跳过已经训练过的 batch
+            self.train_dataloader.load_state_dict(dataloader_state)
+            self.batch_idx = self.trained_batch_idx + 1
+
+    def _resumable_dataloader(self):
+        return (
+            isinstance(self.train_dataloader, CollieDataLoader)
+            and not self.train_dataloader.curriculum_learning_enabled
+        )
 
     @property
     def global_batch_idx(self):
@@ -305,6 +341,9 @@ class Trainer(TrainerEventTrigger):
                 collate_fn=self.train_dataset_collate_fn,
                 drop_last=False,
                 num_workers=self.config.dataloader_num_workers,
+                group_by_length=self.config.group_by_length,
+                max_tokens=self.config.train_max_tokens or None,
+                prefetch_batches=self.config.dataloader_prefetch_batches,
             )
             self.steps_per_epoch = len(self.train_dataloader)
 
@@ -383,6 +422,7 @@ class Trainer(TrainerEventTrigger):
                             "epoch_idx": self.epoch_idx,
                             "global_batch_idx": self.global_batch_idx,
                             "memory_allocated": torch.cuda.max_memory_allocated(),
+                            "data_wait_time": getattr(train_dataloader, "wait_time", 0.),
                             "mode": "train",
                         }
                     )
@@ -402,6 +442,9 @@ class Trainer(TrainerEventTrigger):
                     self.eval()
             self.resume_from_checkpoint = False
             self.batch_idx = 0
+        # 释放预取线程中尚未使用的 batch
+        if isinstance(train_dataloader, CollieDataLoader):
+            train_dataloader.close()
         self.on_train_end()
 
     def eval(self, dataloader: Optional[Iterable] = None):
@@ -848,6 +891,7 @@ class Trainer(TrainerEventTrigger):
         io_driver = IODriver.from_protocol(protocol)
         io_driver.makedirs(path, exist_ok=True)
         callback_states = self.on_save_checkpoint()
+        state_dict = self.state_dict()
         # save parallel_settings
         if env.dp_rank == 0:
             trainer_state_dict = {
@@ -855,7 +899,7 @@ class Trainer(TrainerEventTrigger):
                 "tp_size": env.tp_size,
                 "pp_size": env.pp_size,
             }
-            trainer_state_dict.update(self.state_dict())
+            trainer_state_dict.update(state_dict)
             io_driver.save(json.dumps(trainer_state_dict), os.path.join(path, "trainer_state_dict.json"))
 
         engine = self.engine
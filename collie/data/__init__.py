@@ -1,12 +1,17 @@
 from .dataloader import CollieDataLoader
-from .batch_sampler import CollieBatchSampler
-from .dataset import CollieDatasetForTraining, CollieDatasetForClassification, CollieDatasetForGeneration, CollieDatasetForPerplexity
+from .batch_sampler import CollieBatchSampler, CollieDistributedSampler, CollieTokenBatchSampler
+from .dataset import CollieDatasetForTraining, CollieDatasetForClassification, CollieDatasetForGeneration, CollieDatasetForPerplexity, \
+    ColliePackedDataset, CollieStreamingDataset
 
 __all__ = [
     'CollieDataLoader',
     'CollieBatchSampler',
+    'CollieDistributedSampler',
+    'CollieTokenBatchSampler',
     'CollieDatasetForTraining',
     'CollieDatasetForClassification',
     'CollieDatasetForGeneration',
-    'CollieDatasetForPerplexity'
+    'CollieDatasetForPerplexity',
+    'ColliePackedDataset',
+    'CollieStreamingDataset'
 ]
\ No newline at end of file
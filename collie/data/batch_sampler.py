@@ -1,8 +1,78 @@
+import itertools
+import os
+from typing import Optional, Sequence
+
+import numpy as np
+
+from .permutation import _IndexPermutation
+
+
+class CollieDistributedSampler:
+    """
+    与 ``torch.utils.data.DistributedSampler`` 行为一致的 Sampler，但打乱时使用
+    由 ``seed`` 和 epoch 决定的 Feistel 排列逐块计算下标，不会在每个 epoch 生成并保存
+    完整的排列，适用于样本数目极大的数据集。
+
+    :param dataset: 数据集，仅使用其长度
+    :param num_replicas: 数据并行的大小
+    :param rank: 数据并行的 rank
+    :param shuffle: 是否打乱
+    :param seed: 随机数种子，为 ``None`` 时使用 ``COLLIE_SEED`` 环境变量
+    :param drop_last: 样本数目不能被 ``num_replicas`` 整除时是否丢弃多余的样本；
+        为 ``False`` 时从头补齐
+    """
+    def __init__(self, dataset, num_replicas: int = 1, rank: int = 0,
+                 shuffle: bool = True, seed: Optional[int] = None,
+                 drop_last: bool = False):
+        if seed is None:
+            seed = int(os.environ.get("COLLIE_SEED", 0))
+        self.dataset_size = len(dataset)
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.shuffle = shuffle
+        self.seed = seed
+        self.drop_last = drop_last
+        self.epoch = 0
+        if self.drop_last:
+            self.num_samples = self.dataset_size // self.num_replicas
+        else:
+            self.num_samples = (self.dataset_size + self.num_replicas - 1) // self.num_replicas
+        self.total_size = self.num_samples * self.num_replicas
+
+    def __iter__(self):
+        permutation = _IndexPermutation(self.dataset_size, self.seed, self.epoch) \
+            if self.shuffle else None
+        chunk_size = 65536 * self.num_replicas
+        for start in range(self.rank, self.total_size, chunk_size):
+            # 超出数据集大小的位置从头补齐
+            positions = np.arange(start, min(start + chunk_size, self.total_size),
+                                  self.num_replicas) % self.dataset_size
+            if permutation is not None:
+                positions = permutation[positions]
+            yield from positions.tolist()
+
+    def __len__(self) -> int:
+        return self.num_samples
+
+    def set_epoch(self, epoch_idx):
+        self.epoch = epoch_idx
+
+
 class CollieBatchSampler:
     """
     Batch Sampler。在最后一个 batch 样本数目不足一个 ``batch size`` 时可以选择
     不处理（normal）、丢弃（drop）或从头补齐（fill）。
 
+    当提供 ``lengths`` 时会按长度分桶：每次从 ``sampler`` 中取出
+    ``batch_size * mega_batch_multiplier`` 个样本组成 mega batch，按长度排序后切分
+    为若干 batch，再打乱这些 batch 的顺序。这样同一个 batch 中的样本长度接近，
+    可以减少 padding。下标逐个 mega batch 从 ``sampler`` 中读取，内存占用与数据集
+    大小无关。打乱的顺序只由 ``seed`` 和 ``set_epoch`` 设置的 epoch 决定，因此在
+    不同 rank 和断点续训时保持一致。
+
+    断点续训时可以通过 :meth:`seek` 直接从某个 batch 开始迭代，跳过的 batch 不会被
+    读取。
+
     :param sampler:
     :param batch_size:
     :param last_batch: 当最后一个 batch 样本数不足一个 ``batch_size`` 时的处理方式
@@ -10,17 +80,48 @@ class CollieBatchSampler:
         * ``'normal'`` - 不进行任何特殊处理。
         * ``'drop'`` - 丢弃最后一个 batch。
         * ``'fill'`` - 将最后一个 batch 补齐到 ``batch_size`` 大小。
+
+    :param lengths: 每个样本的长度，下标与 ``sampler`` 返回的下标一致。为 ``None``
+        时不进行分桶
+    :param mega_batch_multiplier: 一个 mega batch 中包含的 batch 数目
+    :param shuffle: 分桶后是否打乱每个 mega batch 中 batch 的顺序
+    :param seed: 打乱 batch 顺序时的随机数种子，为 ``None`` 时使用 ``COLLIE_SEED``
+        环境变量
     """
-    def __init__(self, sampler, batch_size, last_batch="normal"):
+    def __init__(self, sampler, batch_size, last_batch="normal",
+                 lengths: Optional[Sequence[int]] = None,
+                 mega_batch_multiplier: int = 50, shuffle: bool = True,
+                 seed: Optional[int] = None):
         assert last_batch in ["normal", "drop", "fill"]
         self.sampler = sampler
         self.batch_size = batch_size
         self.last_batch = last_batch
+        self.lengths = None if lengths is None else np.asarray(lengths)
+        self.mega_batch_multiplier = mega_batch_multiplier
+        self.shuffle = shuffle
+        if seed is None:
+            seed = int(os.environ.get("COLLIE_SEED", 0))
+        self.seed = seed
+        self.epoch = 0
+        self.start_batch = 0
+
+    def seek(self, batch_idx: int):
+        """令下一次迭代从第 ``batch_idx`` 个 batch 开始。"""
+        self.start_batch = batch_idx
 
     def __iter__(self):
+        start_batch, self.start_batch = self.start_batch, 0
+        if self.lengths is not None:
+            # 完整的 mega batch 恰好切分为 mega_batch_multiplier 个 batch，可以整块跳过
+            yield from itertools.islice(
+                self._bucketed_batches(start_batch // self.mega_batch_multiplier),
+                start_batch % self.mega_batch_multiplier, None,
+            )
+            return
+        # 不分桶时 batch 由 sampler 的下标顺序切分，直接跳过相应数目的下标即可
+        sampler_iter = itertools.islice(iter(self.sampler), start_batch * self.batch_size, None)
         # torch BatchSampler.__iter__
         if self.last_batch == "drop":
-            sampler_iter = iter(self.sampler)
             while True:
                 try:
                     batch = [next(sampler_iter) for _ in range(self.batch_size)]
@@ -30,7 +131,7 @@ class CollieBatchSampler:
         else:
             batch = [0] * self.batch_size
             idx_in_batch = 0
-            for idx in self.sampler:
+            for idx in sampler_iter:
                 batch[idx_in_batch] = idx
                 idx_in_batch += 1
                 if idx_in_batch == self.batch_size:
@@ -50,6 +151,36 @@ class CollieBatchSampler:
                             sampler_iter = iter(self.sampler)
                     yield batch
 
+    def _bucketed_batches(self, start_mega_batch: int = 0):
+        # 逐个 mega batch 从 sampler 中读取下标，不在内存中保存整个 epoch 的下标
+        num_samples = len(self.sampler)
+        remainder = num_samples % self.batch_size
+        indices = iter(self.sampler)
+        if remainder > 0 and num_samples > 0:
+            if self.last_batch == "drop":
+                indices = itertools.islice(indices, num_samples - remainder)
+            elif self.last_batch == "fill":
+                # 与不分桶时相同，从头补齐
+                fill = itertools.chain.from_iterable(itertools.repeat(self.sampler))
+                indices = itertools.chain(
+                    indices, itertools.islice(fill, self.batch_size - remainder)
+                )
+        mega_batch_size = self.batch_size * self.mega_batch_multiplier
+        indices = itertools.islice(indices, start_mega_batch * mega_batch_size, None)
+        for mega_batch_idx in itertools.count(start_mega_batch):
+            mega_batch = np.fromiter(itertools.islice(indices, mega_batch_size), dtype=np.int64)
+            if len(mega_batch) == 0:
+                return
+            mega_batch = mega_batch[np.argsort(self.lengths[mega_batch], kind="stable")]
+            batches = [
+                mega_batch[i : i + self.batch_size].tolist()
+                for i in range(0, len(mega_batch), self.batch_size)
+            ]
+            if self.shuffle:
+                rng = np.random.default_rng((self.seed, self.epoch, mega_batch_idx))
+                batches = [batches[i] for i in rng.permutation(len(batches))]
+            yield from batches
+
     def __len__(self) -> int:
         if self.last_batch == "drop":
             return len(self.sampler) // self.batch_size  # type: ignore[arg-type]
@@ -57,5 +188,110 @@ class CollieBatchSampler:
             return (len(self.sampler) + self.batch_size - 1) // self.batch_size  # type: ignore[arg-type]
         
     def set_epoch(self, epoch_idx):
+        self.epoch = epoch_idx
         self.sampler.set_epoch(epoch_idx)
-        
\ No newline at end of file
+
+
+class CollieTokenBatchSampler:
+    """
+    按 token 数目组 batch 的 Batch Sampler。每个 batch 中样本数与其中最长样本长度
+    的乘积（即 padding 后的 token 数）不超过 ``max_tokens``，从而在样本较短时使用更
+    大的 batch。
+
+    所有 batch 在初始化时根据样本长度一次性构造好，每个 epoch 只打乱 batch 的顺序。
+    batch 的数目会被补齐（或在 ``drop_last`` 时截断）到 ``num_replicas`` 的整数倍，
+    并按 ``batches[rank::num_replicas]`` 分配给各个数据并行 rank。由于各 rank 使用
+    相同的随机数种子计算完全相同的 batch 列表，因此不需要通信就能保证每个 rank 的
+    step 数相同。
+
+    :param lengths: 每个样本的长度
+    :param max_tokens: 每个 batch 中 padding 后的最大 token 数
+    :param num_replicas: 数据并行的大小
+    :param rank: 数据并行的 rank
+    :param shuffle: 是否在每个 epoch 打乱 batch 的顺序
+    :param seed: 随机数种子，为 ``None`` 时使用 ``COLLIE_SEED`` 环境变量
+    :param drop_last: batch 数目不能被 ``num_replicas`` 整除时是否丢弃多余的
+        batch；为 ``False`` 时会从头补齐
+    :param max_batch_size: 每个 batch 的最大样本数，为 ``None`` 时不做限制
+    :param batch_size_multiple: batch 的样本数须为该值的整数倍。在流水线并行中应
+        设为 micro batch 的数目，以便将 batch 均分为多个 micro batch
+    """
+    def __init__(self, lengths: Sequence[int], max_tokens: int,
+                 num_replicas: int = 1, rank: int = 0, shuffle: bool = True,
+                 seed: Optional[int] = None, drop_last: bool = False,
+                 max_batch_size: Optional[int] = None,
+                 batch_size_multiple: int = 1):
+        if seed is None:
+            seed = int(os.environ.get("COLLIE_SEED", 0))
+        self.lengths = np.asarray(lengths)
+        self.max_tokens = max_tokens
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.shuffle = shuffle
+        self.seed = seed
+        self.drop_last = drop_last
+        self.max_batch_size = max_batch_size
+        self.batch_size_multiple = batch_size_multiple
+        self.epoch = 0
+        self.start_batch = 0
+        self.batches = self._build_batches()
+
+    def seek(self, batch_idx: int):
+        """令下一次迭代从当前 rank 的第 ``batch_idx`` 个 batch 开始。"""
+        self.start_batch = batch_idx
+
+    def _build_batches(self):
+        # 长度相同的样本之间随机排列
+        rng = np.random.default_rng(self.seed)
+        indices = rng.permutation(len(self.lengths))
+        indices = indices[np.argsort(self.lengths[indices], kind="stable")]
+        lengths = self.lengths[indices]
+        counts = np.arange(1, len(indices) + 1)
+        batches = []
+        start = 0
+        while start < len(indices):
+            # 长度已经排好序，batch 中最长的样本就是最后一个样本，因此前 k 个样本
+            # padding 后的 token 数 lengths[start + k - 1] * k 随 k 单调不减
+            if lengths[start] > 0:
+                limit = max(int(self.max_tokens // lengths[start]), 1)
+            else:
+                limit = len(indices) - start
+            if self.max_batch_size is not None:
+                limit = min(limit, self.max_batch_size)
+            window = lengths[start : start + limit]
+            tokens = window * counts[: len(window)]
+            end = start + max(int(tokens.searchsorted(self.max_tokens, side="right")), 1)
+            size = end - start
+            if size >= self.batch_size_multiple:
+                size -= size % self.batch_size_multiple
+            else:
+                # 单个样本已超出预算时也须凑够 batch_size_multiple 个样本
+                size = self.batch_size_multiple
+            batch = indices[start : start + size]
+            if len(batch) < size:
+                batch = np.concatenate([batch, np.resize(indices, size - len(batch))])
+            batches.append(batch.tolist())
+            start += size
+        remainder = len(batches) % self.num_replicas
+        if remainder > 0:
+            if self.drop_last:
+                batches = batches[: len(batches) - remainder]
+            else:
+                batches.extend(batches[: self.num_replicas - remainder])
+        return batches
+
+    def __iter__(self):
+        start_batch, self.start_batch = self.start_batch, 0
+        if self.shuffle:
+            rng = np.random.default_rng((self.seed, self.epoch))
+            order = rng.permutation(len(self.batches))
+        else:
+            order = np.arange(len(self.batches))
+        for i in order[self.rank :: self.num_replicas][start_batch:]:
+            yield self.batches[i]
+
+    def __len__(self) -> int:
+        return len(self.batches) // self.num_replicas
+
+    def set_epoch(self, epoch_idx):
+        self.epoch = epoch_idx
@@ -0,0 +1,133 @@
+"""CoLLie 数据集的 tokenize 缓存
+"""
+import hashlib
+import json
+import os
+import pickle
+import sqlite3
+from typing import Callable, Dict, List, Sequence
+
+__all__ = []
+
+
+def _tokenizer_fingerprint(tokenizer) -> str:
+    """计算 ``tokenizer`` 的指纹，词表、分词规则或特殊 token 变化时指纹随之变化。"""
+    sha = hashlib.sha1()
+    sha.update(tokenizer.__class__.__name__.encode())
+    backend = getattr(tokenizer, "backend_tokenizer", None)
+    if backend is not None:
+        sha.update(backend.to_str().encode())
+    else:
+        sha.update(json.dumps(tokenizer.get_vocab(), sort_keys=True).encode())
+    sha.update(json.dumps(tokenizer.special_tokens_map, sort_keys=True, default=str).encode())
+    return sha.hexdigest()
+
+
+def _dataset_fingerprint(namespace: str, records) -> str:
+    """计算一组原始样本在 ``namespace`` 对应的处理方式下的指纹。"""
+    sha = hashlib.sha1(namespace.encode())
+    for record in records:
+        sha.update(json.dumps(record, sort_keys=True, default=str).encode())
+        sha.update(b"\n")
+    return sha.hexdigest()
+
+
+class _TokenizationCache:
+    """基于 ``sqlite`` 的 tokenize 结果缓存。
+
+    缓存的 key 由 ``namespace``（tokenizer 指纹和数据集的处理参数）与样本内容共同决定，
+    因此同一份缓存可以安全地被多个数据集、多次运行复用。数据库以 WAL 模式打开，
+    多个进程（包括 DataLoader 的 worker 和不同的 rank）可以同时读写。数据库连接
+    在每个进程中按需创建，不会被序列化。
+
+    :param path: 缓存所在的文件夹
+    :param namespace: 数据集处理方式的指纹
+    """
+
+    def __init__(self, path: str, namespace: str) -> None:
+        self.path = path
+        self.namespace = namespace
+        self._connection = None
+        self._pid = None
+
+    @property
+    def connection(self):
+        if self._connection is None or self._pid != os.getpid():
+            os.makedirs(self.path, exist_ok=True)
+            connection = sqlite3.connect(
+                os.path.join(self.path, "collie-tokenization-cache.db"),
+                timeout=600,
+                check_same_thread=False,
+            )
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value BLOB)"
+            )
+            connection.commit()
+            self._connection = connection
+            self._pid = os.getpid()
+        return self._connection
+
+    def _key(self, record: Dict) -> str:
+        sha = hashlib.sha1(self.namespace.encode())
+        sha.update(json.dumps(record, sort_keys=True, default=str).encode())
+        return sha.hexdigest()
+
+    def get_or_compute(self, record: Dict, fn: Callable[[Dict], Dict]) -> Dict:
+        """返回 ``record`` 的缓存结果，不存在时调用 ``fn(record)`` 计算并写入缓存。"""
+        key = self._key(record)
+        row = self.connection.execute(
+            "SELECT value FROM cache WHERE key = ?", (key,)
+        ).fetchone()
+        if row is not None:
+            return pickle.loads(row[0])
+        sample = fn(record)
+        self.connection.execute(
+            "INSERT OR IGNORE INTO cache (key, value) VALUES (?, ?)",
+            (key, pickle.dumps(sample, protocol=pickle.HIGHEST_PROTOCOL)),
+        )
+        self.connection.commit()
+        return sample
+
+    def get_or_compute_many(
+        self, records: Sequence[Dict], fn: Callable[[Sequence[Dict]], List[Dict]]
+    ) -> List[Dict]:
+        """批量版本的 :meth:`get_or_compute`，缓存未命中的样本会通过一次
+        ``fn(records)`` 调用统一处理。
+        """
+        keys = [self._key(record) for record in records]
+        cached = {}
+        # sqlite 对单条语句的参数个数有限制
+        for start in range(0, len(keys), 500):
+            chunk = keys[start : start + 500]
+            cached.update(
+                self.connection.execute(
+                    f"SELECT key, value FROM cache WHERE key IN ({', '.join('?' * len(chunk))})",
+                    chunk,
+                ).fetchall()
+            )
+        missing = [i for i, key in enumerate(keys) if key not in cached]
+        samples = [None] * len(records)
+        for i, key in enumerate(keys):
+            if key in cached:
+                samples[i] = pickle.loads(cached[key])
+        if len(missing) > 0:
+            computed = fn([records[i] for i in missing])
+            self.connection.executemany(
+                "INSERT OR IGNORE INTO cache (key, value) VALUES (?, ?)",
+                [
+                    (keys[i], pickle.dumps(sample, protocol=pickle.HIGHEST_PROTOCOL))
+                    for i, sample in zip(missing, computed)
+                ],
+            )
+            self.connection.commit()
+            for i, sample in zip(missing, computed):
+                samples[i] = sample
+        return samples
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_connection"] = None
+        state["_pid"] = None
+        return state
@@ -1,11 +1,172 @@
-from torch.utils.data import DistributedSampler, DataLoader
+import queue
+import threading
+import time
+from contextlib import nullcontext
+from math import ceil
+
+import torch
+from torch.utils.data import Dataset, DataLoader, IterableDataset, get_worker_info
+from torch.utils.data.dataloader import default_collate
 from deepspeed.runtime.data_pipeline.data_sampling.data_sampler import DeepSpeedDataSampler
 from deepspeed.accelerator import get_accelerator
 from deepspeed.runtime.data_pipeline.constants import CURRICULUM_LEARNING, \
     DATA_SAMPLING_NUM_WORKERS, DATA_SAMPLING, CURRICULUM_LEARNING_ENABLED
 
-from collie.utils import env
-from .batch_sampler import CollieBatchSampler
+from collie.utils import env, ColliePadder
+from .batch_sampler import CollieBatchSampler, CollieDistributedSampler, \
+    CollieTokenBatchSampler
+
+
+def _get_lengths(dataset):
+    lengths = getattr(dataset, "lengths", None)
+    if lengths is None:
+        lengths = [len(dataset[i]["input_ids"]) for i in range(len(dataset))]
+    return lengths
+
+
+class _RawRecordDataset(Dataset):
+    """返回 ``dataset`` 中未经 tokenize 的原始样本，用于 ``batch_tokenize`` 模式。"""
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, index):
+        return self.dataset._get_record(index)
+
+
+class _BatchTokenizeCollator:
+    """在 ``collate_fn`` 之前对一个 batch 的原始样本进行一次批量 tokenize。"""
+    def __init__(self, dataset, collate_fn=None):
+        self.dataset = dataset
+        self.collate_fn = collate_fn if collate_fn is not None else default_collate
+
+    def __call__(self, records):
+        return self.collate_fn(self.dataset._get_samples(records))
+
+
+class _StreamingCollator:
+    """在 worker 中为每个 batch 附上该 worker 的读取进度，用于流式数据集的断点恢复。"""
+    def __init__(self, dataset, collate_fn=None):
+        self.dataset = dataset
+        self.collate_fn = collate_fn if collate_fn is not None else default_collate
+
+    def __call__(self, samples):
+        worker_info = get_worker_info()
+        worker_id = 0 if worker_info is None else worker_info.id
+        return self.collate_fn(samples), worker_id, self.dataset.consumed
+
+
+def _pin(data):
+    if isinstance(data, torch.Tensor):
+        return data if data.is_cuda or data.is_pinned() else data.pin_memory()
+    if isinstance(data, dict):
+        return {key: _pin(value) for key, value in data.items()}
+    if isinstance(data, (list, tuple)):
+        return type(data)(_pin(value) for value in data)
+    return data
+
+
+def _record_stream(data, stream):
+    # 告知缓存分配器这些张量会在 ``stream`` 上被使用，避免其显存被提前复用
+    if isinstance(data, torch.Tensor):
+        if data.is_cuda:
+            data.record_stream(stream)
+    elif isinstance(data, dict):
+        for value in data.values():
+            _record_stream(value, stream)
+    elif isinstance(data, (list, tuple)):
+        for value in data:
+            _record_stream(value, stream)
+
+
+class _DevicePrefetcher:
+    """在后台线程中提前读取至多 ``num_batches`` 个 batch。
+
+    ``transform`` 在后台线程中对每个 batch 调用，用于锁页和搬运到设备上。存在 cuda
+    设备时，读取和搬运都在一个单独的 cuda stream 上进行，主线程取出 batch 时再令当前
+    stream 等待搬运完成；否则退化为普通的线程队列。
+    """
+    _END = object()
+
+    def __init__(self, iterator, transform, num_batches):
+        self.iterator = iterator
+        self.transform = transform
+        self.queue = queue.Queue(maxsize=num_batches)
+        if torch.cuda.is_available():
+            self.device = torch.cuda.current_device()
+            self.stream = torch.cuda.Stream()
+        else:
+            self.device = None
+            self.stream = None
+        self.finished = False
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _put(self, item):
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def _run(self):
+        if self.device is not None:
+            # 当前设备是线程局部的
+            torch.cuda.set_device(self.device)
+        try:
+            while not self.stopped.is_set():
+                with nullcontext() if self.stream is None \
+                        else torch.cuda.stream(self.stream):
+                    try:
+                        data = next(self.iterator)
+                    except StopIteration:
+                        self._put(self._END)
+                        return
+                    data = self.transform(data)
+                    event = None
+                    if self.stream is not None:
+                        event = torch.cuda.Event()
+                        event.record(self.stream)
+                self._put((data, event))
+        except Exception as e:
+            self._put(e)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.finished:
+            raise StopIteration
+        item = self.queue.get()
+        if item is self._END:
+            self.close()
+            raise StopIteration
+        if isinstance(item, Exception):
+            self.close()
+            raise item
+        data, event = item
+        if event is not None:
+            stream = torch.cuda.current_stream()
+            stream.wait_event(event)
+            _record_stream(data, stream)
+        return data
+
+    def close(self):
+        """停止后台线程，并丢弃队列中已经搬运到设备上的 batch。"""
+        self.finished = True
+        self.stopped.set()
+        self.thread.join()
+        while True:
+            try:
+                self.queue.get_nowait()
+            except queue.Empty:
+                break
+        self.iterator = None
+
 
 class CollieDataLoader(object):
     """
@@ -14,6 +175,24 @@ class CollieDataLoader(object):
     在流水线并行的情景下每次迭代取出 ``batch_size * accumulation_steps`` 个
     sample。
 
+    当 ``dataset`` 的 ``batch_tokenize`` 为 ``True`` 时，原始样本会按 batch 读取，
+    并在 ``collate_fn`` 之前通过一次批量的 tokenizer 调用处理，详见
+    :class:`.CollieDatasetForTraining`。
+
+    当 ``dataset`` 为 :class:`.CollieStreamingDataset` 等 ``IterableDataset`` 时，
+    分片由数据集自行分配，``sampler`` 等参数不再生效。
+
+    对于非流式的数据集，``num_workers`` 大于 0 时 worker 进程会在各个 epoch 以及
+    各轮 eval 之间保持存活，epoch 通过 :meth:`set_epoch` 传入。
+
+    读取进度可以通过 :meth:`state_dict` 保存，并通过 :meth:`load_state_dict` 恢复，
+    恢复后的迭代直接从未读取过的 batch 开始。
+
+    当 ``prefetch_batches`` 大于 0 时，后台线程会提前读取 batch，并（在
+    ``pin_memory`` 为 ``True`` 时）锁页后在单独的 cuda stream 上搬运到设备上。训练
+    循环等待数据的时间记录在 :attr:`wait_time` （上一个 batch）和
+    :attr:`total_wait_time` （当前 epoch 累计）中，单位为秒。
+
     :param dataset:
     :param batch_size:
     :param pin_memory:
@@ -25,6 +204,17 @@ class CollieDataLoader(object):
     :param drop_last: 当最后一个 batch 样本数不足时是否丢弃。在流水线情况下如果为
         ``False``，则会补齐最后一个 batch。
     :param data_efficiency_config: DeepSpeed 中关于 ``Data Effiency`` 部分的设置
+    :param group_by_length: 是否将长度接近的样本分到同一个 batch 中以减少
+        padding，详见 :class:`.CollieBatchSampler`
+    :param lengths: 每个样本的长度。为 ``None`` 且 ``group_by_length`` 为
+        ``True`` 时，会使用 ``dataset.lengths`` 或遍历一次 ``dataset`` 计算
+    :param mega_batch_multiplier: 分桶时一个 mega batch 中包含的 batch 数目
+    :param max_tokens: 不为 ``None`` 时按 token 数目组 batch，每个 batch 中
+        padding 后的 token 数不超过 ``max_tokens``，此时 ``batch_size`` 不再生效，
+        详见 :class:`.CollieTokenBatchSampler`。在流水线并行的情景下该值为每个
+        micro batch 的 token 预算，且每个 batch 的样本数为 ``accumulation_steps``
+        的整数倍
+    :param prefetch_batches: 后台线程中提前读取的 batch 数目，为 0 时不预取
     """
     def __init__(self,
                  dataset,
@@ -36,7 +226,12 @@ class CollieDataLoader(object):
                  num_workers=None,
                  sampler=None,
                  drop_last=False,
-                 data_efficiency_config={}):
+                 data_efficiency_config={},
+                 group_by_length=False,
+                 lengths=None,
+                 mega_batch_multiplier=50,
+                 max_tokens=None,
+                 prefetch_batches=0):
         self.batch_size = batch_size
         if env.pp_size > 1:
             self.batch_size *= accumulation_steps
@@ -54,9 +249,27 @@ class CollieDataLoader(object):
             )
             device_count = get_accelerator().device_count()
             num_workers = data_efficiency_config[DATA_SAMPLING][DATA_SAMPLING_NUM_WORKERS]
+        elif isinstance(dataset, IterableDataset):
+            # 流式数据集自行分配分片，sampler 仅用于设置 epoch
+            sampler = dataset
+            device_count = 1
+            if num_workers is None:
+                num_workers = 2 * device_count
+        elif max_tokens is not None:
+            if lengths is None:
+                lengths = _get_lengths(dataset)
+            micro_batch_num = accumulation_steps if env.pp_size > 1 else 1
+            sampler = CollieTokenBatchSampler(
+                lengths, max_tokens * micro_batch_num,
+                num_replicas=env.dp_size, rank=env.dp_rank, shuffle=shuffle,
+                drop_last=drop_last, batch_size_multiple=micro_batch_num
+            )
+            device_count = 1
+            if num_workers is None:
+                num_workers = 2 * device_count
         else:
             if sampler is None:
-                sampler = DistributedSampler(
+                sampler = CollieDistributedSampler(
                     dataset=dataset, num_replicas=env.dp_size,
                     rank=env.dp_rank, shuffle=shuffle
                 )
@@ -74,11 +287,40 @@ class CollieDataLoader(object):
         self.data = None
         self.drop_last = drop_last
         self.post_process_func = None
+        self.shuffle = shuffle
+        self.mega_batch_multiplier = mega_batch_multiplier
+        self.max_tokens = max_tokens
+        self.prefetch_batches = prefetch_batches
+        self.prefetcher = None
+        # 非流式数据集的 DataLoader 只创建一次，其 worker 在各 epoch 和各轮 eval 之间复用
+        self.dataloader = None
+        self.wait_time = 0.
+        self.total_wait_time = 0.
+        if group_by_length and lengths is None:
+            lengths = _get_lengths(dataset)
+        self.lengths = lengths
+        self.streaming = isinstance(dataset, IterableDataset)
+        # 流式数据集中每个 worker 的读取进度，见 CollieStreamingDataset.load_state_dict
+        self.consumed = [None] * max(self.num_workers, 1)
+        # 当前 epoch 中已经读取的 batch 数，以及下一次迭代的起始 batch
+        self.batch_idx = 0
+        self.start_batch = 0
 
-        if self.drop_last:
+        if self.streaming:
+            try:
+                num_samples = len(self.dataset) / env.dp_size
+            except TypeError:
+                # 长度未知
+                num_samples = 0
+            if self.drop_last:
+                self.len = int(num_samples // self.batch_size)
+            else:
+                self.len = ceil(num_samples / self.batch_size)
+        elif self.max_tokens is not None:
+            self.len = len(self.sampler)
+        elif self.drop_last:
             self.len = len(self.sampler) // self.batch_size
         else:
-            from math import ceil
             self.len = ceil(len(self.sampler) / self.batch_size)
 
     def __iter__(self):
@@ -90,36 +332,151 @@ class CollieDataLoader(object):
         return self.len
 
     def __next__(self):
+        start = time.perf_counter()
         if self.curriculum_learning_enabled:
             data = next(self.data_iterator)
+        else:
+            data = next(self.data)
+        if self.prefetcher is None:
+            data = self._to_device(data)
+        self.wait_time = time.perf_counter() - start
+        self.total_wait_time += self.wait_time
+        if self.curriculum_learning_enabled:
             if self.post_process_func is not None:
                 data = self.post_process_func(data, self.sampler.state_dict())
             return data
-        else:
-            return next(self.data)
+        self.batch_idx += 1
+        return data
+
+    def _to_device(self, data):
+        if self.pin_memory and torch.cuda.is_available():
+            data = _pin(data)
+        # ColliePadder 在子进程中只在 CPU 上填充，在主进程中统一搬运一次
+        if isinstance(self.collate_fn, ColliePadder):
+            return self.collate_fn.to_device(data)
+        return data
+
+    def _iterate(self, dataloader):
+        self.close()
+        self.total_wait_time = 0.
+        if self.prefetch_batches > 0:
+            self.prefetcher = _DevicePrefetcher(
+                iter(dataloader), self._to_device, self.prefetch_batches
+            )
+            return self.prefetcher
+        return iter(dataloader)
+
+    def close(self):
+        """
+        停止预取的后台线程并释放其中的 batch。迭代结束时会自动调用，提前结束迭代时
+        需要手动调用。
+        """
+        if self.prefetcher is not None:
+            self.prefetcher.close()
+            self.prefetcher = None
+
+    def set_epoch(self, epoch_idx):
+        """设置下一次迭代的 epoch，已经启动的 worker 会被继续使用。"""
+        self.sampler.set_epoch(epoch_idx)
+
+    def seek(self, batch_idx):
+        """令下一次迭代从第 ``batch_idx`` 个 batch 开始，跳过的 batch 不会被读取。"""
+        assert not self.streaming and not self.curriculum_learning_enabled, \
+            "Only map-style datasets without curriculum learning support `seek`."
+        self.start_batch = batch_idx
+
+    def state_dict(self):
+        """返回当前 epoch 的读取进度。"""
+        assert not self.curriculum_learning_enabled, \
+            "Curriculum learning does not support `state_dict`."
+        if self.streaming:
+            return {"epoch": self.dataset.epoch, "consumed": list(self.consumed)}
+        return {"epoch": getattr(self.sampler, "epoch", 0), "batch_idx": self.batch_idx}
+
+    def load_state_dict(self, state_dict):
+        """恢复读取进度，下一次迭代将从未读取过的 batch 开始。"""
+        assert not self.curriculum_learning_enabled, \
+            "Curriculum learning does not support `load_state_dict`."
+        if not self.streaming:
+            if hasattr(self.sampler, "set_epoch"):
+                self.sampler.set_epoch(state_dict["epoch"])
+            self.seek(state_dict["batch_idx"])
+            return
+        if len(state_dict["consumed"]) != len(self.consumed):
+            raise ValueError(
+                "The number of dataloader workers must be the same as the "
+                f"checkpoint: {max(self.num_workers, 1)} != "
+                f"{len(state_dict['consumed'])}."
+            )
+        self.consumed = list(state_dict["consumed"])
+        self.dataset.load_state_dict(state_dict)
+
+    def _streaming_batches(self, iterator):
+        for batch, worker_id, consumed in iterator:
+            self.consumed[worker_id] = consumed
+            yield batch
+
+    def _get_dataset_and_collate_fn(self):
+        if getattr(self.dataset, "batch_tokenize", False):
+            return _RawRecordDataset(self.dataset), \
+                _BatchTokenizeCollator(self.dataset, self.collate_fn)
+        return self.dataset, self.collate_fn
 
     def _create_dataloader(self):
+        dataset, collate_fn = self._get_dataset_and_collate_fn()
+        start_batch, self.start_batch = self.start_batch, 0
+        self.batch_idx = start_batch
         if self.curriculum_learning_enabled:
             self.dataloader = DataLoader(
-                self.dataset, pin_memory=self.pin_memory,
+                dataset, pin_memory=self.pin_memory,
                 batch_sampler=self.sampler, num_workers=self.num_workers,
-                collate_fn=self.collate_fn
+                collate_fn=collate_fn
             )
-            self.data_iterator = iter(self.dataloader)
+            self.data_iterator = self._iterate(self.dataloader)
+            return self.dataloader
+        elif self.streaming:
+            if self.dataset._resume_state is None:
+                self.consumed = [None] * len(self.consumed)
+            # 流水线并行要求每个 batch 都能被均分为 micro batch
+            self.dataloader = DataLoader(dataset,
+                                         batch_size=self.batch_size,
+                                         collate_fn=_StreamingCollator(dataset, collate_fn),
+                                         num_workers=self.num_workers,
+                                         drop_last=self.drop_last or env.pp_size > 1)
+            # worker 在创建迭代器时已经复制了恢复位置，之后的 epoch 从头开始
+            self.data = self._streaming_batches(self._iterate(self.dataloader))
+            self.dataset._resume_state = None
+            return self.dataloader
+        elif self.max_tokens is not None:
+            self.sampler.seek(start_batch)
+            if self.dataloader is None:
+                self.dataloader = DataLoader(dataset,
+                                             batch_sampler=self.sampler,
+                                             collate_fn=collate_fn,
+                                             num_workers=self.num_workers,
+                                             persistent_workers=self.num_workers > 0)
+            self.data = self._iterate(self.dataloader)
             return self.dataloader
         else:
-            if self.drop_last:
-                last_batch = "drop"
-            elif env.pp_size > 1:
-                last_batch = "fill"
-            else:
-                last_batch = "normal"
-            batch_sampler = CollieBatchSampler(self.sampler, self.batch_size,
-                                               last_batch)
-            self.dataloader = DataLoader(self.dataset,
-                                         batch_sampler=batch_sampler,
-                                         collate_fn=self.collate_fn,
-                                         num_workers=self.num_workers)
-            self.data = (x for x in self.dataloader)
-
+            if self.dataloader is None:
+                if self.drop_last:
+                    last_batch = "drop"
+                elif env.pp_size > 1:
+                    last_batch = "fill"
+                else:
+                    last_batch = "normal"
+                batch_sampler = CollieBatchSampler(self.sampler, self.batch_size,
+                                                   last_batch, lengths=self.lengths,
+                                                   mega_batch_multiplier=self.mega_batch_multiplier,
+                                                   shuffle=self.shuffle)
+                self.dataloader = DataLoader(dataset,
+                                             batch_sampler=batch_sampler,
+                                             collate_fn=collate_fn,
+                                             num_workers=self.num_workers,
+                                             persistent_workers=self.num_workers > 0)
+            # sampler 在主进程中迭代，worker 不需要随 epoch 重建
+            batch_sampler = self.dataloader.batch_sampler
+            batch_sampler.epoch = getattr(self.sampler, "epoch", 0)
+            batch_sampler.seek(start_batch)
+            self.data = self._iterate(self.dataloader)
             return self.dataloader
@@ -1,59 +1,148 @@
 """CoLLie 中预定义的数据结构
 """
+import copy
 import io
 import json
 import mmap
 import os
 import random
+import tempfile
 import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
 from functools import reduce
-from typing import Dict, List, Optional, Sequence, Tuple
+from itertools import islice
+from typing import Dict, List, Optional, Sequence, Tuple, Union
 
 import numpy as np
 import torch
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, IterableDataset, get_worker_info
 from torch.utils.data.dataset import Dataset
 from transformers import PreTrainedTokenizer
 
-from collie.driver.io import FileIODriver
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from collie.data.cache import (
+    _dataset_fingerprint,
+    _TokenizationCache,
+    _tokenizer_fingerprint,
+)
+from collie.data.permutation import _IndexPermutation
+from collie.driver.io import FileIODriver, IODriver
+from collie.log import logger
+from collie.utils import env
 
 __all__ = [
     "CollieDatasetForTraining",
+    "ColliePackedDataset",
     "CollieDatasetForGeneration",
     "CollieDatasetForClassification",
+    "CollieStreamingDataset",
 ]
 
 
+_JSON_INDEX_FILE = "collie-dataset-index"
+_LENGTHS_FILE_PREFIX = "collie-lengths"
+
+
+def _zstd_module():
+    if zstandard is None:
+        raise ModuleNotFoundError(
+            "Package `zstandard` is required for zstd compressed datasets, "
+            "please install it with `pip install collie-lm[zstd]`."
+        )
+    return zstandard
+
+
 class _ShardContainer(list):
-    def __init__(self, path, shuffle: bool = False, seed: int = 1024) -> None:
+    """读取 ``json`` 格式的预处理数据集。每个 shard 由 ``.bin`` 文件（每行一条样本）
+    和 ``.meta`` 文件（每条样本的偏移量与长度）组成。
+
+    所有样本的索引以三个连续的 ``numpy`` 数组保存：所在文件的编号、偏移量和长度。
+    数据集文件夹中存在 :meth:`save_index` 保存的索引时会以 ``mmap`` 的方式加载，
+    DataLoader 的各个 worker 可以共享同一份索引。
+
+    ``.bin.zst`` 文件由若干个独立压缩的 zstd frame 组成，格式见
+    :class:`_JsonShardWriter`。读取样本时只解压其所在的 frame，最近使用的
+    ``frame_cache_size`` 个 frame 会被缓存。
+    """
+
+    def __init__(
+        self, path, shuffle: bool = False, seed: int = 1024, frame_cache_size: int = 8
+    ) -> None:
         list.__init__([])
         self.file = None
         self.file_name = None
         self.shuffle = shuffle
         self.seed = seed
+        self.frame_cache_size = frame_cache_size
         self.threadlocal = threading.local()
-        meta_files = []
-        for file in FileIODriver.list(path):
-            if file.endswith(".meta"):
-                meta_files.append(os.path.join(path, file))
-        self.meta = [
+        # 压缩文件中每个 frame 的位置与大小，按文件编号懒加载
+        self.frames = {}
+        if FileIODriver.exists(os.path.join(path, _JSON_INDEX_FILE + ".json")):
+            files = json.loads(
+                FileIODriver.load(os.path.join(path, _JSON_INDEX_FILE + ".json"), mode="r")
+            )["files"]
+            self.files = [os.path.join(path, file) for file in files]
+            index = np.load(os.path.join(path, _JSON_INDEX_FILE + ".npy"), mmap_mode="r")
+            self.file_ids, self.offsets, self.lengths = index[0], index[1], index[2]
+        else:
+            # 按 shard 的编号排序，与写入时的顺序一致
+            meta_files = sorted(
+                (file for file in FileIODriver.list(path) if file.endswith(".meta")),
+                key=lambda file: (len(file), file),
+            )
+            self.files = [os.path.join(path, file[: -len(".meta")]) for file in meta_files]
+            metas = []
+            for i, file in enumerate(meta_files):
+                meta = FileIODriver.load(os.path.join(path, file), mode="rb")
+                if isinstance(meta, dict):
+                    self.frames[i] = meta["frames"]
+                    meta = meta["meta"]
+                metas.append(np.asarray(meta, dtype=np.int64).reshape(-1, 2))
+            self.file_ids = np.concatenate(
+                [np.full(len(meta), i, dtype=np.int64) for i, meta in enumerate(metas)]
+                + [np.zeros(0, dtype=np.int64)]
+            )
+            metas = np.concatenate(metas + [np.zeros((0, 2), dtype=np.int64)])
+            self.offsets, self.lengths = metas[:, 0].copy(), metas[:, 1].copy()
+        self.indices = None
+        if self.shuffle:
+            self.indices = _IndexPermutation(len(self.offsets), self.seed)
+
+    @staticmethod
+    def save_index(path, files: Sequence[str], file_ids, offsets, lengths):
+        """将索引保存到 ``path`` 中，之后可以通过 ``mmap`` 的方式加载。
+
+        :param files: ``.bin`` 文件相对于 ``path`` 的路径
+        :param file_ids: 每条样本所在文件在 ``files`` 中的下标
+        :param offsets: 每条样本在文件中的偏移量
+        :param lengths: 每条样本的长度
+        """
+        index = np.stack(
             [
-                {"file": file, "offset": meta[0], "length": meta[1]}
-                for meta in FileIODriver.load(file, mode="rb")
+                np.asarray(file_ids, dtype=np.int64),
+                np.asarray(offsets, dtype=np.int64),
+                np.asarray(lengths, dtype=np.int64),
             ]
-            for file in meta_files
-        ]
-        self.meta = np.hstack(self.meta).tolist()
-        self.indices = list(range(len(self.meta)))
-        if self.shuffle:
-            random.seed(self.seed)
-            random.shuffle(self.indices)
+        )
+        np.save(os.path.join(path, _JSON_INDEX_FILE + ".npy"), index)
+        FileIODriver.save(
+            json.dumps({"files": list(files)}),
+            os.path.join(path, _JSON_INDEX_FILE + ".json"),
+        )
 
     def _get_mmap(self, path):
         if not hasattr(self.threadlocal, "handles"):
+            self.threadlocal.handles = {}
+        if path not in self.threadlocal.handles:
             with open(path, "rb") as f:
                 mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
-                self.threadlocal.handles = [f, mm]
+                self.threadlocal.handles[path] = [f, mm]
                 if (
                     path.endswith(".gz")
                     or path.endswith(".bz")
@@ -63,27 +152,354 @@ class _ShardContainer(list):
                         "Compressed files are not supported because .seek() would require "
                         "rereading the entire file, making performance too slow."
                     )
-        return self.threadlocal.handles[-1]
+        return self.threadlocal.handles[path][-1]
+
+    def _get_frame(self, file_id: int, frame_idx: int) -> bytes:
+        if not hasattr(self.threadlocal, "frame_cache"):
+            self.threadlocal.frame_cache = OrderedDict()
+            self.threadlocal.decompressor = _zstd_module().ZstdDecompressor()
+        cache = self.threadlocal.frame_cache
+        key = (file_id, frame_idx)
+        if key in cache:
+            cache.move_to_end(key)
+            return cache[key]
+        if file_id not in self.frames:
+            self.frames[file_id] = FileIODriver.load(
+                self.files[file_id] + ".meta", mode="rb"
+            )["frames"]
+        offset, size = self.frames[file_id][frame_idx]
+        data = self._get_mmap(self.files[file_id])[offset : offset + size]
+        cache[key] = self.threadlocal.decompressor.decompress(data)
+        if len(cache) > self.frame_cache_size:
+            cache.popitem(last=False)
+        return cache[key]
 
     def __len__(self):
-        return len(self.meta)
+        return len(self.offsets)
 
     def __getitem__(self, index):
-        meta = self.meta[self.indices[index]]
-        file_name: str = meta["file"]
+        if self.indices is not None:
+            index = self.indices[index]
+        file_id = int(self.file_ids[index])
+        file_name = self.files[file_id]
+        if file_name.endswith(".zst"):
+            offset = int(self.offsets[index])
+            frame = self._get_frame(file_id, offset >> 32)
+            start = offset & 0xFFFFFFFF
+            return json.loads(frame[start : frame.index(b"\n", start)].decode())
         if (
             self.file is None
-            or self.file_name != file_name.replace(".meta", "")
+            or self.file_name != file_name
             or (isinstance(self.file, mmap.mmap) and self.file.closed)
         ):
-            self.file_name = file_name.replace(".meta", "")
-            if self.file is not None:
-                self.file.close()
+            self.file_name = file_name
             self.file = self._get_mmap(self.file_name)
-        self.file.seek(meta["offset"])
+        self.file.seek(int(self.offsets[index]))
         return json.loads(self.file.readline().decode())
 
 
+_BINARY_META_FILE = "collie-dataset-meta.json"
+_BINARY_SHARD_PREFIX = "collie-dataset-shard"
+
+
+def _is_binary_processed(path, protocol: str = "file") -> bool:
+    return IODriver.from_protocol(protocol).exists(os.path.join(path, _BINARY_META_FILE))
+
+
+def _token_dtype(max_token_id: int):
+    # 最大值保留给 labels 中的 -100
+    if max_token_id < np.iinfo(np.uint16).max:
+        return np.uint16
+    return np.uint32
+
+
+class _BinaryShardContainer:
+    """二进制格式的预处理数据集。
+
+    每个 shard 由三个文件组成：
+
+    * ``{shard}.tokens`` - 所有样本 ``input_ids`` 拼接而成的一维数组；
+    * ``{shard}.labels`` - 与 ``tokens`` 等长的 ``labels`` 数组，数据类型的最大值
+      表示 ``-100``；
+    * ``{shard}.idx`` - 长度为 ``样本数 + 1`` 的 ``int64`` 偏移量数组。
+
+    所有文件都通过 ``np.memmap`` 读取，按样本切片时不会发生拷贝。``memmap`` 在
+    各个进程中按需打开，因此可以安全地传给 DataLoader 的 worker。``memmap`` 只能
+    用于本地文件，其它协议下只能读取元信息和样本长度。
+    """
+
+    def __init__(self, path, protocol: str = "file") -> None:
+        self.path = path
+        self.io_driver = IODriver.from_protocol(protocol)
+        meta = json.loads(self.io_driver.load(os.path.join(path, _BINARY_META_FILE), mode="r"))
+        self.dtype = np.dtype(meta["dtype"])
+        self.shards = meta["shards"]
+        self.ignore_value = np.iinfo(self.dtype).max
+        self.cumulative = np.cumsum([0] + [shard["num_samples"] for shard in self.shards])
+        self._handles = None
+        self._lengths = None
+
+    def _open(self):
+        if self.io_driver is not FileIODriver:
+            raise ValueError(
+                f"The binary dataset in `{self.path}` is read with `np.memmap`, which "
+                "requires a local path. Please copy it to the local file system first."
+            )
+        handles = []
+        for shard in self.shards:
+            prefix = os.path.join(self.path, shard["name"])
+            if shard["num_samples"] == 0:
+                handles.append(None)
+                continue
+            handles.append(
+                (
+                    np.memmap(prefix + ".tokens", dtype=self.dtype, mode="r"),
+                    np.memmap(prefix + ".labels", dtype=self.dtype, mode="r"),
+                    np.memmap(prefix + ".idx", dtype=np.int64, mode="r"),
+                )
+            )
+        self._handles = handles
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_handles"] = None
+        return state
+
+    @property
+    def lengths(self) -> np.ndarray:
+        """每条样本的 token 数目，只读取 ``.idx`` 文件。"""
+        if self._lengths is None:
+            lengths = [np.zeros(0, dtype=np.int64)]
+            for shard in self.shards:
+                if shard["num_samples"] == 0:
+                    continue
+                buffer = self.io_driver.load_buffer(os.path.join(self.path, shard["name"] + ".idx"))
+                offsets = np.frombuffer(buffer.getvalue(), dtype=np.int64)
+                buffer.close()
+                lengths.append(np.diff(offsets))
+            self._lengths = np.concatenate(lengths)
+        return self._lengths
+
+    def __len__(self):
+        return int(self.cumulative[-1])
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if index < 0 or index >= len(self):
+            raise IndexError("Index out of range.")
+        if self._handles is None:
+            self._open()
+        shard_idx = int(np.searchsorted(self.cumulative, index, side="right")) - 1
+        tokens, labels, offsets = self._handles[shard_idx]
+        local_idx = index - self.cumulative[shard_idx]
+        start, end = offsets[local_idx], offsets[local_idx + 1]
+        raw_labels = labels[start:end]
+        labels = raw_labels.astype(np.int32)
+        labels[raw_labels == self.ignore_value] = -100
+        return {"tokens": np.array(tokens[start:end], dtype=np.int32), "labels": labels}
+
+
+class _BinaryShardWriter:
+    """将样本逐个写入二进制 shard，格式见 :class:`_BinaryShardContainer`。
+
+    本地文件系统上样本直接追加写入 shard 文件；其他 :class:`~collie.driver.io.IODriver`
+    不支持追加写入，样本先写入临时文件（超过 ``_SPOOL_SIZE`` 后落盘），写满一个
+    shard 后再通过 ``save_buffer`` 保存。
+    """
+
+    _SPOOL_SIZE = 1024 * 1024
+
+    def __init__(self, path: str, dtype, shard_size: int = 4, protocol: str = "file") -> None:
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.ignore_value = np.iinfo(self.dtype).max
+        self.shard_size = shard_size * 1024 * 1024
+        self.io_driver = IODriver.from_protocol(protocol)
+        self.shards = []
+        self.io_driver.makedirs(path, exist_ok=True)
+        self._new_shard()
+
+    def _open(self, path):
+        if self.io_driver is FileIODriver:
+            return open(path, "wb")
+        return tempfile.SpooledTemporaryFile(max_size=self._SPOOL_SIZE)
+
+    def _new_shard(self):
+        name = f"{_BINARY_SHARD_PREFIX}-{len(self.shards)}"
+        prefix = os.path.join(self.path, name)
+        self.tokens_file = self._open(prefix + ".tokens")
+        self.labels_file = self._open(prefix + ".labels")
+        self.offsets = [0]
+        self.shards.append({"name": name, "num_samples": 0})
+
+    def _close_shard(self):
+        prefix = os.path.join(self.path, self.shards[-1]["name"])
+        for file, suffix in ((self.tokens_file, ".tokens"), (self.labels_file, ".labels")):
+            if self.io_driver is not FileIODriver:
+                self.io_driver.save_buffer(file, prefix + suffix)
+            file.close()
+        offsets = io.BytesIO(np.asarray(self.offsets, dtype=np.int64).tobytes())
+        self.io_driver.save_buffer(offsets, prefix + ".idx")
+
+    def write(self, tokens, labels=None, attention_mask=None):
+        # attention_mask 不会被保存，读取时重新构造为全 1
+        tokens = np.asarray(tokens, dtype=np.int64)
+        labels = tokens if labels is None else np.asarray(labels, dtype=np.int64)
+        assert (
+            tokens.shape == labels.shape
+        ), f"tokens and labels must have the same shape, got {tokens.shape} and {labels.shape}."
+        if tokens.size > 0 and tokens.max() >= self.ignore_value:
+            raise ValueError(
+                f"Token id {tokens.max()} is too large for dtype {self.dtype}."
+            )
+        labels = np.where(labels < 0, self.ignore_value, labels)
+        self.tokens_file.write(tokens.astype(self.dtype).tobytes())
+        self.labels_file.write(labels.astype(self.dtype).tobytes())
+        self.offsets.append(self.offsets[-1] + len(tokens))
+        self.shards[-1]["num_samples"] += 1
+        if self.offsets[-1] * self.dtype.itemsize > self.shard_size:
+            self._close_shard()
+            self._new_shard()
+
+    def close(self):
+        if self.shards[-1]["num_samples"] == 0 and len(self.shards) > 1:
+            # 最后一个 shard 为空时不保存
+            prefix = os.path.join(self.path, self.shards.pop()["name"])
+            for file, suffix in ((self.tokens_file, ".tokens"), (self.labels_file, ".labels")):
+                file.close()
+                if self.io_driver is FileIODriver:
+                    FileIODriver.delete(prefix + suffix)
+        else:
+            self._close_shard()
+        meta = {"format": "binary", "version": 1, "dtype": self.dtype.name, "shards": self.shards}
+        self.io_driver.save(json.dumps(meta), os.path.join(self.path, _BINARY_META_FILE))
+
+
+class _JsonShardWriter:
+    """将样本逐个写入 ``json`` 格式的 shard，格式见 :class:`_ShardContainer`。
+
+    ``compression`` 为 ``'zstd'`` 时，每 ``frame_size`` 大小的样本被压缩为一个独立的
+    zstd frame，样本的偏移量为 ``frame 编号 << 32 | frame 内的偏移量``，各个 frame 在
+    文件中的位置保存在 ``.meta`` 文件中。
+    """
+
+    def __init__(
+        self,
+        path: str,
+        shard_size: int = 4,
+        compression: Optional[str] = None,
+        frame_size: float = 0.25,
+    ) -> None:
+        if compression not in (None, "zstd"):
+            raise ValueError(f"Unsupported compression `{compression}`.")
+        if compression == "zstd":
+            self.compressor = _zstd_module().ZstdCompressor()
+        self.path = path
+        self.shard_size = shard_size * 1024 * 1024
+        self.compression = compression
+        self.frame_size = frame_size * 1024 * 1024
+        self.shard_idx = 0
+        # 所有已经写完的 shard 的文件名与索引
+        self.files = []
+        self.metas = []
+        FileIODriver.makedirs(path, exist_ok=True)
+        self._new_shard()
+
+    def _new_shard(self):
+        self.file_name = os.path.join(
+            self.path, f"{_BINARY_SHARD_PREFIX}-{self.shard_idx}.bin"
+        )
+        if self.compression == "zstd":
+            self.file_name += ".zst"
+        self.file = open(self.file_name, "wb")
+        self.meta = []
+        self.frames = []
+        self.frame = bytearray()
+
+    def _flush_frame(self):
+        if len(self.frame) == 0:
+            return
+        data = self.compressor.compress(bytes(self.frame))
+        self.frames.append((self.file.tell(), len(data)))
+        self.file.write(data)
+        self.frame = bytearray()
+
+    def _close_shard(self):
+        meta = np.asarray(self.meta, dtype=np.int64).reshape(-1, 2)
+        if self.compression == "zstd":
+            self._flush_frame()
+            FileIODriver.save(
+                {"meta": meta, "frames": np.asarray(self.frames, dtype=np.int64).reshape(-1, 2)},
+                self.file_name + ".meta",
+            )
+        else:
+            FileIODriver.save(meta, self.file_name + ".meta")
+        self.file.close()
+        self.files.append(os.path.basename(self.file_name))
+        self.metas.append(meta)
+        self.shard_idx += 1
+
+    def write(self, tokens, labels=None, attention_mask=None):
+        data = {"tokens": np.asarray(tokens).tolist()}
+        if attention_mask is not None:
+            data["attention_mask"] = np.asarray(attention_mask).tolist()
+        if labels is not None:
+            data["labels"] = np.asarray(labels).tolist()
+        line = json.dumps(data).encode() + "\n".encode()
+        if self.compression == "zstd":
+            self.meta.append(((len(self.frames) << 32) | len(self.frame), len(data["tokens"])))
+            self.frame += line
+            if len(self.frame) > self.frame_size:
+                self._flush_frame()
+            size = self.file.tell() + len(self.frame)
+        else:
+            self.meta.append((self.file.tell(), len(data["tokens"])))
+            self.file.write(line)
+            size = self.file.tell()
+        if size > self.shard_size:
+            self._close_shard()
+            self._new_shard()
+
+    def close(self):
+        self._close_shard()
+        if len(self.meta) == 0 and self.shard_idx > 1:
+            FileIODriver.delete(self.file_name)
+            FileIODriver.delete(self.file_name + ".meta")
+            self.files.pop()
+            self.metas.pop()
+        _ShardContainer.save_index(
+            self.path,
+            self.files,
+            np.concatenate(
+                [np.full(len(meta), i, dtype=np.int64) for i, meta in enumerate(self.metas)]
+            ),
+            np.concatenate([meta[:, 0] for meta in self.metas]),
+            np.concatenate([meta[:, 1] for meta in self.metas]),
+        )
+
+
+_PREPROCESS_DATASET = None
+
+
+def _init_preprocess_worker(dataset):
+    global _PREPROCESS_DATASET
+    _PREPROCESS_DATASET = dataset
+
+
+def _preprocess_worker(records):
+    return _PREPROCESS_DATASET._get_samples(records)
+
+
+def _lengths_worker(records):
+    return _PREPROCESS_DATASET._record_lengths(records)
+
+
+def _as_tokens(ids) -> np.ndarray:
+    """将 token id 转换为连续的 ``int32`` 数组。"""
+    return np.asarray(ids, dtype=np.int32)
+
+
 def _inspect_special_tokens_length(tokenizer):
     ids_with_special_tokens = tokenizer("a", add_special_tokens=True).input_ids
     ids_without_special_tokens = tokenizer("a", add_special_tokens=False).input_ids
@@ -136,6 +552,20 @@ class CollieDatasetForTraining(Dataset):
 
     当使用第二种数据格式时，只有 `output` 部分的 token 会参与 loss计算。
     当使用第二种数据格式时，`labels` 字段是可选的，如果不提供 `labels` 默认计算所有 token 的 loss
+
+    设置 ``cache_dir`` 后，tokenize 的结果会被持久化到该文件夹中。缓存以 tokenizer
+    的指纹和样本内容为 key，可以被 DataLoader 的多个 worker、多个进程以及之后的运行共享。
+
+    设置 ``batch_tokenize=True`` 后，:class:`~collie.data.CollieDataLoader` 会按 batch
+    读取原始样本，并在 ``collate_fn`` 之前通过一次批量的 tokenizer 调用完成处理，
+    以充分利用 fast tokenizer 的并行能力。
+
+    处理后的样本中 ``input_ids`` 和 ``labels`` 为 ``int32`` 的 ``numpy`` 数组；
+    ``attention_mask`` 仅在原始数据中提供时保存，否则由
+    :class:`~collie.utils.ColliePadder` 在组 batch 时根据样本长度生成。
+
+    每个样本的 token 数目可以通过 :attr:`lengths` 获得，分桶、按 token 数组 batch
+    以及 packing 等功能会直接使用该属性而不读取样本内容，详见 :meth:`get_lengths`。
     """
 
     def __init__(
@@ -146,15 +576,23 @@ class CollieDatasetForTraining(Dataset):
         shuffle: bool = False,
         seed: int = 1024,
         max_length: int = -1,
+        cache_dir: Optional[str] = None,
+        batch_tokenize: bool = False,
     ):
         self.dataset = dataset
         self.tokenizer = tokenizer
         self.add_special_tokens = add_special_tokens
-        self.indices = list(range(len(self.dataset)))
+        # 打乱时使用不需要保存的随机排列，避免为每个样本保存一个下标
+        self.indices = (
+            _IndexPermutation(len(self.dataset), seed)
+            if shuffle
+            else range(len(self.dataset))
+        )
         self.max_length = max_length
-        if shuffle:
-            random.seed(seed)
-            random.shuffle(self.indices)
+        self.cache_dir = cache_dir
+        self.batch_tokenize = batch_tokenize
+        self._cache = None
+        self._lengths = None
         if self.tokenizer is not None:
             self.bos_length, self.eos_length = _inspect_special_tokens_length(self.tokenizer)
 
@@ -166,60 +604,203 @@ class CollieDatasetForTraining(Dataset):
             return self._get_slice(index)
         if index > len(self):
             raise IndexError("Index out of range.")
-        index = self.indices[index]
+        return self._get_sample(self._get_record(index))
+
+    def _get_record(self, index) -> Dict:
+        """返回第 ``index`` 条未经处理的原始样本。"""
+        return self.dataset[self.indices[index]]
+
+    def _get_sample(self, record: Dict) -> Dict:
+        """处理一条原始样本。设置了 ``cache_dir`` 时优先从 tokenize 缓存中读取。"""
+        if self.tokenizer is None or self.cache_dir is None:
+            return self._process(record)
+        return self._get_cache().get_or_compute(record, self._process)
+
+    def _get_samples(self, records: Sequence[Dict]) -> List[Dict]:
+        """批量处理一组原始样本，结果与逐个调用 :meth:`_get_sample` 相同。"""
+        if self.tokenizer is None or self.cache_dir is None:
+            return self._tokenize_batch(records)
+        return self._get_cache().get_or_compute_many(records, self._tokenize_batch)
+
+    def _get_cache(self) -> _TokenizationCache:
+        if self._cache is None:
+            self._cache = _TokenizationCache(self.cache_dir, self._cache_namespace())
+        return self._cache
+
+    def _cache_namespace(self) -> str:
+        """tokenize 缓存的命名空间，包含所有会影响处理结果的参数。"""
+        return json.dumps(
+            {
+                "dataset": self.__class__.__name__,
+                "tokenizer": _tokenizer_fingerprint(self.tokenizer),
+                "add_special_tokens": self.add_special_tokens,
+                "max_length": self.max_length,
+                "style": getattr(self, "style", None),
+                "shared_prefix": getattr(self, "shared_prefix", None),
+            },
+            sort_keys=True,
+        )
+
+    def _make_sample(self, input_ids, labels=None, attention_mask=None) -> Dict:
+        """构造一条 ``int32`` 数组格式的样本并按 ``max_length`` 截断。
+
+        ``attention_mask`` 只有在原始数据中提供时才会保存，否则由
+        :class:`~collie.utils.ColliePadder` 在组 batch 时根据长度生成。
+        """
+        input_ids = _as_tokens(input_ids)
+        labels = input_ids if labels is None else _as_tokens(labels)
+        sample = {"input_ids": input_ids, "labels": labels}
+        if attention_mask is not None:
+            sample["attention_mask"] = _as_tokens(attention_mask)
+        if self.max_length > 0:
+            for key in sample.keys():
+                sample[key] = sample[key][: self.max_length]
+        return sample
+
+    def _mask_prompt(self, input_ids, target_length: int) -> np.ndarray:
+        """返回只有最后 ``target_length`` 个 token 参与 loss 计算的 ``labels``。"""
+        if self.add_special_tokens:
+            target_length -= self.bos_length
+        labels = _as_tokens(input_ids).copy()
+        labels[: -target_length] = -100
+        return labels
+
+    def _process(self, record: Dict) -> Dict:
         if self.tokenizer is None:
-            input_ids = self.dataset[index]["tokens"]
-            labels = self.dataset[index].get("labels", input_ids.detach().clone())
-            if "attention_mask" in self.dataset[index].keys():
-                attention_mask = self.dataset[index]["attention_mask"]
-            else:
-                attention_mask = torch.ones_like(torch.tensor(input_ids)).cpu().tolist()
-        else:
-            if "text" in self.dataset[0].keys():
-                inputs = self.tokenizer(
-                    self.dataset[index]["text"],
-                    add_special_tokens=self.add_special_tokens,
-                )
-                input_ids = inputs["input_ids"]
-                labels = torch.tensor(input_ids).cpu().tolist()
-                attention_mask = inputs.get(
-                    "attention_mask",
-                    torch.ones_like(torch.tensor(input_ids)).cpu().tolist(),
-                )
-            elif (
-                "input" in self.dataset[0].keys() and "output" in self.dataset[0].keys()
-            ):
-                inputs = self.tokenizer(
-                    self.dataset[index]["input"] + self.dataset[index]["output"],
-                    add_special_tokens=self.add_special_tokens,
-                )
-                input_ids = inputs["input_ids"]
-                attention_mask = inputs.get(
-                    "attention_mask",
-                    torch.ones_like(torch.tensor(input_ids)).cpu().tolist(),
-                )
-                labels = torch.tensor(input_ids)
-                target_length = len(
-                    self.tokenizer(
-                        self.dataset[index]["output"],
-                        add_special_tokens=self.add_special_tokens,
-                    ).input_ids
+            return self._make_sample(
+                record["tokens"], record.get("labels", None), record.get("attention_mask", None)
+            )
+        if "text" in record.keys():
+            input_ids = self.tokenizer(
+                record["text"], add_special_tokens=self.add_special_tokens
+            )["input_ids"]
+            return self._make_sample(input_ids)
+        if "input" in record.keys() and "output" in record.keys():
+            input_ids = self.tokenizer(
+                record["input"] + record["output"],
+                add_special_tokens=self.add_special_tokens,
+            )["input_ids"]
+            target_length = len(
+                self.tokenizer(
+                    record["output"], add_special_tokens=self.add_special_tokens
+                ).input_ids
+            )
+            return self._make_sample(input_ids, self._mask_prompt(input_ids, target_length))
+        raise ValueError("Dataset must have one or two fields.")
+
+    def _tokenize_batch(self, records: Sequence[Dict]) -> List[Dict]:
+        """使用 ``tokenizer`` 的批处理接口处理一组原始样本，结果与逐个调用
+        :meth:`__getitem__` 相同。
+        """
+        if self.tokenizer is None:
+            return [self._process(record) for record in records]
+        if "text" in records[0].keys():
+            inputs = self.tokenizer(
+                [record["text"] for record in records],
+                add_special_tokens=self.add_special_tokens,
+            )
+            return [self._make_sample(input_ids) for input_ids in inputs["input_ids"]]
+        if "input" in records[0].keys() and "output" in records[0].keys():
+            inputs = self.tokenizer(
+                [record["input"] + record["output"] for record in records],
+                add_special_tokens=self.add_special_tokens,
+            )
+            targets = self.tokenizer(
+                [record["output"] for record in records],
+                add_special_tokens=self.add_special_tokens,
+            )
+            return [
+                self._make_sample(
+                    input_ids, self._mask_prompt(input_ids, len(targets["input_ids"][i]))
                 )
-                if self.add_special_tokens:
-                    target_length -= self.bos_length
-                labels[: -target_length] = -100
-                labels = labels.cpu().tolist()
-            else:
-                raise ValueError("Dataset must have one or two fields.")
-        if self.max_length > 0:
-            input_ids = input_ids[: self.max_length]
-            attention_mask = attention_mask[: self.max_length]
-            labels = labels[: self.max_length]
-        return {
-            "input_ids": input_ids,
-            "attention_mask": attention_mask,
-            "labels": labels,
-        }
+                for i, input_ids in enumerate(inputs["input_ids"])
+            ]
+        raise ValueError("Dataset must have one or two fields.")
+
+    @property
+    def lengths(self) -> np.ndarray:
+        """每个样本的 token 数目，下标与 ``self[i]`` 一致，详见 :meth:`get_lengths`。"""
+        return self.get_lengths()
+
+    def get_lengths(
+        self, num_proc: Optional[int] = None, batch_size: int = 1000
+    ) -> np.ndarray:
+        """计算每个样本的 token 数目，结果会被保存在内存中。
+
+        * 由 :meth:`from_processed` 加载的数据集直接读取保存时写入的长度索引；
+        * 其余数据集会在 ``num_proc`` 个进程中批量处理所有样本。设置了 ``cache_dir``
+          和 ``tokenizer`` 时，结果会以数据集内容和处理参数的指纹为文件名保存在
+          ``cache_dir`` 中，之后的运行可以直接加载。
+
+        :param num_proc: 计算长度的进程数，为 ``None`` 时根据数据集大小自动选择
+        :param batch_size: 每次批量处理的样本数
+        :return: ``int64`` 类型的 ``numpy`` 数组
+        """
+        if self._lengths is None:
+            lengths = self._raw_lengths(num_proc, batch_size)
+            self._lengths = lengths[np.asarray(self.indices[0 : len(self)], dtype=np.int64)]
+        return self._lengths
+
+    def _sample_length(self, sample: Dict) -> int:
+        return len(sample["input_ids"])
+
+    def _record_lengths(self, records: Sequence[Dict]) -> np.ndarray:
+        return np.fromiter(
+            (self._sample_length(sample) for sample in self._get_samples(records)),
+            dtype=np.int64,
+            count=len(records),
+        )
+
+    def _raw_lengths(self, num_proc: Optional[int], batch_size: int) -> np.ndarray:
+        """按 ``self.dataset`` 中的原始顺序计算每个样本的长度。"""
+        if isinstance(self.dataset, (_ShardContainer, _BinaryShardContainer)):
+            lengths = np.asarray(self.dataset.lengths, dtype=np.int64)
+            if getattr(self.dataset, "indices", None) is not None:
+                lengths = lengths[self.dataset.indices[0 : len(self.dataset)]]
+            if self.max_length > 0:
+                lengths = np.minimum(lengths, self.max_length)
+            return lengths
+        cache_file = None
+        if self.cache_dir is not None and self.tokenizer is not None:
+            fingerprint = _dataset_fingerprint(
+                self._cache_namespace(),
+                (self.dataset[i] for i in range(len(self.dataset))),
+            )
+            cache_file = os.path.join(
+                self.cache_dir, f"{_LENGTHS_FILE_PREFIX}-{fingerprint}.npy"
+            )
+            if os.path.exists(cache_file):
+                return np.load(cache_file)
+        if num_proc is None:
+            num_proc = 1 if len(self.dataset) < 16 * batch_size else min(os.cpu_count(), 8)
+
+        def record_batches():
+            for start in range(0, len(self.dataset), batch_size):
+                yield [
+                    self.dataset[i]
+                    for i in range(start, min(start + batch_size, len(self.dataset)))
+                ]
+
+        if num_proc > 1:
+            processor = copy.copy(self)
+            processor.dataset = None
+            processor.indices = None
+            with ProcessPoolExecutor(
+                max_workers=num_proc,
+                initializer=_init_preprocess_worker,
+                initargs=(processor,),
+            ) as executor:
+                lengths = list(executor.map(_lengths_worker, record_batches()))
+        else:
+            lengths = [self._record_lengths(records) for records in record_batches()]
+        lengths = np.concatenate(lengths + [np.zeros(0, dtype=np.int64)])
+        if cache_file is not None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            # 先写入临时文件再重命名，避免多个进程同时写入时读到不完整的文件
+            tmp_file = f"{cache_file}.{os.getpid()}.tmp.npy"
+            np.save(tmp_file, lengths)
+            os.replace(tmp_file, cache_file)
+        return lengths
 
     def _get_slice(self, s: slice):
         result = []
@@ -234,43 +815,268 @@ class CollieDatasetForTraining(Dataset):
         tokenizer: Optional[PreTrainedTokenizer] = None,
         shuffle: bool = False,
         seed: int = 1024,
+        cache_dir: Optional[str] = None,
+        batch_tokenize: bool = False,
     ):
         dataset = cls(
             dataset=json.loads(FileIODriver.load(path, mode="r")),
             shuffle=shuffle,
             seed=seed,
             tokenizer=tokenizer,
+            cache_dir=cache_dir,
+            batch_tokenize=batch_tokenize,
         )
         return dataset
 
     @classmethod
-    def from_processed(cls, path: str, shuffle: bool = False, seed: int = 1024):
-        dataset = cls(dataset=_ShardContainer(path), shuffle=shuffle, seed=seed)
+    def from_processed(
+        cls, path: str, shuffle: bool = False, seed: int = 1024, protocol: str = "file"
+    ):
+        """加载由 :meth:`save_propressed` 保存的数据集，自动识别 ``json`` 和
+        ``binary`` 两种格式。
+
+        :param protocol: ``binary`` 格式的数据集所使用的 :class:`~collie.driver.io.IODriver`
+            的协议。该格式通过 ``np.memmap`` 读取样本，因此只有 ``'file'`` 可以读取样本
+        """
+        if _is_binary_processed(path, protocol):
+            container = _BinaryShardContainer(path, protocol)
+        elif protocol != "file":
+            raise ValueError("Only the `binary` format supports protocols other than `file`.")
+        else:
+            container = _ShardContainer(path)
+        dataset = cls(dataset=container, shuffle=shuffle, seed=seed)
         return dataset
 
-    def save_propressed(self, path: str, shard_size: int = 4):
-        shard = io.BytesIO()
-        shard_idx = 0
-        meta = np.empty((0, 2), int)
-        for i in self.indices:
-            data = {"tokens": self[i]["input_ids"]}
-            data.update(
-                {key: value for key, value in self[i].items() if key != "input_ids"}
+    @staticmethod
+    def convert_processed(
+        src: str,
+        dst: str,
+        shard_size: int = 4,
+        dtype: Optional[str] = None,
+        protocol: str = "file",
+    ):
+        """将 ``json`` 格式（``.bin`` 和 ``.meta``）的预处理数据集转换为 ``binary``
+        格式。
+
+        :param src: ``json`` 格式数据集所在的文件夹
+        :param dst: 保存 ``binary`` 格式数据集的文件夹
+        :param shard_size: 每个 shard 的大小，单位为 MB
+        :param dtype: token 的数据类型，可选 ``'uint16'`` 和 ``'uint32'``；为
+            ``None`` 时根据最大的 token id 自动选择
+        :param protocol: 保存 ``dst`` 时使用的 :class:`~collie.driver.io.IODriver` 的协议
+        """
+        container = _ShardContainer(src)
+        if dtype is None:
+            max_token_id = 0
+            for i in range(len(container)):
+                tokens = container[i]["tokens"]
+                if len(tokens) > 0:
+                    max_token_id = max(max_token_id, max(tokens))
+            dtype = _token_dtype(max_token_id)
+        writer = _BinaryShardWriter(dst, dtype, shard_size, protocol)
+        for i in range(len(container)):
+            sample = container[i]
+            writer.write(sample["tokens"], sample.get("labels", None))
+        writer.close()
+
+    def save_propressed(
+        self,
+        path: str,
+        shard_size: int = 4,
+        format: str = "json",
+        dtype: Optional[str] = None,
+        num_proc: int = 1,
+        batch_size: int = 1000,
+        log_interval: float = 10.0,
+        compression: Optional[str] = None,
+        frame_size: float = 0.25,
+        protocol: str = "file",
+    ) -> Dict:
+        """保存预处理（tokenize）后的数据集，可通过 :meth:`from_processed` 加载。
+
+        样本按 ``batch_size`` 分组后使用 ``tokenizer`` 的批处理接口进行 tokenize，
+        ``num_proc > 1`` 时在进程池中并行处理。处理结果会被流式写入 shard，同时
+        只有有限个 batch 驻留在内存中。
+
+        :param path: 保存的文件夹
+        :param shard_size: 每个 shard 的大小，单位为 MB
+        :param format: 保存的格式
+
+            * ``'json'`` - 每个样本保存为一行 json。
+            * ``'binary'`` - 将 ``input_ids`` 和 ``labels`` 保存为连续的整数数组，
+              读取时使用 ``np.memmap``，无需解析 json。该格式不保存
+              ``attention_mask``。
+
+        :param dtype: ``binary`` 格式中 token 的数据类型，可选 ``'uint16'`` 和
+            ``'uint32'``；为 ``None`` 时根据 ``tokenizer`` 的词表大小选择
+        :param num_proc: 用于 tokenize 的进程数
+        :param batch_size: 每次批量 tokenize 的样本数
+        :param log_interval: 每隔多少秒输出一次处理速度（samples/s 和 tokens/s）
+        :param compression: ``json`` 格式的压缩方式，可选 ``None`` 和 ``'zstd'``。
+            ``'zstd'`` 会将样本分组压缩为可随机访问的 frame，需要安装 ``zstandard``
+            （``pip install collie-lm[zstd]``）
+        :param frame_size: 压缩时每个 frame 压缩前的大小，单位为 MB。frame 越小随机
+            访问时需要解压的数据越少，但压缩率越低
+        :param protocol: ``binary`` 格式保存时使用的 :class:`~collie.driver.io.IODriver`
+            的协议；``json`` 格式只支持 ``'file'``
+        :return: 处理的样本数、token 数以及吞吐量
+        """
+        assert format in ("json", "binary"), "Format can only be one of `json` or `binary`"
+        if format == "binary" and compression is not None:
+            raise ValueError("Compression is only supported by the `json` format.")
+        if format == "json" and protocol != "file":
+            raise ValueError("Only the `binary` format supports protocols other than `file`.")
+        if format == "binary":
+            if dtype is None:
+                assert (
+                    self.tokenizer is not None
+                ), "`dtype` must be provided when the dataset has no tokenizer."
+                dtype = _token_dtype(len(self.tokenizer))
+            writer = _BinaryShardWriter(path, dtype, shard_size, protocol)
+        else:
+            writer = _JsonShardWriter(path, shard_size, compression, frame_size)
+
+        # 子进程中只需要 tokenize 相关的属性
+        processor = copy.copy(self)
+        processor.dataset = None
+        processor.indices = None
+
+        def record_batches():
+            for start in range(0, len(self), batch_size):
+                yield [
+                    self.dataset[index]
+                    for index in self.indices[start : start + batch_size]
+                ]
+
+        num_samples, num_tokens = 0, 0
+        start_time = last_log_time = time.time()
+
+        def log_throughput():
+            elapsed = max(time.time() - start_time, 1e-6)
+            logger.info(
+                f"Processed {num_samples}/{len(self)} samples, "
+                f"{num_samples / elapsed:.2f} samples/s, {num_tokens / elapsed:.2f} tokens/s."
+            )
+
+        def write(samples):
+            nonlocal num_samples, num_tokens, last_log_time
+            for sample in samples:
+                writer.write(
+                    sample["input_ids"], sample["labels"], sample.get("attention_mask", None)
+                )
+                num_tokens += len(sample["input_ids"])
+            num_samples += len(samples)
+            if time.time() - last_log_time > log_interval:
+                log_throughput()
+                last_log_time = time.time()
+
+        if num_proc > 1:
+            with ProcessPoolExecutor(
+                max_workers=num_proc,
+                initializer=_init_preprocess_worker,
+                initargs=(processor,),
+            ) as executor:
+                pending = deque()
+                for records in record_batches():
+                    pending.append(executor.submit(_preprocess_worker, records))
+                    if len(pending) >= 2 * num_proc:
+                        write(pending.popleft().result())
+                while len(pending) > 0:
+                    write(pending.popleft().result())
+        else:
+            for records in record_batches():
+                write(processor._get_samples(records))
+        writer.close()
+        log_throughput()
+        elapsed = max(time.time() - start_time, 1e-6)
+        return {
+            "samples": num_samples,
+            "tokens": num_tokens,
+            "samples_per_second": num_samples / elapsed,
+            "tokens_per_second": num_tokens / elapsed,
+        }
+
+
+class ColliePackedDataset(Dataset):
+    """将多个样本拼接（packing）为长度不超过 ``max_length`` 的一条序列，减少
+    padding 带来的计算浪费。样本按原顺序依次放入序列，放不下时开始新的序列；长度
+    超过 ``max_length`` 的样本会被截断。
+
+    返回的每条序列包含 ``input_ids``、``labels`` 以及 ``position_ids`` （原样本
+    提供 ``attention_mask`` 时也包含拼接后的 ``attention_mask``），均为 ``int32``
+    数组，其中 ``position_ids`` 在每个样本的开头重新从 0 开始，
+    **CoLLiE** 中的 LLaMA 和 InternLM 模型会据此保证不同样本之间互不可见。每个样本
+    第一个 token 的 ``labels`` 会被置为 ``-100``，避免用上一个样本预测下一个样本。
+
+    :param dataset: 被拼接的数据集，每个样本须包含 ``input_ids`` 和 ``labels``，
+        例如 :class:`CollieDatasetForTraining`
+    :param max_length: 拼接后序列的最大长度
+    :param lengths: 每个样本的长度。为 ``None`` 时使用 ``dataset.lengths``，不存在时
+        会遍历一次 ``dataset`` 来计算
+    """
+
+    def __init__(
+        self,
+        dataset: Sequence[Dict],
+        max_length: int,
+        lengths: Optional[Sequence[int]] = None,
+    ):
+        assert max_length > 0, "`max_length` must be positive."
+        self.dataset = dataset
+        self.max_length = max_length
+        if lengths is None:
+            lengths = getattr(dataset, "lengths", None)
+        if lengths is None:
+            lengths = [len(dataset[i]["input_ids"]) for i in range(len(dataset))]
+        lengths = np.minimum(np.asarray(lengths, dtype=np.int64), max_length)
+        # 第 i 条序列由 [offsets[i], offsets[i + 1]) 范围内的样本拼接而成
+        offsets = [0]
+        total = 0
+        for i, length in enumerate(lengths):
+            if total + length > max_length and i > offsets[-1]:
+                offsets.append(i)
+                total = 0
+            total += length
+        offsets.append(len(lengths))
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.lengths = np.add.reduceat(lengths, self.offsets[:-1]) if len(lengths) > 0 \
+            else np.zeros(0, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index) -> Dict:
+        if index >= len(self):
+            raise IndexError("Index out of range.")
+        samples = [
+            self.dataset[i] for i in range(self.offsets[index], self.offsets[index + 1])
+        ]
+        input_ids, labels, position_ids = [], [], []
+        for sample in samples:
+            sample_input_ids = _as_tokens(sample["input_ids"])[: self.max_length]
+            sample_labels = np.array(sample["labels"], dtype=np.int32)[: self.max_length]
+            if len(sample_labels) > 0:
+                # tokenize 或截断后可能为空
+                sample_labels[0] = -100
+            input_ids.append(sample_input_ids)
+            labels.append(sample_labels)
+            position_ids.append(np.arange(len(sample_input_ids), dtype=np.int32))
+        packed = {
+            "input_ids": np.concatenate(input_ids),
+            "labels": np.concatenate(labels),
+            "position_ids": np.concatenate(position_ids),
+        }
+        # 所有样本都没有 attention_mask 时由 ColliePadder 生成
+        if any("attention_mask" in sample.keys() for sample in samples):
+            packed["attention_mask"] = np.concatenate(
+                [
+                    _as_tokens(sample["attention_mask"])[: self.max_length]
+                    if "attention_mask" in sample.keys()
+                    else np.ones(len(ids), dtype=np.int32)
+                    for sample, ids in zip(samples, input_ids)
+                ]
             )
-            bytes_data = json.dumps(data).encode() + "\n".encode()
-            offset = shard.tell()
-            length = len(data["tokens"])
-            shard.write(bytes_data)
-            meta = np.append(meta, np.array([[offset, length]]), axis=0)
-            if shard.tell() > shard_size * 1024 * 1024 or i == len(self) - 1:
-                file = f"collie-dataset-shard-{shard_idx}.bin"
-                shard.seek(0)
-                FileIODriver.save(meta, os.path.join(path, file + ".meta"))
-                FileIODriver.save(shard.read().decode(), os.path.join(path, file))
-                shard.close()
-                shard = io.BytesIO()
-                meta = np.empty((0, 2), int)
-                shard_idx += 1
+        return packed
 
 
 class CollieDatasetForPerplexity(CollieDatasetForTraining):
@@ -292,47 +1098,57 @@ class CollieDatasetForGeneration(CollieDatasetForTraining):
             ]
     """
 
-    def __getitem__(self, index) -> Dict:
-        if index > len(self):
-            raise IndexError("Index out of range.")
+    def _process(self, record: Dict) -> Dict:
         target = None
-        index = self.indices[index]
         if self.tokenizer is None:
-            input_ids = self.dataset[index]["tokens"]
-            if "attention_mask" in self.dataset[index].keys():
-                attention_mask = self.dataset[index]["attention_mask"]
-            else:
-                attention_mask = torch.ones_like(torch.tensor(input_ids).cpu().tolist())
-            target = self.dataset[index].get("target", None)
+            sample = self._make_sample(
+                record["tokens"], attention_mask=record.get("attention_mask", None)
+            )
+            target = record.get("target", None)
         else:
             inputs = self.tokenizer(
-                self.dataset[index]["text"], add_special_tokens=self.add_special_tokens
-            )
-            input_ids = inputs["input_ids"]
-            attention_mask = inputs.get(
-                "attention_mask",
-                torch.ones_like(torch.tensor(input_ids)).cpu().tolist(),
+                record["text"], add_special_tokens=self.add_special_tokens
             )
-            if "target" in self.dataset[index].keys():
-                if isinstance(self.dataset[index]["target"], str):
-                    target = [self.tokenizer(self.dataset[index]["target"]).input_ids]
-                elif isinstance(self.dataset[index]["target"], (list, tuple, set)):
+            sample = self._make_sample(inputs["input_ids"])
+            if "target" in record.keys():
+                if isinstance(record["target"], str):
+                    target = [self.tokenizer(record["target"]).input_ids]
+                elif isinstance(record["target"], (list, tuple, set)):
                     target = [
                         self.tokenizer(x).input_ids
-                        for x in self.dataset[index]["target"]
+                        for x in record["target"]
                     ]
-        if self.max_length > 0:
-            input_ids = input_ids[: self.max_length]
-            attention_mask = attention_mask[: self.max_length]
-        sample = {
-            "input_ids": input_ids,
-            "attention_mask": attention_mask,
-            "labels": input_ids,
-        }
         if target is not None:
             sample["target"] = target
         return sample
 
+    def _tokenize_batch(self, records: Sequence[Dict]) -> List[Dict]:
+        if self.tokenizer is None:
+            return [self._process(record) for record in records]
+        inputs = self.tokenizer(
+            [record["text"] for record in records],
+            add_special_tokens=self.add_special_tokens,
+        )
+        # 所有样本的 target 合并为一次 tokenizer 调用
+        target_texts, target_spans = [], []
+        for record in records:
+            target = record.get("target", None)
+            if isinstance(target, str):
+                target = [target]
+            elif not isinstance(target, (list, tuple, set)):
+                target_spans.append(None)
+                continue
+            target_spans.append((len(target_texts), len(target_texts) + len(target)))
+            target_texts.extend(target)
+        target_ids = self.tokenizer(target_texts).input_ids if target_texts else []
+        samples = []
+        for i, input_ids in enumerate(inputs["input_ids"]):
+            sample = self._make_sample(input_ids)
+            if target_spans[i] is not None:
+                sample["target"] = target_ids[target_spans[i][0] : target_spans[i][1]]
+            samples.append(sample)
+        return samples
+
 
 class CollieDatasetForClassification(CollieDatasetForTraining):
     """**CoLLie** 中的分类任务数据集
@@ -348,6 +1164,28 @@ class CollieDatasetForClassification(CollieDatasetForTraining):
                 },
                 ...
             ]
+
+    当 ``style`` 为 ``harness`` 且 ``shared_prefix`` 为 ``True`` 时，各个选项共同的前缀
+    只保存一次，每个选项只保存其后缀，样本格式为：
+
+        .. code-block::
+
+            {
+                "input_ids": array([1, 100, 100]),  # 所有选项共享的前缀
+                "option_ids": (array([200, 201]), array([300])),  # 每个选项的后缀
+                "option_labels": (array([200, 201]), array([300])),
+                "target": 0
+            }
+
+    ``attention_mask`` 和 ``option_attention_mask`` 由 :class:`~collie.utils.ColliePadder`
+    在组 batch 时生成。
+
+    前缀取各选项完整 token 序列的最长公共前缀，且不包含任何需要计算 loss 的 token，
+    因此 :class:`~collie.controller.evaluator.EvaluatorForClassfication` 只需对前缀
+    进行一次前向传播，再基于其 ``past_key_values`` 对每个选项的后缀打分，结果与逐个
+    选项完整前向传播相同。
+
+    :param shared_prefix: 是否只保存一次各选项共享的前缀
     """
 
     def __init__(
@@ -359,6 +1197,9 @@ class CollieDatasetForClassification(CollieDatasetForTraining):
         seed: int = 1024,
         max_length: int = -1,
         style: str = "harness",
+        cache_dir: Optional[str] = None,
+        batch_tokenize: bool = False,
+        shared_prefix: bool = False,
     ):
         super().__init__(
             dataset=dataset,
@@ -367,105 +1208,315 @@ class CollieDatasetForClassification(CollieDatasetForTraining):
             shuffle=shuffle,
             seed=seed,
             max_length=max_length,
+            cache_dir=cache_dir,
+            batch_tokenize=batch_tokenize,
         )
         assert style.lower() in (
             "harness",
             "helm",
         ), "Style can only be one of `harness` or `helm`"
         self.style = style.lower()
+        self.shared_prefix = shared_prefix
 
-    def __getitem__(self, index) -> Dict:
-        if index > len(self):
-            raise IndexError("Index out of range.")
-        index = self.indices[index]
+    def _sample_length(self, sample: Dict) -> int:
+        # 以最长的选项作为样本的长度
+        if "option_ids" in sample.keys():
+            return len(sample["input_ids"]) + max(len(ids) for ids in sample["option_ids"])
+        if isinstance(sample["input_ids"], tuple):
+            return max(len(ids) for ids in sample["input_ids"])
+        return len(sample["input_ids"])
+
+    @staticmethod
+    def _to_shared_prefix(sample: Dict) -> Dict:
+        """将各选项的完整序列拆分为共享的前缀和各自的后缀。"""
+        input_ids, labels = sample["input_ids"], sample["labels"]
+        # 前缀中不能包含需要计算 loss 的 token，且每个后缀至少保留一个 token
+        prefix_length = min(len(ids) for ids in input_ids) - 1
+        for label in labels:
+            scored = np.flatnonzero(label != -100)
+            if len(scored) > 0:
+                prefix_length = min(prefix_length, int(scored[0]))
+        first = input_ids[0]
+        for ids in input_ids[1:]:
+            different = np.flatnonzero(ids[:prefix_length] != first[:prefix_length])
+            if len(different) > 0:
+                prefix_length = int(different[0])
+        # 第一个 token 不会被预测，总是可以放入前缀
+        prefix_length = max(prefix_length, 1)
+        return {
+            "input_ids": first[:prefix_length],
+            "option_ids": tuple(ids[prefix_length:] for ids in input_ids),
+            "option_labels": tuple(label[prefix_length:] for label in labels),
+            "target": sample["target"],
+        }
+
+    def _harness_sample(self, options: Sequence[Dict], target) -> Dict:
+        """由每个选项的 ``input_ids`` 和 ``labels`` 构造一条 ``harness`` 风格的样本。"""
+        sample = {
+            "input_ids": tuple(option["input_ids"] for option in options),
+            "labels": tuple(option["labels"] for option in options),
+            "target": target,
+        }
+        if self.shared_prefix:
+            return self._to_shared_prefix(sample)
+        return sample
+
+    @staticmethod
+    def _check_record(record: Dict):
+        if not (
+            "input" in record.keys()
+            and "output" in record.keys()
+            and "target" in record.keys()
+        ):
+            raise ValueError(
+                "CollieDatasetForClassification must have three fields (`input`, `output` and `target`)."
+            )
+
+    def _process(self, record: Dict) -> Dict:
         if self.tokenizer is None:
-            input_ids = tuple(self.dataset[index]["tokens"])
-            target = self.dataset[index]["target"]
+            input_ids = tuple(_as_tokens(tokens) for tokens in record["tokens"])
+            labels = record.get("labels", None)
+            labels = input_ids if labels is None else tuple(_as_tokens(x) for x in labels)
+            return {"input_ids": input_ids, "labels": labels, "target": record["target"]}
+        self._check_record(record)
+        if self.style == "harness":
+            options = []
+            for output in record["output"]:
+                input_ids = self.tokenizer(
+                    record["input"] + output,
+                    add_special_tokens=self.add_special_tokens,
+                )["input_ids"]
+                target_length = len(
+                    self.tokenizer(
+                        output, add_special_tokens=self.add_special_tokens
+                    ).input_ids
+                )
+                options.append(
+                    self._make_sample(input_ids, self._mask_prompt(input_ids, target_length))
+                )
+            return self._harness_sample(options, record["target"])
+        elif self.style == "helm":
+            input_ids = self.tokenizer(
+                record["input"], add_special_tokens=self.add_special_tokens
+            )["input_ids"]
+            sample = self._make_sample(input_ids)
+            sample["target"] = record["target"]
+            sample["output"] = tuple(record["output"])
+            return sample
         else:
-            if self.style == "harness":
-                if (
-                    "input" in self.dataset[0].keys()
-                    and "output" in self.dataset[0].keys()
-                    and "target" in self.dataset[0].keys()
-                ):
-                    input_ids = []
-                    attention_mask = []
-                    labels = []
-                    for output in self.dataset[index]["output"]:
-                        inputs = self.tokenizer(
-                            self.dataset[index]["input"] + output,
-                            add_special_tokens=self.add_special_tokens,
-                        )
-                        input_ids.append(inputs.get("input_ids"))
-                        attention_mask.append(
-                            inputs.get(
-                                "attention_mask",
-                                torch.ones_like(torch.tensor(inputs.get("input_ids"))),
-                            )
-                        )
-                        label = torch.tensor(inputs.get("input_ids"))
-                        target_length = len(
-                            self.tokenizer(
-                                output,
-                                add_special_tokens=self.add_special_tokens,
-                            ).input_ids
-                        )
-                        if self.add_special_tokens:
-                            target_length -= self.bos_length
-                        label[: -target_length] = -100
-                        label = label.cpu().tolist()
-                        labels.append(label)
-
-                    input_ids = tuple(input_ids)
-                    labels = tuple(labels)
-                    attention_mask = tuple(attention_mask)
-                    target = self.dataset[index]["target"]
-                else:
-                    raise ValueError(
-                        "CollieDatasetForClassification must have three fields (`input`, `output` and `target`)."
-                    )
-                if self.max_length > 1:
-                    input_ids = [sample[: self.max_length] for sample in input_ids]
-                    labels = [sample[: self.max_length] for sample in labels]
-                    attention_mask = [
-                        sample[: self.max_length] for sample in attention_mask
-                    ]
-                return {
-                    "input_ids": input_ids,
-                    "attention_mask": attention_mask,
-                    "labels": labels,
-                    "target": target,
-                }
-            elif self.style == "helm":
-                if (
-                    "input" in self.dataset[0].keys()
-                    and "output" in self.dataset[0].keys()
-                    and "target" in self.dataset[0].keys()
-                ):
-                    inputs = self.tokenizer(
-                        self.dataset[index]["input"],
-                        add_special_tokens=self.add_special_tokens,
-                    )
-                    input_ids = inputs["input_ids"]
-                    attention_mask = inputs.get(
-                        "attention_mask",
-                        torch.ones_like(torch.tensor(input_ids)).cpu().tolist(),
-                    )
-                    output = tuple([option for option in self.dataset[index]["output"]])
-                    target = self.dataset[index]["target"]
-                else:
-                    raise ValueError(
-                        "CollieDatasetForClassification must have three fields (`input`, `output` and `target`)."
-                    )
-                if self.max_length > 0:
-                    input_ids = input_ids[: self.max_length]
-                    attention_mask = attention_mask[: self.max_length]
-                return {
-                    "input_ids": input_ids,
-                    "attention_mask": attention_mask,
-                    "labels": input_ids,
-                    "target": target,
-                    "output": output,
-                }
+            raise ValueError("Style can only be one of `harness` or `helm`")
+
+    def _tokenize_batch(self, records: Sequence[Dict]) -> List[Dict]:
+        if self.tokenizer is None:
+            return [self._process(record) for record in records]
+        self._check_record(records[0])
+        if self.style == "harness":
+            # 所有样本的所有选项合并为一次 tokenizer 调用
+            inputs = self.tokenizer(
+                [record["input"] + output for record in records for output in record["output"]],
+                add_special_tokens=self.add_special_tokens,
+            )
+            targets = self.tokenizer(
+                [output for record in records for output in record["output"]],
+                add_special_tokens=self.add_special_tokens,
+            )
+            options = [
+                self._make_sample(
+                    input_ids, self._mask_prompt(input_ids, len(targets["input_ids"][i]))
+                )
+                for i, input_ids in enumerate(inputs["input_ids"])
+            ]
+            samples = []
+            offset = 0
+            for record in records:
+                span = slice(offset, offset + len(record["output"]))
+                offset = span.stop
+                samples.append(self._harness_sample(options[span], record["target"]))
+            return samples
+        elif self.style == "helm":
+            inputs = self.tokenizer(
+                [record["input"] for record in records],
+                add_special_tokens=self.add_special_tokens,
+            )
+            samples = []
+            for record, input_ids in zip(records, inputs["input_ids"]):
+                sample = self._make_sample(input_ids)
+                sample["target"] = record["target"]
+                sample["output"] = tuple(record["output"])
+                samples.append(sample)
+            return samples
+        else:
+            raise ValueError("Style can only be one of `harness` or `helm`")
+
+
+class CollieStreamingDataset(IterableDataset):
+    """**CoLLie** 中的流式数据集，按分片依次读取 ``jsonl`` 格式的数据，适用于无法
+    一次性载入内存的大规模预训练数据。每一行为一条样本，格式与
+    :class:`CollieDatasetForTraining` 相同。
+
+    分片会被均匀地分配到各个数据并行的 rank 以及 DataLoader 的各个 worker 上，
+    每个分片通过 :class:`~collie.driver.io.IODriver` 按行增量地读取，因此支持
+    ``petrel`` 等存储后端，且内存占用与分片大小无关。样本按 ``shuffle_buffer_size``
+    行一块读入，在块内打乱。
+
+    读取进度可以通过 :meth:`state_dict` 和 :meth:`load_state_dict` 保存与恢复。
+    进度记录为当前块在分片中的字节偏移，恢复时直接从该位置开始读取，最多重新读取
+    一块原始文本，已经训练过的样本不会被重复解析和 tokenize。
+    配合 :class:`~collie.data.CollieDataLoader` 使用时，读取进度会随
+    :meth:`~collie.controller.trainer.Trainer.state_dict` 一起保存。
+
+    .. note::
+
+        数据量无法预先得知，因此各个 rank 上的样本数可能不同。请尽量使分片数目为
+        ``dp_size * num_workers`` 的整数倍且各分片的大小相近。
+
+    :param path: 数据所在的文件夹、单个分片文件或分片文件的列表
+    :param tokenizer: 用于处理样本的 tokenizer，为 ``None`` 时样本须包含 ``tokens`` 字段
+    :param add_special_tokens: 是否添加特殊 token
+    :param max_length: 样本的最大长度
+    :param shuffle: 是否打乱分片顺序和样本顺序
+    :param seed: 随机种子
+    :param shuffle_buffer_size: 打乱样本时每一块的行数
+    :param suffix: ``path`` 为文件夹时，分片文件的后缀名
+    :param protocol: 读取数据使用的 :class:`~collie.driver.io.IODriver` 的协议
+    :param num_samples: 数据集的样本总数，用于估计每个 epoch 的步数。为 ``None``
+        时数据集没有长度
+    :param dataset_cls: 处理单条样本时使用的数据集类型
+    :param cache_dir: tokenize 缓存的路径，详见 :class:`CollieDatasetForTraining`
+    :param num_replicas: 数据并行的进程数，为 ``None`` 时使用 ``env.dp_size``
+    :param rank: 数据并行的 rank，为 ``None`` 时使用 ``env.dp_rank``
+    """
+
+    def __init__(
+        self,
+        path: Union[str, Sequence[str]],
+        tokenizer: Optional[PreTrainedTokenizer] = None,
+        add_special_tokens: bool = True,
+        max_length: int = -1,
+        shuffle: bool = False,
+        seed: int = 1024,
+        shuffle_buffer_size: int = 10000,
+        suffix: str = ".jsonl",
+        protocol: str = "file",
+        num_samples: Optional[int] = None,
+        dataset_cls: type = CollieDatasetForTraining,
+        cache_dir: Optional[str] = None,
+        num_replicas: Optional[int] = None,
+        rank: Optional[int] = None,
+    ):
+        self.io_driver = IODriver.from_protocol(protocol)
+        if isinstance(path, str):
+            if path.endswith(suffix):
+                shards = [path]
             else:
-                raise ValueError("Style can only be one of `harness` or `helm`")
+                shards = self.io_driver.walk(path, suffix)
+                if protocol != "file":
+                    # petrel 返回的是相对于 path 的路径
+                    shards = [os.path.join(path, shard) for shard in shards]
+        else:
+            shards = list(path)
+        assert len(shards) > 0, f"No shard with suffix `{suffix}` found in {path}."
+        self.shards = sorted(shards)
+        self.processor = dataset_cls(
+            dataset=[],
+            tokenizer=tokenizer,
+            add_special_tokens=add_special_tokens,
+            max_length=max_length,
+            cache_dir=cache_dir,
+        )
+        self.shuffle = shuffle
+        self.seed = seed
+        self.shuffle_buffer_size = shuffle_buffer_size if shuffle else 0
+        self.num_samples = num_samples
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.epoch = 0
+        # 每个 worker 的读取进度 [分片的序号, 当前块的字节偏移, 块内已经读取的样本数]，
+        # 只在 worker 所在的进程中更新
+        self.consumed = None
+        self._resume_state = None
+
+    def __len__(self):
+        if self.num_samples is None:
+            raise TypeError(f"{self.__class__.__name__} has no length.")
+        return self.num_samples
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+
+    def state_dict(self) -> Dict:
+        """返回当前进程中的读取进度。"""
+        return {"epoch": self.epoch, "consumed": self.consumed}
+
+    def load_state_dict(self, state_dict: Dict):
+        """设置下一次迭代的起始位置，``state_dict`` 形如 ``{"epoch": 0,
+        "consumed": [[shard, offset, num_samples], ...]}``，其中 ``consumed`` 为每个
+        worker 的读取进度：当前块从该 worker 的第 ``shard`` 个分片的第 ``offset``
+        个字节开始，块内已经读取了 ``num_samples`` 个样本。尚未读取时为 ``None``。
+        """
+        self.epoch = state_dict["epoch"]
+        self._resume_state = state_dict
+
+    def _consumer(self) -> Tuple[int, int, int]:
+        num_replicas = env.dp_size if self.num_replicas is None else self.num_replicas
+        rank = env.dp_rank if self.rank is None else self.rank
+        worker_info = get_worker_info()
+        if worker_info is None:
+            worker_id, num_workers = 0, 1
+        else:
+            worker_id, num_workers = worker_info.id, worker_info.num_workers
+        return worker_id, rank * num_workers + worker_id, num_replicas * num_workers
+
+    def _shards(self, consumer: int, num_consumers: int) -> List[str]:
+        shards = list(self.shards)
+        if self.shuffle:
+            random.Random(f"{self.seed}-{self.epoch}").shuffle(shards)
+        if len(shards) < num_consumers:
+            logger.warning(
+                f"The number of shards ({len(shards)}) is less than the number of "
+                f"data parallel workers ({num_consumers}), some workers will be idle."
+            )
+        return shards[consumer::num_consumers]
+
+    def _lines(self, shards: Sequence[str], shard: int, offset: int):
+        """从第 ``shard`` 个分片的第 ``offset`` 个字节开始按行读取，同时返回读完该行后的位置。"""
+        for idx in range(shard, len(shards)):
+            stream = self.io_driver.open_stream(shards[idx], offset)
+            try:
+                for line in stream:
+                    offset += len(line)
+                    if line.strip():
+                        yield line, idx, offset
+            finally:
+                stream.close()
+            offset = 0
+
+    def __iter__(self):
+        worker_id, consumer, num_consumers = self._consumer()
+        position = None
+        if self._resume_state is not None and self._resume_state["epoch"] == self.epoch:
+            position = self._resume_state["consumed"][worker_id]
+        self._resume_state = None
+        return self._iter(consumer, num_consumers, position or (0, 0, 0))
+
+    def _iter(self, consumer: int, num_consumers: int, position: Sequence[int]):
+        self.consumed = None
+        shard, offset, skip = position
+        lines = self._lines(self._shards(consumer, num_consumers), shard, offset)
+        block_size = max(self.shuffle_buffer_size, 1)
+        while True:
+            block = list(islice(lines, block_size))
+            if len(block) == 0:
+                return
+            # 下一块的起始位置
+            _, next_shard, next_offset = block[-1]
+            if self.shuffle_buffer_size > 1:
+                # 由块的起始位置决定打乱的顺序，恢复时可以重现同一块
+                random.Random(f"{self.seed}-{self.epoch}-{consumer}-{shard}-{offset}").shuffle(block)
+            for i in range(skip, len(block)):
+                if i + 1 < len(block):
+                    self.consumed = [shard, offset, i + 1]
+                else:
+                    self.consumed = [next_shard, next_offset, 0]
+                yield self.processor._get_sample(json.loads(block[i][0]))
+            shard, offset, skip = next_shard, next_offset, 0
@@ -0,0 +1,76 @@
+"""CoLLie 中不需要存储的随机下标排列
+"""
+from typing import Union
+
+import numpy as np
+
+__all__ = []
+
+
+def _mix(x: np.ndarray, key: np.uint64) -> np.ndarray:
+    # splitmix64 的混合函数，uint64 的乘法溢出即为取模
+    x = (x ^ key) * np.uint64(0xBF58476D1CE4E5B9)
+    x ^= x >> np.uint64(31)
+    x *= np.uint64(0x94D049BB133111EB)
+    x ^= x >> np.uint64(29)
+    return x
+
+
+class _IndexPermutation:
+    """``[0, n)`` 上由 ``seed`` 和 ``epoch`` 决定的随机排列，不需要保存整个排列。
+
+    排列由一个 Feistel 网络构造：在不小于 ``n`` 的 ``4 ** k`` 大小的定义域上，Feistel
+    网络总是一个双射；对于落在 ``[n, 4 ** k)`` 中的结果再次应用网络（cycle walking），
+    直至其落入 ``[0, n)``。任意位置的值都可以在 O(1) 的时间和内存内算出，且支持
+    ``numpy`` 数组的批量计算。
+
+    :param n: 排列的长度
+    :param seed: 随机数种子
+    :param epoch: 当前的 epoch，不同 epoch 对应不同的排列
+    :param rounds: Feistel 网络的轮数
+    """
+
+    def __init__(self, n: int, seed: int = 0, epoch: int = 0, rounds: int = 4) -> None:
+        self.n = n
+        self.seed = seed
+        self.epoch = epoch
+        self.half_bits = max(1, (max(n - 1, 1).bit_length() + 1) // 2)
+        self.mask = np.uint64((1 << self.half_bits) - 1)
+        self.keys = np.random.default_rng((seed, epoch)).integers(
+            0, 2**63, size=rounds, dtype=np.uint64
+        )
+
+    def _feistel(self, x: np.ndarray) -> np.ndarray:
+        shift = np.uint64(self.half_bits)
+        left, right = x >> shift, x & self.mask
+        for key in self.keys:
+            left, right = right, left ^ (_mix(right, key) & self.mask)
+        return (left << shift) | right
+
+    def permute(self, positions: np.ndarray) -> np.ndarray:
+        """批量计算 ``positions`` 处的值。"""
+        x = np.asarray(positions, dtype=np.uint64)
+        x = self._feistel(x)
+        outside = x >= np.uint64(self.n)
+        while outside.any():
+            x[outside] = self._feistel(x[outside])
+            outside = x >= np.uint64(self.n)
+        return x.astype(np.int64)
+
+    def __len__(self) -> int:
+        return self.n
+
+    def __getitem__(self, index: Union[int, slice, np.ndarray]):
+        if isinstance(index, slice):
+            return self.permute(np.arange(*index.indices(self.n)))
+        if isinstance(index, np.ndarray):
+            return self.permute(np.where(index < 0, index + self.n, index))
+        if index < 0:
+            index += self.n
+        if not 0 <= index < self.n:
+            raise IndexError("Index out of range.")
+        return int(self.permute(np.asarray([index]))[0])
+
+    def __iter__(self):
+        for start in range(0, self.n, 65536):
+            yield from self[start : start + 65536].tolist()
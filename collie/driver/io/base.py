@@ -3,6 +3,23 @@ from typing import Optional
 import io
 
 class IODriver(ABC):
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        # driver 只通过静态方法使用，不会被实例化，因此在定义子类时检查接口是否完整
+        if ABC in cls.__bases__:
+            return
+        names = set()
+        for base in cls.__mro__[1:]:
+            names.update(getattr(base, "__abstractmethods__", ()))
+        missing = sorted(
+            name for name in names
+            if getattr(getattr(cls, name, None), "__isabstractmethod__", False)
+        )
+        if len(missing) > 0:
+            raise TypeError(
+                f"IODriver `{cls.__name__}` does not implement: {', '.join(missing)}."
+            )
+
     @staticmethod
     @abstractmethod
     def load(path: str, mode: str):
@@ -13,6 +30,15 @@ class IODriver(ABC):
     def load_buffer(path: str):
         raise NotImplementedError
 
+    @staticmethod
+    @abstractmethod
+    def open_stream(path: str, offset: int = 0):
+        """以二进制只读的方式打开 ``path``，从第 ``offset`` 个字节开始增量地读取。
+
+        :return: 二进制的文件对象，支持 ``readline``、``read`` 以及按行迭代
+        """
+        raise NotImplementedError
+
     @staticmethod
     @abstractmethod
     def save(obj, path: str, append: bool = False):
@@ -21,6 +47,7 @@ class IODriver(ABC):
     @staticmethod
     @abstractmethod
     def save_buffer(obj: io.BytesIO, path: str):
+        """将二进制文件对象 ``obj`` 从头开始的全部内容保存到 ``path``。"""
         raise NotImplementedError
 
     @staticmethod
@@ -24,6 +24,13 @@ class FileIODriver(IODriver):
             buffer.seek(0)
             return buffer
 
+    @staticmethod
+    def open_stream(path: str, offset: int = 0):
+        assert os.path.exists(path), f"File {path} does not exist."
+        f = open(path, 'rb')
+        f.seek(offset)
+        return f
+
     @staticmethod
     def save(obj, path: str, append: bool = False):
         folder = os.path.dirname(path)
@@ -38,6 +45,14 @@ class FileIODriver(IODriver):
         else:
             torch.save(obj, path)
 
+    @staticmethod
+    def save_buffer(obj: io.BytesIO, path: str):
+        folder = os.path.dirname(path)
+        os.makedirs(folder, exist_ok=True)
+        obj.seek(0)
+        with open(path, 'wb') as f:
+            shutil.copyfileobj(obj, f)
+
     @staticmethod
     def exists(path: str) -> bool:
         return os.path.exists(path)
@@ -1,5 +1,6 @@
 from collie.driver.io.base import IODriver
 
+import io
 import os
 import torch
 from io import BytesIO
@@ -25,6 +26,23 @@ def no_proxy():
     for key, value in backup.items():
         os.environ[key] = value
 
+class _PetrelStream(io.RawIOBase):
+    """将 petrel 返回的流包装为文件对象，以便按行读取。"""
+    def __init__(self, body):
+        self.body = body
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        data = self.body.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        self.body.close()
+        super().close()
+
 class PetrelIODriver(IODriver):
     @staticmethod
     def load(path: str, mode: str):
@@ -53,6 +71,21 @@ class PetrelIODriver(IODriver):
             buffer.seek(0)
             return buffer
 
+    @staticmethod
+    def open_stream(path: str, offset: int = 0):
+        with no_proxy():
+            from petrel_client.client import Client
+            client = Client()
+            body = client.get(path, enable_stream=True)
+        stream = io.BufferedReader(_PetrelStream(body))
+        # petrel 的流不支持 seek，分块丢弃 offset 之前的内容
+        while offset > 0:
+            chunk = stream.read(min(offset, 1 << 20))
+            if not chunk:
+                break
+            offset -= len(chunk)
+        return stream
+
     @staticmethod
     def save(obj, path: str, append: bool = False):
         with no_proxy():
@@ -70,6 +103,14 @@ class PetrelIODriver(IODriver):
             client.put(path, buffer)
             buffer.close()
 
+    @staticmethod
+    def save_buffer(obj: BytesIO, path: str):
+        with no_proxy():
+            from petrel_client.client import Client
+            client = Client()
+            obj.seek(0)
+            client.put(path, obj)
+
     @staticmethod
     def exists(path: str) -> bool:
         with no_proxy():
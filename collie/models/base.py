@@ -20,7 +20,8 @@ from accelerate.utils.modeling import set_module_tensor_to_device
 from transformers.generation.utils import GenerationMixin
 from transformers.generation.utils import GenerationConfig
 from transformers.utils import ContextManagers
-from collie.module import PipelineModel, GPTLMLoss
+from collie.module import PipelineModel, GPTLMLoss, ColumnParallelLMHead, LinearWithHiddenStates
+from collie.models.utils import ActivationCheckpointing, StaticKVCache, build_static_kv_cache
 from collie.config import CollieConfig, load_config
 from collie.log import logger
 from collie.utils import setup_distribution, is_zero3_enabled, env, \
@@ -43,10 +44,20 @@ class CollieModelForCausalLM(nn.Module, GenerationMixin):
     4. 将 lm_head 的输入 hidden_states 保存在 ``hidden_states`` 属性中。也可以使
        用 :class:`~collie.module.ColumnParallelLMHead` 来自动地保存。
 
+    如果模型的 layer 包含 ``kv_cache`` 属性，并在该属性不为 ``None`` 时将 key 和 value
+    写入其中（参考 :class:`~collie.models.utils.StaticKVCache`），可以将
+    ``_supports_static_kv_cache`` 设置为 ``True`` 以在生成时使用预先分配的 cache。
+
+    如果模型的 layer 在前向时通过 ``activation_checkpointing`` 属性（
+    :class:`~collie.models.utils.ActivationCheckpointing`）执行 ``_forward``，则可以
+    使用 ``checkpointing_policy`` 等梯度检查点的设置；layer 同时实现
+    ``_attention_forward`` 与 ``_mlp_forward`` 时还可以只对其中一个子模块使用检查点。
+
     """
     main_input_name = "input_ids"
     base_model_prefix = ""
     _can_generate = False
+    _supports_static_kv_cache = False
 
     def __init__(self, config: CollieConfig) -> None:
         super().__init__()
@@ -57,6 +68,17 @@ class CollieModelForCausalLM(nn.Module, GenerationMixin):
         # transformers 的 GenerateMixin 要求 config 必须为 PretrainedConfig，备份一下 collie 的配置
         self.collie_config = config
 
+    @staticmethod
+    def _share_activation_checkpointing(model: nn.Module, config: CollieConfig):
+        """
+        令 ``model`` 中的所有层共享同一个梯度检查点策略，``'auto'`` 策略需要知道所有层的
+        激活大小。各模型在 ``__init__`` 的最后调用，流水线模型在 :meth:`from_config` 中调用。
+        """
+        activation_checkpointing = ActivationCheckpointing(config)
+        for module in model.modules():
+            if isinstance(getattr(module, "activation_checkpointing", None), ActivationCheckpointing):
+                module.activation_checkpointing = activation_checkpointing
+
     def _get_hidden_states(self, layers: Sequence[nn.Module], attr_name: str="hidden_states"):
         all_hidden_states = []
         for layer in layers:
@@ -69,6 +91,19 @@ class CollieModelForCausalLM(nn.Module, GenerationMixin):
             if hasattr(layer, attr_name):
                 object.__setattr__(layer, attr_name, None)
 
+    def _lm_head_forward(self, lm_head: nn.Module, hidden_states: torch.Tensor,
+                         labels: Optional[torch.Tensor] = None) -> Tuple[Optional[torch.Tensor], Optional[torch.Tensor]]:
+        """计算 lm_head 的输出。
+
+        训练时如果设置了 ``lm_loss_chunk_size`` 且传入了 ``labels``，lm_head 会与交叉
+        熵融合计算，返回 ``(loss, None)``；否则返回 ``(None, logits)``。
+        """
+        chunk_size = self.collie_config.lm_loss_chunk_size
+        if self.training and labels is not None and chunk_size > 0 and \
+                isinstance(lm_head, (ColumnParallelLMHead, LinearWithHiddenStates)):
+            return lm_head(hidden_states, labels=labels, chunk_size=chunk_size), None
+        return None, lm_head(hidden_states)
+
     def _set_hidden_states(self, layers: Sequence[nn.Module], hidden_states: List[torch.Tensor], attr_name: str="hidden_states"):
         hidden_states = iter(hidden_states)
         for layer in layers:
@@ -80,17 +115,46 @@ class CollieModelForCausalLM(nn.Module, GenerationMixin):
             if hasattr(layer, attr_name):
                 object.__setattr__(layer, attr_name, use_cache)
 
+    def _set_kv_cache(self, layers: Sequence[nn.Module], kv_cache: Optional[StaticKVCache]):
+        for layer in layers:
+            if hasattr(layer, "kv_cache"):
+                object.__setattr__(layer, "kv_cache", kv_cache)
+
     def can_generate(self) -> bool:
         return True
 
-    def generate(self, *args, **kwargs):
+    def generate(self, *args, static_kv_cache: bool = True, **kwargs):
         """
         生成函数。用法同 ``huggingface``。
+
+        :param static_kv_cache: 是否为本次生成预先分配
+            :class:`~collie.models.utils.StaticKVCache`。仅对支持的模型生效，束搜索和
+            对比搜索时不会使用。
         """
-        res = super().generate(*args, **kwargs)
+        kv_cache = None
+        if static_kv_cache and self._supports_static_kv_cache:
+            kv_cache = build_static_kv_cache(self, args, kwargs)
+        self._kv_cache = kv_cache
+        self._set_kv_cache(self.modules(), kv_cache)
+        try:
+            res = super().generate(*args, **kwargs)
+        finally:
+            self._kv_cache = None
+            self._set_kv_cache(self.modules(), None)
         self.clean_cache()
         return res
 
+    def _update_model_kwargs_for_generation(self, outputs, model_kwargs, *args, **kwargs):
+        model_kwargs = super()._update_model_kwargs_for_generation(
+            outputs, model_kwargs, *args, **kwargs
+        )
+        # 使用预先分配的 cache 时各层不再返回 past_key_values
+        if getattr(self, "_kv_cache", None) is not None and model_kwargs.get(
+            "past_key_values", None
+        ) is None and model_kwargs.get("use_cache", False):
+            model_kwargs["past_key_values"] = self._kv_cache
+        return model_kwargs
+
     @classmethod
     def from_config(cls, config: Union[CollieConfig, str], **kwargs):
         """
@@ -140,8 +204,10 @@ class CollieModelForCausalLM(nn.Module, GenerationMixin):
             setattr(model, "collie_config", config)
             setattr(model, "save_parallel_state_dict", cls.save_parallel_state_dict)
             setattr(model, "load_parallel_state_dict", cls.load_parallel_state_dict)
+            setattr(model, "_supports_static_kv_cache", model_cls._supports_static_kv_cache)
             for method in cls.overwrite_pipeline_methods() + [cls.resize_token_embeddings, cls.prepare_inputs, cls.enable_input_require_grads]:
                 object.__setattr__(model, method.__name__, types.MethodType(method, model))
+            cls._share_activation_checkpointing(model, config)
         if kwargs.get("init_params", True):
             post_init_funcs = {}
             # 记录 post_init 函数
@@ -392,10 +458,14 @@ class CollieModelForCausalLM(nn.Module, GenerationMixin):
         if past_key_values is not None:
             if not isinstance(past_key_values, torch.Tensor) and None in past_key_values:
                 past_key_values = None
-        return self.prepare_inputs(
+        model_inputs = self.prepare_inputs(
             input_ids=input_ids, attention_mask=attention_mask,
             use_cache=use_cache, past_key_values=past_key_values
         )
+        if isinstance(past_key_values, StaticKVCache):
+            # 各层直接从自身的 kv_cache 中读取历史
+            model_inputs["past_key_values"] = None
+        return model_inputs
 
     @staticmethod
     def overwrite_pipeline_methods() -> Sequence[callable]:
@@ -32,7 +32,8 @@ from collie.module import (
     RowParallelLinearWithoutBias,
 )
 from collie.utils import concat_tensor, dict_as_params, env, progress 
-from collie.models.utils import (kv_cache_to_inputs_for_model, inputs_to_kv_cache_for_model,\
+from collie.models.utils import (ActivationCheckpointing,\
+                                kv_cache_to_inputs_for_model, inputs_to_kv_cache_for_model,\
                                 kv_cache_to_inputs_for_layer, inputs_to_kv_cache_for_layer)
 # try:
 #     from flash_attn.flash_attention import FlashAttention
@@ -317,6 +318,7 @@ class ChatGLMLayer(nn.Module):
         # 务必保持变量名一致
         self.use_cache = False
         self.hidden_states = None
+        self.activation_checkpointing = ActivationCheckpointing(config)
 
     def get_masks(self, input_ids, device):
         batch_size, seq_length = input_ids.shape
@@ -393,65 +395,77 @@ class ChatGLMLayer(nn.Module):
             else:
                 new_layer_past = (key, value)
 
-        # seqlen, batch, num_attention_heads, hidden_size_per_attention_head
-        seq_len, b, nh, hidden_size = key.shape
-        query_key_layer_scaling_coeff = float(self.layer_id + 1)
-        query_layer = query / (math.sqrt(hidden_size) * query_key_layer_scaling_coeff)
-        # [b, np, sq, sk]
-        output_size = (query_layer.size(1), query_layer.size(2), query_layer.size(0), key.size(0))
-
-        # [sq, b, np, hn] -> [sq, b * np, hn] [1, 32, 128]
-        query_layer = query_layer.view(output_size[2], output_size[0] * output_size[1], -1)
-        # [sk, b, np, hn] -> [sk, b * np, hn] [24, 32, 128]
-        key_layer = key.view(output_size[3], output_size[0] * output_size[1], -1)
-
-        matmul_result = torch.zeros(
-            1, 1, 1,
-            dtype=query_layer.dtype,
-            device=query_layer.device,
-        )
+        if self.config.attention_backend == "sdpa":
+            # [sq, b, np, hn] -> [b, np, sq, hn]
+            context_layer = F.scaled_dot_product_attention(
+                query.permute(1, 2, 0, 3),
+                key.permute(1, 2, 0, 3),
+                value.permute(1, 2, 0, 3),
+                attn_mask=None if attention_mask is None else ~attention_mask,
+            )
+            # [b, np, sq, hn] --> [sq, b, hp]
+            context_layer = context_layer.permute(2, 0, 1, 3).contiguous()
+            context_layer = context_layer.view(*context_layer.size()[:-2], self.hidden_size)
+        else:
+            # seqlen, batch, num_attention_heads, hidden_size_per_attention_head
+            seq_len, b, nh, hidden_size = key.shape
+            query_key_layer_scaling_coeff = float(self.layer_id + 1)
+            query_layer = query / (math.sqrt(hidden_size) * query_key_layer_scaling_coeff)
+            # [b, np, sq, sk]
+            output_size = (query_layer.size(1), query_layer.size(2), query_layer.size(0), key.size(0))
+
+            # [sq, b, np, hn] -> [sq, b * np, hn] [1, 32, 128]
+            query_layer = query_layer.view(output_size[2], output_size[0] * output_size[1], -1)
+            # [sk, b, np, hn] -> [sk, b * np, hn] [24, 32, 128]
+            key_layer = key.view(output_size[3], output_size[0] * output_size[1], -1)
+
+            matmul_result = torch.zeros(
+                1, 1, 1,
+                dtype=query_layer.dtype,
+                device=query_layer.device,
+            )
 
-        matmul_result = torch.baddbmm(
-            matmul_result,
-            query_layer.transpose(0, 1),  # [b * np, sq, hn]
-            key_layer.transpose(0, 1).transpose(1, 2),  # [b * np, hn, sk]
-            beta=0.0,
-            alpha=1.0,
-        )
-        # [32, 1, 24]
-        # change view to [b, np, sq, sk]
-        attention_scores = matmul_result.view(*output_size)
-        if not (attention_mask == 0).all():
-            # if auto-regressive, skip
-            attention_scores.masked_fill_(attention_mask, -10000.0)
-        dtype = attention_scores.dtype
-        attention_scores = attention_scores.float()
-        attention_scores = attention_scores * query_key_layer_scaling_coeff
-        attention_probs = F.softmax(attention_scores, dim=-1)
-
-        attention_probs = attention_probs.type(dtype)
-        # value_layer -> context layer.
-        # [sk, b, np, hn] --> [b, np, sq, hn]
-
-        # context layer shape: [b, np, sq, hn]
-        output_size = (value.size(1), value.size(2), query_layer.size(0), value.size(3))
-
-        # change view [sk, b * np, hn]
-        value_layer = value.view(value.size(0), output_size[0] * output_size[1], -1)
-
-        # change view [b * np, sq, sk]
-        attention_probs = attention_probs.view(output_size[0] * output_size[1], output_size[2], -1)
-        # matmul: [b * np, sq, hn] [24,32, 128]
-        context_layer = torch.bmm(attention_probs, value_layer.transpose(0, 1))
-
-        # change view [b, np, sq, hn]
-        context_layer = context_layer.view(*output_size)
-
-        # [b, np, sq, hn] --> [sq, b, np, hn]
-        context_layer = context_layer.permute(2, 0, 1, 3).contiguous()
-        # [sq, b, np, hn] --> [sq, b, hp]
-        new_context_layer_shape = context_layer.size()[:-2] + (self.hidden_size,)
-        context_layer = context_layer.view(*new_context_layer_shape)
+            matmul_result = torch.baddbmm(
+                matmul_result,
+                query_layer.transpose(0, 1),  # [b * np, sq, hn]
+                key_layer.transpose(0, 1).transpose(1, 2),  # [b * np, hn, sk]
+                beta=0.0,
+                alpha=1.0,
+            )
+            # [32, 1, 24]
+            # change view to [b, np, sq, sk]
+            attention_scores = matmul_result.view(*output_size)
+            if not (attention_mask == 0).all():
+                # if auto-regressive, skip
+                attention_scores.masked_fill_(attention_mask, -10000.0)
+            dtype = attention_scores.dtype
+            attention_scores = attention_scores.float()
+            attention_scores = attention_scores * query_key_layer_scaling_coeff
+            attention_probs = F.softmax(attention_scores, dim=-1)
+
+            attention_probs = attention_probs.type(dtype)
+            # value_layer -> context layer.
+            # [sk, b, np, hn] --> [b, np, sq, hn]
+
+            # context layer shape: [b, np, sq, hn]
+            output_size = (value.size(1), value.size(2), query_layer.size(0), value.size(3))
+
+            # change view [sk, b * np, hn]
+            value_layer = value.view(value.size(0), output_size[0] * output_size[1], -1)
+
+            # change view [b * np, sq, sk]
+            attention_probs = attention_probs.view(output_size[0] * output_size[1], output_size[2], -1)
+            # matmul: [b * np, sq, hn] [24,32, 128]
+            context_layer = torch.bmm(attention_probs, value_layer.transpose(0, 1))
+
+            # change view [b, np, sq, hn]
+            context_layer = context_layer.view(*output_size)
+
+            # [b, np, sq, hn] --> [sq, b, np, hn]
+            context_layer = context_layer.permute(2, 0, 1, 3).contiguous()
+            # [sq, b, np, hn] --> [sq, b, hp]
+            new_context_layer_shape = context_layer.size()[:-2] + (self.hidden_size,)
+            context_layer = context_layer.view(*new_context_layer_shape)
         attention_output = self.attention["dense"](context_layer)
         # Residual connection.
         hidden_states = hidden_states * self.alpha + attention_output
@@ -484,23 +498,15 @@ class ChatGLMLayer(nn.Module):
         
         attention_mask = attention_mask.contiguous()   
         
-        if self.config.checkpointing and self.training:
-            inputs["hidden_states"], new_layer_past = torch.utils.checkpoint.checkpoint(
-                self._forward,
-                inputs["hidden_states"],
-                inputs["input_ids"],
-                inputs["position_ids"],
-                past_key_values,
-                attention_mask,
-            )
-        else:
-            inputs["hidden_states"], new_layer_past = self._forward(
-                hidden_states=inputs["hidden_states"],
-                input_ids=inputs["input_ids"],
-                position_ids=inputs["position_ids"],
-                past_key_values=past_key_values,
-                attention_mask=attention_mask,
-            )
+        inputs["hidden_states"], new_layer_past = self.activation_checkpointing(
+            self,
+            self.layer_id,
+            inputs["hidden_states"],
+            inputs["input_ids"],
+            inputs["position_ids"],
+            past_key_values,
+            attention_mask,
+        )
         inputs["position_ids"] = inputs["position_ids"].contiguous()
         inputs.update(kv_cache_to_inputs_for_layer(idx=self.layer_id,
                                                    new_layer_past=new_layer_past))
@@ -694,12 +700,13 @@ class ChatGLMForCausalLM(CollieModelForCausalLM):
     def __init__(self, config: CollieConfig) -> None:
         super().__init__(config)
         self.model = ChatGLMModel(config)
-        self.lm_head = ColumnParallelLinearWithoutBias(
+        self.lm_head = ColumnParallelLMHead(
             self.config.hidden_size, self.config.vocab_size, bias=False
         )
         # GenerationMixin 需要的额外参数
         self.config.is_decoder = True
         self.main_input_name = "input_ids"
+        self._share_activation_checkpointing(self, config)
 
     def forward(
         self,
@@ -714,10 +721,10 @@ class ChatGLMForCausalLM(CollieModelForCausalLM):
             past_key_values=past_key_values,
             **kwargs,
         )
-        logits = self.lm_head(output.last_hidden_state)
+        loss, logits = self._lm_head_forward(self.lm_head, output.last_hidden_state, kwargs.get("labels"))
 
         return CausalLMOutputWithPast(
-            loss=None,
+            loss=loss,
             logits=logits,
             past_key_values=output.past_key_values,
             hidden_states=output.hidden_states,
@@ -32,6 +32,8 @@ from collie.module import (
     RowParallelLinearWithoutBias,
 )
 from collie.models.utils import (
+    ActivationCheckpointing,
+    get_rotary_table,
     kv_cache_to_inputs_for_layer, inputs_to_kv_cache_for_layer,
     kv_cache_to_inputs_for_model, inputs_to_kv_cache_for_model
 )
@@ -421,6 +423,7 @@ class ChatGLM2Layer(nn.Module):
         self.use_cache = False
         # self.past_key_values = None
         self.hidden_states = None
+        self.activation_checkpointing = ActivationCheckpointing(config)
 
     def get_masks(self, input_ids, past_key_values, padding_mask=None):
         batch_size, seq_length = input_ids.shape
@@ -605,21 +608,14 @@ class ChatGLM2Layer(nn.Module):
 
         # Data format change to avoid explicit tranposes : [b s h] --> [s b h].
         inputs["hidden_states"] = inputs["hidden_states"].transpose(0, 1).contiguous()
-        if self.config.checkpointing and self.training:
-            inputs["hidden_states"], new_layer_past = torch.utils.checkpoint.checkpoint(
-                self._forward,
-                inputs["hidden_states"],
-                full_attention_mask,
-                past_key_values,
-                inputs["rotary_pos_emb"],
-            )
-        else:
-            inputs["hidden_states"], new_layer_past = self._forward(
-                inputs["hidden_states"],
-                full_attention_mask,
-                past_key_values,
-                inputs["rotary_pos_emb"],
-            )
+        inputs["hidden_states"], new_layer_past = self.activation_checkpointing(
+            self,
+            self.layer_id,
+            inputs["hidden_states"],
+            full_attention_mask,
+            past_key_values,
+            inputs["rotary_pos_emb"],
+        )
         # 将输入维度转为 [b, s, h]
         inputs["hidden_states"] = inputs["hidden_states"].transpose(0, 1).contiguous()
 
@@ -658,7 +654,9 @@ class ChatGLM2Model(nn.Module):
         inputs = {"input_ids": input_ids}
         if input_ids == None:
             inputs["hidden_states"] = kwargs["inputs_embeds"]
-            inputs['rotary_pos_emb'] = self._get_rotary_embedding(self.config, kwargs.get("position_ids", None))
+            inputs['rotary_pos_emb'] = self._get_rotary_embedding(
+                self.config, kwargs.get("position_ids", None), kwargs["inputs_embeds"].device
+            )
         else:
             inputs.update(dict(zip(["hidden_states", "rotary_pos_emb"], self.word_embeddings(input_ids, kwargs.get("position_ids", None)))))
 
@@ -713,20 +711,28 @@ class ChatGLM2Model(nn.Module):
         return layers
 
     @staticmethod
-    def _get_rotary_embedding(config, position_ids):
+    def _get_rotary_embedding(config, position_ids, device=None):
         seq_length = config.seq_length
         rotary_dim = (
             config.hidden_size // config.num_attention_heads
             if config.kv_channels is None
             else config.kv_channels
         )
+        if position_ids is not None:
+            device = position_ids.device
+        device = torch.device("cpu") if device is None else torch.device(device)
         # rotary_dim = rotary_dim // config.tp_size
-        rotary_pos_emb = RotaryEmbedding(
-            rotary_dim // 2,
-            original_impl=config.original_rope,
-            dtype=config.torch_dtype,
+        # 编码表在所有层和所有前向之间共享，只计算一次
+        rotary_pos_emb = get_rotary_table(
+            ("chatglm2", rotary_dim // 2, config.torch_dtype, device),
+            seq_length,
+            lambda length: RotaryEmbedding(
+                rotary_dim // 2,
+                original_impl=config.original_rope,
+                device=device,
+                dtype=config.torch_dtype,
+            )(length),
         )
-        rotary_pos_emb = rotary_pos_emb(seq_length)
         if position_ids is not None:
             rotary_pos_emb = rotary_pos_emb[position_ids]
         else:
@@ -744,7 +750,7 @@ class ChatGLM2Model(nn.Module):
                 super().__init__(*args, **kwargs)
 
             def forward(self, input_, position_ids=None):
-                rotary_pos_emb = cls._get_rotary_embedding(config, position_ids)
+                rotary_pos_emb = cls._get_rotary_embedding(config, position_ids, input_.device)
                 return super().forward(input_), rotary_pos_emb
 
         return WordEmbeddingWithPositionIdsAndInputIds
@@ -754,12 +760,13 @@ class ChatGLM2ForCausalLM(CollieModelForCausalLM):
     def __init__(self, config: CollieConfig):
         super().__init__(config)
         self.model = ChatGLM2Model(config)
-        self.lm_head = ColumnParallelLinearWithoutBias(
+        self.lm_head = ColumnParallelLMHead(
             self.config.hidden_size, self.config.padded_vocab_size, bias=False
         )
         # GenerationMixin 需要的额外参数
         self.config.is_decoder = True
         self.main_input_name = "input_ids"
+        self._share_activation_checkpointing(self, config)
 
     def forward(
             self,
@@ -773,10 +780,10 @@ class ChatGLM2ForCausalLM(CollieModelForCausalLM):
             past_key_values=past_key_values,
             **kwargs,
         )
-        logits = self.lm_head(output.last_hidden_state)
+        loss, logits = self._lm_head_forward(self.lm_head, output.last_hidden_state, kwargs.get("labels"))
 
         return CausalLMOutputWithPast(
-            loss=None,
+            loss=loss,
             logits=logits,
             past_key_values=output.past_key_values,
             hidden_states=output.hidden_states,
@@ -39,6 +39,8 @@ from collie.module import (
 from collie.utils import concat_tensor, dict_as_params, env, progress
 from collie.models.base import CollieModelForCausalLM
 from collie.models.utils import (
+    ActivationCheckpointing,
+    get_rotary_table,
     kv_cache_to_inputs_for_layer, inputs_to_kv_cache_for_layer,
     kv_cache_to_inputs_for_model, inputs_to_kv_cache_for_model,
 )
@@ -140,31 +142,33 @@ class InternLM2RotaryEmbedding(nn.Module):
         self.base = base
         inv_freq = 1.0 / (self.base ** (torch.arange(0, self.dim, 2).float().to(device) / self.dim))
         self.register_buffer("inv_freq", inv_freq, persistent=False)
+        self.max_seq_len_cached = max_position_embeddings
 
-        # Build here to make `torch.jit.trace` work.
-        self._set_cos_sin_cache(
-            seq_len=max_position_embeddings, device=self.inv_freq.device, dtype=torch.get_default_dtype()
-        )
-
-    def _set_cos_sin_cache(self, seq_len, device, dtype):
-        self.max_seq_len_cached = seq_len
-        t = torch.arange(self.max_seq_len_cached, device=device, dtype=self.inv_freq.dtype)
+    def _positions(self, seq_len, device):
+        return torch.arange(seq_len, device=device, dtype=torch.float32)
 
-        freqs = torch.einsum("i,j->ij", t, self.inv_freq)
+    def _cos_sin(self, seq_len, device, dtype):
+        # 使用 float32 重新计算频率，不受模型整体转换为半精度的影响
+        inv_freq = 1.0 / (self.base ** (torch.arange(0, self.dim, 2).float() / self.dim))
+        t = self._positions(seq_len, device)
+        freqs = torch.einsum("i,j->ij", t, inv_freq.to(device))
         # Different from paper, but it uses a different permutation in order to obtain the same calculation
         emb = torch.cat((freqs, freqs), dim=-1)
-        self.register_buffer("cos_cached", emb.cos().to(dtype), persistent=False)
-        self.register_buffer("sin_cached", emb.sin().to(dtype), persistent=False)
+        return emb.cos().to(dtype), emb.sin().to(dtype)
 
     def forward(self, x, seq_len=None):
         # x: [bs, num_attention_heads, seq_len, head_size]
-        if seq_len > self.max_seq_len_cached:
-            self._set_cos_sin_cache(seq_len=seq_len, device=x.device, dtype=torch.float32)
-
-        return (
-            self.cos_cached[:seq_len].to(dtype=x.dtype),
-            self.sin_cached[:seq_len].to(dtype=x.dtype),
+        # cos/sin 表在所有层之间共享，只在长度不足时重新计算
+        key = (
+            "cos_sin", self.dim, self.base, getattr(self, "scaling_factor", 1.0),
+            x.dtype, x.device,
         )
+        table = get_rotary_table(
+            key,
+            max(seq_len, self.max_position_embeddings),
+            lambda length: torch.stack(self._cos_sin(length, x.device, x.dtype), dim=1),
+        )[:seq_len]
+        return table[:, 0], table[:, 1]
 
 
 # Copied from transformers.model.llama.modeling_llama.LlamaLinearScalingRotaryEmbedding with Llama->InternLM2
@@ -175,16 +179,8 @@ class InternLM2LinearScalingRotaryEmbedding(InternLM2RotaryEmbedding):
         self.scaling_factor = scaling_factor
         super().__init__(dim, max_position_embeddings, base, device)
 
-    def _set_cos_sin_cache(self, seq_len, device, dtype):
-        self.max_seq_len_cached = seq_len
-        t = torch.arange(self.max_seq_len_cached, device=device, dtype=self.inv_freq.dtype)
-        t = t / self.scaling_factor
-
-        freqs = torch.einsum("i,j->ij", t, self.inv_freq)
-        # Different from paper, but it uses a different permutation in order to obtain the same calculation
-        emb = torch.cat((freqs, freqs), dim=-1)
-        self.register_buffer("cos_cached", emb.cos().to(dtype), persistent=False)
-        self.register_buffer("sin_cached", emb.sin().to(dtype), persistent=False)
+    def _positions(self, seq_len, device):
+        return super()._positions(seq_len, device) / self.scaling_factor
 
 
 # Copied from transformers.model.llama.modeling_llama.LlamaDynamicNTKScalingRotaryEmbedding with Llama->InternLM2
@@ -196,6 +192,10 @@ class InternLM2DynamicNTKScalingRotaryEmbedding(InternLM2RotaryEmbedding):
     def __init__(self, dim, max_position_embeddings=2048, base=10000, device=None, scaling_factor=1.0):
         self.scaling_factor = scaling_factor
         super().__init__(dim, max_position_embeddings, base, device)
+        # 频率依赖于见过的最大长度，因此编码表不在层之间共享
+        self._set_cos_sin_cache(
+            seq_len=max_position_embeddings, device=self.inv_freq.device, dtype=torch.get_default_dtype()
+        )
 
     def _set_cos_sin_cache(self, seq_len, device, dtype):
         self.max_seq_len_cached = seq_len
@@ -215,6 +215,16 @@ class InternLM2DynamicNTKScalingRotaryEmbedding(InternLM2RotaryEmbedding):
         self.register_buffer("cos_cached", emb.cos().to(dtype), persistent=False)
         self.register_buffer("sin_cached", emb.sin().to(dtype), persistent=False)
 
+    def forward(self, x, seq_len=None):
+        # x: [bs, num_attention_heads, seq_len, head_size]
+        if seq_len > self.max_seq_len_cached:
+            self._set_cos_sin_cache(seq_len=seq_len, device=x.device, dtype=torch.float32)
+
+        return (
+            self.cos_cached[:seq_len].to(dtype=x.dtype),
+            self.sin_cached[:seq_len].to(dtype=x.dtype),
+        )
+
 
 # Copied from transformers.model.llama.modeling_llama.rotate_half
 def rotate_half(x):
@@ -407,10 +417,12 @@ class InternLM2Attention(nn.Module):
 
         past_key_value = (key_states, value_states) if use_cache else None
 
-        key_states = repeat_kv(key_states, self.num_key_value_groups)
-        value_states = repeat_kv(value_states, self.num_key_value_groups)
-
+        # grouped-query attention：将同一组的 query head 折叠到序列维度上，
+        # 与对应的 key/value head 直接相乘，不复制 key 和 value
+        num_heads = query_states.shape[1]
+        query_states = query_states.reshape(bsz, key_states.shape[1], -1, self.head_dim)
         attn_weights = torch.matmul(query_states, key_states.transpose(2, 3)) / math.sqrt(self.head_dim)
+        attn_weights = attn_weights.view(bsz, num_heads, q_len, kv_seq_len)
 
         if attn_weights.size() != (bsz, self.num_heads/self.config.tp_size, q_len, kv_seq_len):
             raise ValueError(
@@ -427,7 +439,9 @@ class InternLM2Attention(nn.Module):
 
         # upcast attention to fp32
         attn_weights = nn.functional.softmax(attn_weights, dim=-1, dtype=torch.float32).to(query_states.dtype)
-        attn_output = torch.matmul(attn_weights, value_states)
+        attn_output = torch.matmul(
+            attn_weights.view(bsz, key_states.shape[1], -1, kv_seq_len), value_states
+        ).view(bsz, num_heads, q_len, self.head_dim)
 
         if attn_output.size() != (bsz, self.num_heads/self.config.tp_size, q_len, self.head_dim):
             raise ValueError(
@@ -648,8 +662,9 @@ class InternLM2DecoderLayer(nn.Module):
         self.use_cache = self.config.model_config.use_cache
         self.hidden_states = None
         self.output_attentions = False
+        self.activation_checkpointing = ActivationCheckpointing(config)
 
-    def _forward(
+    def _attention_forward(
         self,
         hidden_states: torch.Tensor,
         attention_mask: Optional[torch.Tensor] = None,
@@ -700,32 +715,39 @@ class InternLM2DecoderLayer(nn.Module):
         )
         hidden_states = residual + hidden_states
 
+        return hidden_states, present_key_value
+
+    def _mlp_forward(self, hidden_states: torch.Tensor) -> torch.FloatTensor:
         # Fully Connected
         residual = hidden_states
         hidden_states = self.ffn_norm(hidden_states)
         hidden_states = self.feed_forward(hidden_states)
-        hidden_states = residual + hidden_states
+        return residual + hidden_states
 
-        return hidden_states, present_key_value
+    def _forward(
+        self,
+        hidden_states: torch.Tensor,
+        attention_mask: Optional[torch.Tensor] = None,
+        position_ids: Optional[torch.LongTensor] = None,
+        past_key_value: Optional[Tuple[torch.Tensor]] = None,
+        **kwargs,
+    ) -> Tuple[torch.FloatTensor, Optional[Tuple[torch.FloatTensor, torch.FloatTensor]]]:
+        hidden_states, present_key_value = self._attention_forward(
+            hidden_states, attention_mask, position_ids, past_key_value, **kwargs
+        )
+        return self._mlp_forward(hidden_states), present_key_value
 
     def forward(self, inputs: dict):
         layer_past = inputs_to_kv_cache_for_layer(idx=self.idx, inputs=inputs)
 
-        if self.config.checkpointing and self.training:
-            hidden_states, new_layer_past = torch.utils.checkpoint.checkpoint(
-                self._forward,
-                inputs["hidden_states"],
-                inputs.get("attention_mask", None),
-                inputs.get("position_ids", None),
-                layer_past,
-            )
-        else:
-            hidden_states, new_layer_past = self._forward(
-                inputs["hidden_states"],
-                inputs.get("attention_mask", None),
-                inputs.get("position_ids", None),
-                layer_past
-            )  # **inputs
+        hidden_states, new_layer_past = self.activation_checkpointing(
+            self,
+            self.idx,
+            inputs["hidden_states"],
+            inputs.get("attention_mask", None),
+            inputs.get("position_ids", None),
+            layer_past,
+        )
         inputs["hidden_states"] = hidden_states
 
         inputs.update(kv_cache_to_inputs_for_layer(idx=self.idx, new_layer_past=new_layer_past))
@@ -1041,7 +1063,7 @@ class InternLM2ForCausalLM(CollieModelForCausalLM):
         self.model = InternLM2Model(config)
         self.vocab_size = config.vocab_size
         # self.output = nn.Linear(config.hidden_size, config.vocab_size, bias=False)
-        self.output = ColumnParallelLinearWithoutBias(
+        self.output = ColumnParallelLMHead(
             self.collie_config.hidden_size, self.collie_config.vocab_size, bias=False
         )
         # Initialize weights and apply final processing
@@ -1051,6 +1073,7 @@ class InternLM2ForCausalLM(CollieModelForCausalLM):
         if config.model_config.tie_word_embeddings:
             self.lm_head.weight = self.embed_tokens.weight
         self.main_input_name = "input_ids"
+        self._share_activation_checkpointing(self, config)
 
     def get_input_embeddings(self):
         return self.model.tok_embeddings
@@ -1083,9 +1106,9 @@ class InternLM2ForCausalLM(CollieModelForCausalLM):
             past_key_values=past_key_values,
             **kwargs,
         )
-        logits = self.output(output.last_hidden_state)
+        loss, logits = self._lm_head_forward(self.output, output.last_hidden_state, kwargs.get("labels"))
         return CausalLMOutputWithPast(
-            loss=None,
+            loss=loss,
             logits=logits,
             past_key_values=output.past_key_values,
             hidden_states=output.hidden_states,
@@ -25,7 +25,8 @@ from collie.driver.io import IODriver
 from collie.log.logger import logger
 from collie.models.base import CollieModelForCausalLM
 from collie.models.utils import (
-    flash_attention, 
+    ActivationCheckpointing,
+    flash_attention, get_complex_rotary_table, sdpa_attention,
     kv_cache_to_inputs_for_layer, inputs_to_kv_cache_for_layer, 
     kv_cache_to_inputs_for_model, inputs_to_kv_cache_for_model, 
 )
@@ -52,10 +53,7 @@ class RotaryPositionEmbedding(nn.Module):
         t = query.dtype
         query = torch.view_as_complex(query.float().reshape(*query.shape[:-1], -1, 2))
         key = torch.view_as_complex(key.float().reshape(*key.shape[:-1], -1, 2))
-        freqs = torch.outer(
-            torch.arange((2**16) * 2, device=self.inv_freq.device), self.inv_freq
-        ).float()
-        freqs_cis = torch.polar(torch.ones_like(freqs), freqs)[
+        freqs_cis = get_complex_rotary_table(self.inv_freq, start_pos + seq_len)[
             start_pos : start_pos + seq_len
         ]
         shape = [
@@ -161,13 +159,16 @@ class MossBlock(nn.Module):
         )
         # 务必保持变量名一致
         self.use_cache = self.config.model_config.use_cache
+        self.kv_cache = None
         self.hidden_states = None
+        self.activation_checkpointing = ActivationCheckpointing(config)
 
-    def _forward(
+    def _attention_forward(
         self,
         hidden_states: torch.Tensor,
         attention_mask: Optional[torch.Tensor] = None,
         past_key_values: Optional[torch.Tensor] = None,
+        sdpa_mask_cache: Optional[dict] = None,
         **kwargs,
     ):
         if not self.training:
@@ -193,11 +194,17 @@ class MossBlock(nn.Module):
             rearrange(key, "b n (h d) -> b n h d", d=head_dim),
             rearrange(value, "b n (h d) -> b n h d", d=head_dim),
         )
+        # 生成时使用预先分配的 cache，原地写入 start_pos 处
+        kv_cache = None
+        if layer_past is None and self.use_cache and not self.training:
+            kv_cache = self.kv_cache
         if layer_past is not None:
             if self.config.peft_config and self.config.peft_config.peft_type == "PREFIX_TUNING":
                 start_pos = layer_past[0].shape[2]
             else:
                 start_pos = layer_past[0].shape[1]
+        elif kv_cache is not None:
+            start_pos = kv_cache.start_pos(self.idx)
         else:
             start_pos = 0
         query, key = self.self_attn["rotary_emb"](query, key, seq_len, start_pos)
@@ -210,11 +217,12 @@ class MossBlock(nn.Module):
                 past_value = layer_past[1].permute([0, 2, 1, 3])
             else:
                 past_key, past_value = layer_past
-            query = torch.cat([past_key, query], dim=1)
             key = torch.cat([past_key, key], dim=1)
             value = torch.cat([past_value, value], dim=1)
         new_layer_past = None
-        if self.use_cache and not self.training:
+        if kv_cache is not None:
+            key, value = kv_cache.update(self.idx, key, value)
+        elif self.use_cache and not self.training:
             # 调整成和 hf 兼容的格式，方便 prefix tuning
             if self.config.peft_config and self.config.peft_config.peft_type == "PREFIX_TUNING":
                 present_key = key.reshape(*key.shape[:-1], -1, 2)\
@@ -224,13 +232,19 @@ class MossBlock(nn.Module):
                 new_layer_past = (present_key, present_value)
             else:
                 new_layer_past = (key, value)
+        padding_mask = attention_mask
         attention_mask = (
             attention_mask
             if attention_mask is not None
-            else torch.ones((query.shape[0], query.shape[1])).to(hidden_states.device)
+            else torch.ones((key.shape[0], key.shape[1])).to(hidden_states.device)
         )
-        if self.config.use_flash:
+        # 解码时只计算新 token 的 query，flash attention 仅用于没有历史的前向
+        if self.config.use_flash and start_pos == 0:
             output = flash_attention(query, key, value, attention_mask)
+        elif self.config.attention_backend == "sdpa":
+            output = sdpa_attention(
+                query, key, value, padding_mask, start_pos, mask_cache=sdpa_mask_cache
+            )
         else:
             query, key, value = (
                 query.permute(0, 2, 1, 3),
@@ -240,11 +254,13 @@ class MossBlock(nn.Module):
             attention_score = torch.matmul(query, key.transpose(2, 3)) / math.sqrt(
                 head_dim
             )
-            if seq_len + start_pos > 1:
+            if seq_len > 1:
                 mask = torch.full(
-                    (1, 1, seq_len + start_pos, seq_len + start_pos), float("-inf")
+                    (1, 1, seq_len, seq_len + start_pos),
+                    float("-inf"),
+                    device=attention_score.device,
                 )
-                mask = torch.triu(mask, diagonal=1).to(attention_score.device)
+                mask = torch.triu(mask, diagonal=start_pos + 1)
                 attention_score = attention_score + mask
             key_padding_mask = (
                 1.0 - attention_mask.unsqueeze(1).unsqueeze(2)
@@ -256,13 +272,15 @@ class MossBlock(nn.Module):
             output = (
                 output.transpose(1, 2)
                 .contiguous()
-                .view(batch_size, seq_len + start_pos, -1)
+                .view(batch_size, seq_len, -1)
             )
         output = F.dropout(output, p=self.config.dropout, training=self.training)
-        output = output[:, start_pos:, :]
         hidden_states = hidden_states + self.self_attn["o_proj"](output)
+        return hidden_states, new_layer_past
+
+    def _mlp_forward(self, hidden_states: torch.Tensor):
         _hidden_states = self.post_attention_layernorm(hidden_states)
-        hidden_states = hidden_states + F.dropout(
+        return hidden_states + F.dropout(
             self.mlp["down_proj"](
                 F.silu(self.mlp["gate_proj"](_hidden_states))
                 * self.mlp["up_proj"](_hidden_states)
@@ -270,23 +288,32 @@ class MossBlock(nn.Module):
             p=self.config.dropout,
             training=self.training,
         )
-        return hidden_states, new_layer_past
+
+    def _forward(
+        self,
+        hidden_states: torch.Tensor,
+        attention_mask: Optional[torch.Tensor] = None,
+        past_key_values: Optional[torch.Tensor] = None,
+        sdpa_mask_cache: Optional[dict] = None,
+        **kwargs,
+    ):
+        hidden_states, new_layer_past = self._attention_forward(
+            hidden_states, attention_mask, past_key_values, sdpa_mask_cache
+        )
+        return self._mlp_forward(hidden_states), new_layer_past
 
     def forward(self, inputs: dict):
         
         layer_past = inputs_to_kv_cache_for_layer(idx=self.idx, inputs=inputs)
             
-        if self.config.checkpointing and self.training:
-            hidden_states, new_layer_past = torch.utils.checkpoint.checkpoint(
-                self._forward,
-                inputs["hidden_states"],
-                inputs.get("attention_mask", None),
-                layer_past,  # inputs.get("past_key_values", None),
-            )
-        else:
-            hidden_states, new_layer_past = self._forward(inputs["hidden_states"],
-                                                          inputs.get("attention_mask", None), 
-                                                          layer_past)  # **inputs
+        hidden_states, new_layer_past = self.activation_checkpointing(
+            self,
+            self.idx,
+            inputs["hidden_states"],
+            inputs.get("attention_mask", None),
+            layer_past,  # inputs.get("past_key_values", None),
+            inputs.get("sdpa_mask_cache", None),
+        )
         inputs["hidden_states"] = hidden_states
 
         inputs.update(kv_cache_to_inputs_for_layer(idx=self.idx, new_layer_past=new_layer_past))
@@ -324,6 +351,8 @@ class MossModel(nn.Module):
             inputs["hidden_states"] = self.embed_tokens(inputs["input_ids"])
 
         inputs.update(kv_cache_to_inputs_for_model(past_key_values))
+        # 所有层共享本次前向中构造的 sdpa mask
+        inputs["sdpa_mask_cache"] = {}
             
         all_hidden_states = ()
         for layer in self.layers:
@@ -385,11 +414,12 @@ class MossModel(nn.Module):
 
 class MossForCausalLM(CollieModelForCausalLM):
     base_model_prefix = "model"
+    _supports_static_kv_cache = True
 
     def __init__(self, config: CollieConfig) -> None:
         super().__init__(config)
         self.model = MossModel(config)
-        self.lm_head = ColumnParallelLinearWithoutBias(
+        self.lm_head = ColumnParallelLMHead(
             self.collie_config.hidden_size, self.collie_config.vocab_size, bias=False
         )
         # GenerationMixin 需要的额外参数
@@ -397,6 +427,7 @@ class MossForCausalLM(CollieModelForCausalLM):
         if config.model_config.tie_word_embeddings:
             self.lm_head.weight = self.embed_tokens.weight
         self.main_input_name = "input_ids"
+        self._share_activation_checkpointing(self, config)
 
     def forward(
         self,
@@ -411,9 +442,9 @@ class MossForCausalLM(CollieModelForCausalLM):
             past_key_values=past_key_values,
             **kwargs,
         )
-        logits = self.lm_head(output.last_hidden_state)
+        loss, logits = self._lm_head_forward(self.lm_head, output.last_hidden_state, kwargs.get("labels"))
         return CausalLMOutputWithPast(
-            loss=None,
+            loss=loss,
             logits=logits,
             past_key_values=output.past_key_values,
             hidden_states=output.hidden_states,
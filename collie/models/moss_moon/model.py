@@ -498,7 +498,7 @@ class Moss003MoonForCausalLM(CollieModelForCausalLM):
     def __init__(self, config):
         super().__init__(config)
         self.transformer = Moss003MoonModel(config)
-        self.lm_head = ColumnParallelLinearWithoutBias(config.n_embd, config.vocab_size)
+        self.lm_head = ColumnParallelLMHead(config.n_embd, config.vocab_size)
 
     def forward(
         self,
@@ -517,9 +517,9 @@ class Moss003MoonForCausalLM(CollieModelForCausalLM):
         )
         hidden_states = output.last_hidden_state
         all_hidden_states = output.hidden_states
-        logits = self.lm_head(hidden_states)
+        loss, logits = self._lm_head_forward(self.lm_head, hidden_states, kwargs.get("labels"))
         return CausalLMOutputWithPast(
-            loss=None,
+            loss=loss,
             logits=logits,
             past_key_values=output.past_key_values,
             hidden_states=all_hidden_states,
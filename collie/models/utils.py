@@ -1,3 +1,4 @@
+import copy
 import json
 import os
 
@@ -7,25 +8,77 @@ from einops import rearrange
 from collie.log import logger
 
 
-def flash_attention(query, key, value, attention_mask):
+def get_packed_segment_ids(position_ids):
+    """
+    根据 ``position_ids`` 计算 packing 后每个 token 所属样本的编号。``position_ids``
+    为 0 的 token 是一个新样本的开始。
+
+    :param position_ids: batch_size, seq_len
+    :return: batch_size, seq_len
+    """
+    return torch.cumsum(position_ids == 0, dim=-1)
+
+
+def get_packed_cu_seqlens(position_ids):
+    """
+    根据去除 padding 后的 ``position_ids`` 计算 varlen FlashAttention 所需的
+    ``cu_seqlens`` 和 ``max_seqlen``。
+
+    :param position_ids: total_tokens
+    """
+    starts = torch.nonzero(position_ids == 0).flatten()
+    cu_seqlens = torch.cat(
+        [starts, starts.new_tensor([position_ids.shape[0]])]
+    ).to(torch.int32)
+    max_seqlen = (cu_seqlens[1:] - cu_seqlens[:-1]).max().item()
+    return cu_seqlens, max_seqlen
+
+
+def flash_attention(query, key, value, attention_mask, position_ids=None):
     """
     应用 Flash Attention
 
     :param query: batzh_size, seq_len, heads, head_dim
-    :param key: batzh_size, seq_len, heads, head_dim
-    :param value: batzh_size, seq_len, heads, head_dim
+    :param key: batzh_size, seq_len, kv_heads, head_dim。``kv_heads`` 小于 ``heads``
+        时为 grouped-query attention
+    :param value: batzh_size, seq_len, kv_heads, head_dim
     :param attetion_mask: batch_size, seq_len
+    :param position_ids: batch_size, seq_len。使用 packing 时传入，``position_ids``
+        为 0 的位置被视为一个样本的开始，不同样本之间不会相互 attend
     """
     import flash_attn
 
     version = flash_attn.__version__.split(".")[0]
     batch_size, seq_len, _, _ = query.shape
     if int(version) < 2:
-        from flash_attn.flash_attention import FlashAttention
+        # FlashAttention 1 不支持 grouped-query attention
+        key, value = repeat_kv_heads(key, value, query.shape[2])
+        if position_ids is None:
+            from flash_attn.flash_attention import FlashAttention
+
+            qkv = torch.stack([query, key, value], dim=2)
+            output, _ = FlashAttention()(qkv, causal=True)
+            output = rearrange(output, "b n h d -> b n (h d)")
+        else:
+            from flash_attn.bert_padding import pad_input, unpad_input
+            from flash_attn.flash_attn_interface import (
+                flash_attn_unpadded_qkvpacked_func,
+            )
 
-        qkv = torch.stack([query, key, value], dim=2)
-        output, _ = FlashAttention()(qkv, causal=True)
-        output = rearrange(output, "b n h d -> b n (h d)")
+            qkv = torch.stack([query, key, value], dim=2)
+            qkv_unpad, indices, _, _ = unpad_input(qkv, attention_mask)
+            cu_seqlens, max_seqlen = get_packed_cu_seqlens(
+                position_ids.flatten()[indices]
+            )
+            output_unpad = flash_attn_unpadded_qkvpacked_func(
+                qkv_unpad, cu_seqlens, max_seqlen, 0.0, softmax_scale=None, causal=True
+            )
+            output = pad_input(
+                rearrange(output_unpad, "nnz h d -> nnz (h d)"),
+                indices,
+                batch_size,
+                seq_len,
+            )
     else:
         from flash_attn.bert_padding import pad_input, unpad_input
         from flash_attn.flash_attn_interface import flash_attn_varlen_kvpacked_func
@@ -37,6 +90,11 @@ def flash_attention(query, key, value, attention_mask):
         kv_unpad, indices, cu_seqlens_kv, max_seqlen_kv = unpad_input(
             kv, attention_mask
         )
+        if position_ids is not None:
+            cu_seqlens_q, max_seqlen_q = get_packed_cu_seqlens(
+                position_ids.flatten()[indices]
+            )
+            cu_seqlens_kv, max_seqlen_kv = cu_seqlens_q, max_seqlen_q
         output_unpad = flash_attn_varlen_kvpacked_func(
             q_unpad,
             kv_unpad,
@@ -57,6 +115,380 @@ def flash_attention(query, key, value, attention_mask):
     return output
 
 
+_SDPA_ENABLE_GQA = tuple(int(v) for v in torch.__version__.split(".")[:2]) >= (2, 5)
+
+
+def repeat_kv_heads(key, value, num_heads):
+    """
+    将 grouped-query attention 的 ``key`` 和 ``value`` 复制到与 query 相同的 head 数，
+    仅用于不支持分组计算的 kernel。
+
+    :param key: batch_size, seq_len, kv_heads, head_dim
+    :param value: batch_size, seq_len, kv_heads, head_dim
+    :param num_heads: query 的 head 数
+    """
+    groups = num_heads // key.shape[2]
+    if groups == 1:
+        return key, value
+    return (
+        torch.repeat_interleave(key, dim=2, repeats=groups),
+        torch.repeat_interleave(value, dim=2, repeats=groups),
+    )
+
+
+def _build_sdpa_mask(attention_mask, seq_len, start_pos, position_ids, device):
+    length = start_pos + seq_len
+    mask = None
+    if attention_mask is not None and not bool(attention_mask.all()):
+        mask = attention_mask[:, None, None, :length].bool()
+    if position_ids is not None:
+        # packing 的样本之间互不可见
+        segment_ids = get_packed_segment_ids(position_ids)
+        segment = (segment_ids.unsqueeze(-1) == segment_ids.unsqueeze(-2)).unsqueeze(1)
+        mask = segment if mask is None else mask & segment
+    if mask is None and (start_pos == 0 or seq_len == 1):
+        return None, start_pos == 0 and seq_len > 1
+    ones = torch.ones(seq_len, length, dtype=torch.bool, device=device)
+    causal = ones.tril(diagonal=start_pos)
+    mask = causal if mask is None else mask & causal
+    # 全部被遮蔽的行（如左侧 padding 处的 query）至少可以看到自身，避免 softmax 产生 nan
+    return mask | ones.tril(diagonal=start_pos).triu(diagonal=start_pos), False
+
+
+def sdpa_attention(
+    query,
+    key,
+    value,
+    attention_mask=None,
+    start_pos=0,
+    position_ids=None,
+    mask_cache=None,
+):
+    """
+    使用 :func:`torch.nn.functional.scaled_dot_product_attention` 计算 causal
+    attention。
+
+    没有 padding 时直接使用 ``is_causal``，不构造任何 mask。
+
+    :param query: batch_size, seq_len, heads, head_dim
+    :param key: batch_size, start_pos + seq_len, kv_heads, head_dim。``kv_heads``
+        小于 ``heads`` 时为 grouped-query attention
+    :param value: batch_size, start_pos + seq_len, kv_heads, head_dim
+    :param attention_mask: batch_size, start_pos + seq_len
+    :param start_pos: 已经缓存的 key 和 value 的长度
+    :param position_ids: batch_size, seq_len。使用 packing 时传入，``position_ids``
+        为 0 的位置被视为一个样本的开始，不同样本之间不会相互 attend
+    :param mask_cache: 模型在每次前向开始时创建的字典。第一层构造的 causal mask
+        与 padding mask 保存在其中，同一次前向的其它层直接复用；为 ``None`` 时每次
+        调用都重新构造
+    :return: batch_size, seq_len, heads * head_dim
+    """
+    if mask_cache is not None and "mask" in mask_cache:
+        mask, is_causal = mask_cache["mask"]
+    else:
+        mask, is_causal = _build_sdpa_mask(
+            attention_mask, query.shape[1], start_pos, position_ids, query.device
+        )
+        if mask_cache is not None:
+            mask_cache["mask"] = (mask, is_causal)
+    kwargs = {}
+    if key.shape[2] != query.shape[2]:
+        if _SDPA_ENABLE_GQA:
+            kwargs["enable_gqa"] = True
+        else:
+            key, value = repeat_kv_heads(key, value, query.shape[2])
+    output = torch.nn.functional.scaled_dot_product_attention(
+        query.transpose(1, 2),
+        key.transpose(1, 2),
+        value.transpose(1, 2),
+        attn_mask=mask,
+        is_causal=is_causal,
+        **kwargs,
+    )
+    return rearrange(output, "b h n d -> b n (h d)")
+
+
+_ROTARY_TABLES = {}
+
+
+def get_rotary_table(key: tuple, length: int, build) -> torch.Tensor:
+    """
+    获取在所有层之间共享的旋转位置编码表。
+
+    编码表按 ``key`` 缓存，第一维为位置。长度不足 ``length`` 时调用
+    ``build(capacity)`` 以 2 的幂的长度重新构造，因此同一设备和数据类型上的编码表
+    只会计算常数次，之后每一层的每次前向都只需要切片。
+
+    :param key: 区分不同编码表的键，需要包含设备和数据类型
+    :param length: 需要的位置数
+    :param build: 根据位置数构造编码表的函数
+    :return: 编码表的前 ``length`` 个位置
+    """
+    table = _ROTARY_TABLES.get(key, None)
+    if table is None or table.shape[0] < length:
+        capacity = max(2048, 1 << (length - 1).bit_length())
+        # 编码表在训练和推理之间共享，不能是 inference tensor
+        with torch.inference_mode(False), torch.no_grad():
+            table = build(capacity)
+        _ROTARY_TABLES[key] = table
+    return table[:length]
+
+
+def get_complex_rotary_table(
+    inv_freq: torch.Tensor, length: int, base: float = 10000.0
+) -> torch.Tensor:
+    """
+    获取复数形式的旋转位置编码表，形状为 ``(length, head_dim // 2)``。
+
+    :param inv_freq: 各维度的频率
+    :param length: 需要的位置数
+    :param base: 计算 ``inv_freq`` 时使用的底数，用于区分不同的编码表
+    """
+
+    def build(capacity):
+        freqs = torch.outer(
+            torch.arange(capacity, device=inv_freq.device), inv_freq
+        ).float()
+        return torch.polar(torch.ones_like(freqs), freqs)
+
+    key = ("complex", base, inv_freq.shape[0], inv_freq.dtype, inv_freq.device)
+    return get_rotary_table(key, length, build)
+
+
+class StaticKVCache:
+    """
+    生成时预先分配的 KV cache。
+
+    每一层的 key 和 value 在第一次写入时按 ``(batch_size, max_length, heads, head_dim)``
+    分配一次，之后的每个解码步都原地写入 ``start_pos`` 处，并返回有效部分的视图，
+    避免每生成一个 token 都拼接、复制整个 cache。流水线模型会将 batch 拆分为多个
+    micro batch 依次前向，此时每个 micro batch 按顺序写入 batch 中对应的行。
+
+    为了兼容 ``transformers`` 的生成流程，该对象可以像 ``past_key_values`` 一样
+    按层迭代。
+
+    :param batch_size: 一次生成请求的 batch 大小
+    :param max_length: 生成的最大长度（包含输入），超出时会重新分配
+    """
+
+    def __init__(self, batch_size: int, max_length: int):
+        self.batch_size = batch_size
+        self.max_length = max_length
+        self.keys = {}
+        self.values = {}
+        self.lengths = {}
+        self.cursors = {}
+
+    def start_pos(self, idx: int) -> int:
+        """第 ``idx`` 层即将写入的 micro batch 已经缓存的长度"""
+        if idx not in self.lengths:
+            return 0
+        return self.lengths[idx][self.cursors[idx]]
+
+    def _grow(self, idx: int, length: int):
+        length = max(length, 2 * self.keys[idx].shape[1])
+        for buffers in (self.keys, self.values):
+            old = buffers[idx]
+            buffers[idx] = old.new_empty((old.shape[0], length, *old.shape[2:]))
+            buffers[idx][:, : old.shape[1]] = old
+
+    def update(self, idx: int, key: torch.Tensor, value: torch.Tensor):
+        """
+        将第 ``idx`` 层新计算的 ``key`` 和 ``value`` 写入 cache。
+
+        :param key: batch_size, seq_len, heads, head_dim
+        :param value: batch_size, seq_len, heads, head_dim
+        :return: 包含历史在内的 ``key`` 和 ``value``，为 cache 的视图
+        """
+        batch_size, seq_len = key.shape[:2]
+        if idx not in self.keys:
+            shape = (self.batch_size, self.max_length, *key.shape[2:])
+            self.keys[idx] = key.new_empty(shape)
+            self.values[idx] = value.new_empty(shape)
+            self.lengths[idx] = [0] * self.batch_size
+            self.cursors[idx] = 0
+        cursor = self.cursors[idx]
+        if cursor + batch_size > self.batch_size:
+            raise ValueError(
+                f"The batch size of the static kv cache is {self.batch_size}, "
+                f"but got {cursor + batch_size} samples in layer {idx}."
+            )
+        rows = slice(cursor, cursor + batch_size)
+        start_pos = self.lengths[idx][cursor]
+        end_pos = start_pos + seq_len
+        if end_pos > self.keys[idx].shape[1]:
+            self._grow(idx, end_pos)
+        self.keys[idx][rows, start_pos:end_pos] = key
+        self.values[idx][rows, start_pos:end_pos] = value
+        self.lengths[idx][rows] = [end_pos] * batch_size
+        self.cursors[idx] = (cursor + batch_size) % self.batch_size
+        return self.keys[idx][rows, :end_pos], self.values[idx][rows, :end_pos]
+
+    def __getitem__(self, idx: int):
+        length = self.lengths[idx][0]
+        return self.keys[idx][:, :length], self.values[idx][:, :length]
+
+    def __iter__(self):
+        for idx in sorted(self.keys):
+            yield self[idx]
+
+    def __len__(self):
+        return len(self.keys)
+
+
+def build_static_kv_cache(model, args: tuple, kwargs: dict):
+    """
+    根据 ``generate`` 的参数为一次生成请求构造 :class:`StaticKVCache`。
+
+    不使用 cache、束搜索以及对比搜索时返回 ``None``。
+    """
+    generation_config = copy.deepcopy(
+        kwargs.get("generation_config", None) or model.generation_config
+    )
+    generation_config.update(**kwargs)
+    if (
+        not generation_config.use_cache
+        or generation_config.num_beams > 1
+        or (
+            generation_config.penalty_alpha is not None
+            and generation_config.top_k is not None
+            and generation_config.top_k > 1
+        )
+    ):
+        return None
+    inputs = args[0] if len(args) > 0 else None
+    for key in ("inputs", "input_ids", "inputs_embeds"):
+        if inputs is None:
+            inputs = kwargs.get(key, None)
+    if inputs is None:
+        return None
+    batch_size, input_length = inputs.shape[:2]
+    if generation_config.max_new_tokens is not None:
+        max_length = input_length + generation_config.max_new_tokens
+    else:
+        max_length = max(generation_config.max_length, input_length)
+    return StaticKVCache(
+        batch_size * generation_config.num_return_sequences, max_length
+    )
+
+
+class ActivationCheckpointing:
+    """
+    训练时每一层使用梯度检查点的策略，由 :class:`~collie.config.CollieConfig` 中的
+    ``checkpointing``、``checkpointing_policy``、``checkpointing_interval`` 和
+    ``checkpointing_budget`` 决定。
+
+    层在前向时调用该对象，由其决定以何种方式执行 ``layer._forward``。如果层同时实现了
+    ``_attention_forward`` 与 ``_mlp_forward``（``_forward`` 依次调用两者），则可以
+    只对其中一个子模块使用检查点。
+
+    ``'auto'`` 策略下，每一层第一次训练前向时会额外执行一次不保存激活的前向，通过
+    :func:`torch.autograd.graph.saved_tensors_hooks` 测量不使用检查点时需要保存的激活
+    大小，这一次仍对整个层使用检查点；某一层第二次前向时，所有层都已经测量过，按
+    ``checkpointing_budget`` 选出不使用检查点的层。
+
+    一个模型中的所有层共享同一个对象，见
+    :meth:`~collie.models.base.CollieModelForCausalLM._share_activation_checkpointing`。
+    """
+
+    def __init__(self, config):
+        self.config = config
+        # idx -> (不使用检查点时保存的激活大小, 使用检查点时保存的输入大小)
+        self.sizes = {}
+        # 'auto' 策略下不使用检查点的层
+        self.plan = None
+
+    @staticmethod
+    def _measure(layer, args) -> tuple:
+        storages, views = {}, set()
+
+        def pack(tensor):
+            # 只记录大小而不保存激活，这次前向不会进行反向传播。参数在 ZeRO-3 下
+            # 前向时才被收集，因此每次重新获取参数的地址
+            parameters = {p.untyped_storage().data_ptr() for p in layer.parameters()}
+            storage = tensor.untyped_storage()
+            view = (tensor.data_ptr(), tensor.shape, tensor.stride())
+            if storage.data_ptr() in parameters or view in views:
+                return
+            views.add(view)
+            # 按视图计算大小，避免把共享的缓存（如 rotary 表）整个算进来
+            storages[storage.data_ptr()] = min(
+                storage.nbytes(),
+                storages.get(storage.data_ptr(), 0) + tensor.numel() * tensor.element_size(),
+            )
+
+        with torch.enable_grad(), torch.autograd.graph.saved_tensors_hooks(pack, lambda _: None):
+            layer._forward(*args)
+        inputs = sum(
+            arg.untyped_storage().nbytes()
+            for arg in args
+            if isinstance(arg, torch.Tensor) and arg.is_floating_point()
+        )
+        return sum(storages.values()), inputs
+
+    def _make_plan(self):
+        # 从所有层都使用检查点开始，依次放开额外显存最少的层
+        budget = self.config.checkpointing_budget * 1024**3
+        used = sum(inputs for _, inputs in self.sizes.values())
+        self.plan = set()
+        for idx, (activations, inputs) in sorted(
+            self.sizes.items(), key=lambda item: item[1][0] - item[1][1]
+        ):
+            if used + activations - inputs > budget:
+                break
+            used += activations - inputs
+            self.plan.add(idx)
+        logger.info(
+            f"Activation checkpointing plan: {len(self.sizes) - len(self.plan)} of "
+            f"{len(self.sizes)} layers are checkpointed, using about "
+            f"{used / 1024**3:.2f} GB of activations per micro batch."
+        )
+
+    def mode(self, idx: int) -> str:
+        """
+        第 ``idx`` 层使用检查点的方式。
+
+        :return: ``'full'``、``'attention'``、``'mlp'`` 或 ``'none'``
+        """
+        if not self.config.checkpointing:
+            return "none"
+        if self.config.checkpointing_policy == "auto":
+            return "none" if self.plan is not None and idx in self.plan else "full"
+        if idx % self.config.checkpointing_interval != 0:
+            return "none"
+        return self.config.checkpointing_policy
+
+    def __call__(self, layer, idx: int, *args):
+        """
+        执行第 ``idx`` 层的前向 ``layer._forward(*args)``。
+
+        :return: ``layer._forward`` 的结果
+        """
+        if not layer.training:
+            return layer._forward(*args)
+        mode = self.mode(idx)
+        if mode == "full" and self.config.checkpointing_policy == "auto" and self.plan is None:
+            if idx in self.sizes:
+                self._make_plan()
+            else:
+                self.sizes[idx] = self._measure(layer, args)
+            mode = self.mode(idx)
+        if mode in ("attention", "mlp") and hasattr(layer, "_attention_forward"):
+            if mode == "attention":
+                hidden_states, new_layer_past = torch.utils.checkpoint.checkpoint(
+                    layer._attention_forward, *args
+                )
+                return layer._mlp_forward(hidden_states), new_layer_past
+            hidden_states, new_layer_past = layer._attention_forward(*args)
+            return (
+                torch.utils.checkpoint.checkpoint(layer._mlp_forward, hidden_states),
+                new_layer_past,
+            )
+        if mode != "none":
+            return torch.utils.checkpoint.checkpoint(layer._forward, *args)
+        return layer._forward(*args)
+
+
 def kv_cache_to_inputs_for_model(past_key_values):
     """
     在模型的输入阶段，将嵌套元组形式的past_key_values转化为inputs字典中的每个字段
@@ -5,6 +5,7 @@ __all__ = [
     'ColumnParallelLMHead',
     'RowParallelLinearWithoutBias',
     'GPTLMLoss',
+    'chunked_lm_loss',
     'PipelineGenerationMixin',
 ]
 
@@ -21,6 +22,7 @@ from typing import Mapping, Optional, List, Sequence, Dict, Any, Tuple
 
 from torch import nn
 from torch import distributed as dist
+from torch.nn import functional as F
 from transformers.generation.configuration_utils import GenerationConfig
 from megatron.core.tensor_parallel import (ColumnParallelLinear,
                                            RowParallelLinear,
@@ -40,7 +42,8 @@ from transformers.modeling_outputs import CausalLMOutputWithPast
 from collie.log import logger
 from collie.utils import env, broadcast_tensor, setup_ds_engine, stack_tensor, concat_tensor
 from collie.models.utils import (kv_cache_to_inputs_for_model, inputs_to_kv_cache_for_model,\
-                                kv_cache_to_inputs_for_layer, inputs_to_kv_cache_for_layer)
+                                kv_cache_to_inputs_for_layer, inputs_to_kv_cache_for_layer,\
+                                StaticKVCache, build_static_kv_cache)
 
 class ColumnParallelLinearWithoutBias(ColumnParallelLinear):
     """重写 ``megatron`` 提供的列并行全连接层以去掉结果中的 ``bias``。
@@ -69,11 +72,18 @@ class LinearWithHiddenStates(nn.Linear):
         super().__init__(in_features, out_features, bias, device, dtype)
         self.hidden_states = None
         
-    def forward(self, input_):
+    def forward(self, input_, labels: Optional[torch.Tensor] = None, chunk_size: int = 1024):
+        """
+        :param labels: 训练时传入 ``labels`` 会直接返回 lm_head 与交叉熵融合计算的
+            损失，不生成完整的 logits，详见 :func:`chunked_lm_loss`
+        :param chunk_size: 融合计算时每一块的 token 数
+        """
         if not self.training:
             self.hidden_states = input_
         else:
             self.hidden_states = None
+            if labels is not None:
+                return chunked_lm_loss(input_, self.weight, labels, self.bias, chunk_size)
         return super().forward(input_)
     
 class ColumnParallelLMHead(ColumnParallelLinearWithoutBias):
@@ -86,11 +96,21 @@ class ColumnParallelLMHead(ColumnParallelLinearWithoutBias):
         super(ColumnParallelLMHead, self).__init__(*args, **kwargs)
         self.hidden_states = None
 
-    def forward(self, input_):
+    def forward(self, input_, labels: Optional[torch.Tensor] = None, chunk_size: int = 1024):
+        """
+        :param labels: 训练时传入 ``labels`` 会直接返回 lm_head 与交叉熵融合计算的
+            损失，不生成完整的 logits，详见 :func:`chunked_lm_loss`
+        :param chunk_size: 融合计算时每一块的 token 数
+        """
         if not self.training:
             self.hidden_states = input_
         else:
             self.hidden_states = None
+            if labels is not None:
+                return chunked_lm_loss(
+                    input_, self.weight, labels, self.bias, chunk_size,
+                    group=parallel_state.get_tensor_model_parallel_group()
+                )
         return super().forward(input_)
     
     def __new__(cls, *args, **kwargs):
@@ -135,17 +155,137 @@ class GPTLMLoss(torch.nn.Module):
         self.ignore_index = ignore_index
         self.loss = torch.nn.CrossEntropyLoss(ignore_index=ignore_index)  # ignore <pad> when compute loss
     
-    def forward(self, logits: torch.Tensor, labels: torch.Tensor):
+    def forward(self, logits: Optional[torch.Tensor] = None, labels: Optional[torch.Tensor] = None,
+                loss: Optional[torch.Tensor] = None):
         """ 计算损失
         :param logits: 语言模型的输出
         :param labels: 真实标签
+        :param loss: 设置了 ``lm_loss_chunk_size`` 时模型在 lm_head 中融合计算的损失，
+            此时没有 ``logits``，直接返回该损失
         """
+        if logits is None and loss is not None:
+            return loss
         shift_logits = logits[..., :-1, :].float().contiguous()
         shift_labels = labels[..., 1:].contiguous().to(logits.device)
         # Flatten the tokens
         return self.loss(shift_logits.view(-1, shift_logits.size(-1)), shift_labels.view(-1))
 
 
+class _ChunkedLMHeadLoss(torch.autograd.Function):
+    """按 token 分块计算 lm_head 与交叉熵的损失之和。
+
+    每一块的 logits 用完即释放，反向传播时重新计算，只保存每个 token 的
+    ``logsumexp``。``group`` 不为 ``None`` 时 ``weight`` 为按词表切分后的一部分，
+    softmax 的归约在张量并行的进程组内完成。
+    """
+
+    @staticmethod
+    def _logits(hidden_states, weight, bias):
+        logits = hidden_states @ weight.t()
+        if bias is not None:
+            logits = logits + bias
+        return logits.to(torch.promote_types(logits.dtype, torch.float32))
+
+    @staticmethod
+    def _target(labels, vocab_start, vocab_size):
+        # 词表切分后 label 对应的本地下标，以及 label 是否落在本进程的词表中
+        target = labels - vocab_start
+        in_range = (target >= 0) & (target < vocab_size)
+        return target.clamp(0, vocab_size - 1), in_range
+
+    @staticmethod
+    def forward(ctx, hidden_states, weight, bias, labels, chunk_size, ignore_index, group):
+        vocab_start = 0 if group is None else dist.get_rank(group) * weight.shape[0]
+        loss = torch.zeros((), dtype=torch.promote_types(hidden_states.dtype, torch.float32),
+                           device=hidden_states.device)
+        all_lse = []
+        for start in range(0, hidden_states.shape[0], chunk_size):
+            chunk_labels = labels[start:start + chunk_size]
+            logits = _ChunkedLMHeadLoss._logits(
+                hidden_states[start:start + chunk_size], weight, bias
+            )
+            logits_max = logits.max(dim=-1).values
+            if group is not None:
+                dist.all_reduce(logits_max, op=dist.ReduceOp.MAX, group=group)
+            sum_exp = (logits - logits_max.unsqueeze(-1)).exp().sum(dim=-1)
+            target, in_range = _ChunkedLMHeadLoss._target(chunk_labels, vocab_start, weight.shape[0])
+            target_logits = logits.gather(-1, target.unsqueeze(-1)).squeeze(-1) * in_range
+            if group is not None:
+                dist.all_reduce(sum_exp, group=group)
+                dist.all_reduce(target_logits, group=group)
+            lse = logits_max + sum_exp.log()
+            loss += ((lse - target_logits) * (chunk_labels != ignore_index)).sum()
+            all_lse.append(lse)
+        ctx.save_for_backward(hidden_states, weight, bias, labels, torch.cat(all_lse))
+        ctx.chunk_size = chunk_size
+        ctx.ignore_index = ignore_index
+        ctx.group = group
+        ctx.vocab_start = vocab_start
+        return loss
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        hidden_states, weight, bias, labels, lse = ctx.saved_tensors
+        grad_hidden_states = torch.empty_like(hidden_states)
+        grad_weight = torch.zeros_like(weight) if ctx.needs_input_grad[1] else None
+        grad_bias = torch.zeros_like(bias) if bias is not None and ctx.needs_input_grad[2] else None
+        for start in range(0, hidden_states.shape[0], ctx.chunk_size):
+            end = start + ctx.chunk_size
+            chunk_hidden_states = hidden_states[start:end]
+            chunk_labels = labels[start:end]
+            # softmax - one_hot
+            grad_logits = (
+                _ChunkedLMHeadLoss._logits(chunk_hidden_states, weight, bias)
+                - lse[start:end].unsqueeze(-1)
+            ).exp_()
+            target, in_range = _ChunkedLMHeadLoss._target(chunk_labels, ctx.vocab_start, weight.shape[0])
+            grad_logits.scatter_add_(-1, target.unsqueeze(-1), -in_range.to(grad_logits.dtype).unsqueeze(-1))
+            grad_logits *= ((chunk_labels != ctx.ignore_index) * grad_output).unsqueeze(-1)
+            grad_logits = grad_logits.to(weight.dtype)
+            torch.matmul(grad_logits, weight, out=grad_hidden_states[start:end])
+            if grad_weight is not None:
+                grad_weight.addmm_(grad_logits.t(), chunk_hidden_states)
+            if grad_bias is not None:
+                grad_bias += grad_logits.sum(dim=0)
+        if ctx.group is not None:
+            # 列并行的输入在各个进程上相同，梯度需要求和
+            dist.all_reduce(grad_hidden_states, group=ctx.group)
+        return grad_hidden_states, grad_weight, grad_bias, None, None, None, None
+
+
+def chunked_lm_loss(hidden_states: torch.Tensor,
+                    weight: torch.Tensor,
+                    labels: torch.Tensor,
+                    bias: Optional[torch.Tensor] = None,
+                    chunk_size: int = 1024,
+                    ignore_index: int = -100,
+                    group: Optional[dist.ProcessGroup] = None) -> torch.Tensor:
+    """融合 lm_head 与交叉熵计算语言模型的损失，结果与 :class:`GPTLMLoss` 相同。
+
+    按 ``chunk_size`` 个 token 一块计算 logits 和交叉熵，反向传播时重新计算每一块的
+    logits，因此不会生成完整的 ``[B, T, V]`` 大小的 logits 及其梯度。
+
+    :param hidden_states: lm_head 的输入，形状为 ``[..., T, H]``
+    :param weight: lm_head 的权重，形状为 ``[V, H]``；张量并行时为本进程的部分词表
+    :param labels: 真实标签，形状为 ``[..., T]``，会在内部进行错位
+    :param bias: lm_head 的偏置
+    :param chunk_size: 每一块的 token 数
+    :param ignore_index: 忽略的标签的 ``index``
+    :param group: 词表被切分时所在的张量并行进程组；为 ``None`` 或只有一个进程时视为
+        完整的词表
+    """
+    if group is not None and dist.get_world_size(group) == 1:
+        group = None
+    # 对 labels 而不是 hidden_states 进行错位，避免拷贝 hidden_states
+    shift_labels = F.pad(labels.to(hidden_states.device)[..., 1:], (0, 1), value=ignore_index)
+    shift_labels = shift_labels.reshape(-1)
+    loss = _ChunkedLMHeadLoss.apply(
+        hidden_states.reshape(-1, hidden_states.shape[-1]), weight, bias,
+        shift_labels, chunk_size, ignore_index, group
+    )
+    return loss / (shift_labels != ignore_index).sum()
+
+
 class PipelineGenerationMixin(GenerationMixin):
     """
     重写 ``transformers`` 提供的 ``GenerationMixin`` 以支持 **CoLLie** 中的流水线
@@ -164,20 +304,34 @@ class PipelineGenerationMixin(GenerationMixin):
         self.layers = None
         self._find_layers()
         self.is_contrastive_search = False
+        self._kv_cache = None
         
     def set_engine(self, engine: DeepSpeedEngine):
         """设置DeepSpeed Engine
         """
         self.engine_container.append(engine)
 
-    def generate(self, *args, **kwargs):
+    def generate(self, *args, static_kv_cache: bool = True, **kwargs):
         """开始迭代的生成过程
+
+        :param static_kv_cache: 是否在每个 stage 上为本次生成预先分配
+            :class:`~collie.models.utils.StaticKVCache`。使用时 ``past_key_values``
+            不再在 stage 之间传递。
         """
         if len(self.engine_container) == 0:
             self.engine_container.append(setup_ds_engine(config=self.collie_config, model=self)[0])
         self.engine_container[-1].eval()
         self.forward_type = "generate"
-        res = super().generate(*args, **kwargs)
+        kv_cache = None
+        if static_kv_cache and getattr(self, "_supports_static_kv_cache", False):
+            kv_cache = build_static_kv_cache(self, args, kwargs)
+        self._kv_cache = kv_cache
+        self._set_kv_cache(kv_cache)
+        try:
+            res = super().generate(*args, **kwargs)
+        finally:
+            self._kv_cache = None
+            self._set_kv_cache(None)
         self._clean_hidden_states()
         # contrastive learning
         if self.is_contrastive_search:
@@ -200,7 +354,12 @@ class PipelineGenerationMixin(GenerationMixin):
                 past_key_values: Optional[Tuple[torch.Tensor]] = None,
                 **kwargs) -> torch.Tensor:
         """ 进行迭代的流水线模型的前向传播（生成）
+
+        ``past_key_values`` 为 :class:`~collie.models.utils.StaticKVCache` 时，各层
+        直接读写本 stage 上的 cache。
         """
+        if isinstance(past_key_values, StaticKVCache):
+            past_key_values = None
         inputs = {}
         if input_ids is not None:
             inputs["input_ids"] = input_ids
@@ -348,6 +507,17 @@ class PipelineGenerationMixin(GenerationMixin):
             attention_mask=attention_mask, use_cache=use_cache, **kwargs
         )
 
+    def _update_model_kwargs_for_generation(self, outputs, model_kwargs, *args, **kwargs):
+        model_kwargs = super()._update_model_kwargs_for_generation(
+            outputs, model_kwargs, *args, **kwargs
+        )
+        # 使用预先分配的 cache 时各层不再返回 past_key_values
+        if self._kv_cache is not None and model_kwargs.get(
+            "past_key_values", None
+        ) is None and model_kwargs.get("use_cache", False):
+            model_kwargs["past_key_values"] = self._kv_cache
+        return model_kwargs
+
     def _validate_model_kwargs(self, model_kwargs: Dict[str, Any]):
         """Validates model kwargs for generation. Generate argument typos will also be caught here."""
         # Excludes arguments that are handled before calling any model function
@@ -414,6 +584,13 @@ class PipelineGenerationMixin(GenerationMixin):
             if hasattr(layer, attr_name):
                 object.__setattr__(layer, attr_name, use_cache)
 
+    def _set_kv_cache(self, kv_cache):
+        """ 设置所有层中的 `kv_cache`
+        """
+        for layer in self.layers:
+            if hasattr(layer, "kv_cache"):
+                object.__setattr__(layer, "kv_cache", kv_cache)
+
 class PipelineModel(PipelineModule, PipelineGenerationMixin):
     """
     重写 ``megatron`` 提供的 ``PipelineModule`` 以支持 **CoLLie** 中的
@@ -526,6 +703,7 @@ class PipelineModel(PipelineModule, PipelineGenerationMixin):
         self.inner_forward = False
         self.forward_type = "train" # train, eval, generate
         self.skip_input_embedding()
+        self.fuse_lm_head_loss()
 
     def _flatten_layers(self, layers):
         # layers: list of tuple/layer
@@ -677,6 +855,34 @@ class PipelineModel(PipelineModule, PipelineGenerationMixin):
             object.__setattr__(input_embedding, "forward", MethodType(_forward, input_embedding))
         
         
+    def fuse_lm_head_loss(self):
+        """设置了 ``lm_loss_chunk_size`` 时，训练中在最后一个 stage 的 lm_head 里融合
+        计算交叉熵，输出的字典中以 ``loss`` 代替 ``logits``。
+        """
+        chunk_size = self.collie_config.lm_loss_chunk_size
+        lm_head = self.get_lm_head()[1]
+        if chunk_size <= 0 or lm_head is None:
+            return
+        if not isinstance(lm_head, (ColumnParallelLMHead, LinearWithHiddenStates)):
+            logger.rank_zero_warning(
+                f"`lm_loss_chunk_size` is not supported by {type(lm_head).__name__}, "
+                "the full logits will be computed."
+            )
+            return
+        raw_forward = lm_head.forward
+        def _forward(self, inputs):
+            if not self.training or not isinstance(inputs, dict) or "labels" not in inputs:
+                return raw_forward(inputs)
+            loss = type(self).forward(self, inputs.pop("hidden_states"),
+                                      labels=inputs["labels"], chunk_size=chunk_size)
+            # 与 dict_as_params 相同，只有输出需要梯度
+            outputs = {key: value if key == "past_key_values" else value.detach()
+                       for key, value in inputs.items()}
+            outputs["loss"] = loss
+            return outputs
+        object.__setattr__(lm_head, "forward", MethodType(_forward, lm_head))
+
+
 class MultiParallelGrid(PipelineParallelGrid):
     """
     重写以支持 ``megatron`` 中的张量并行进程组
@@ -7,7 +7,8 @@ from .utils import find_tensors, progress, dictToObj, apply_to_collection, dict_
 from .data_provider import BaseProvider, GradioProvider, _GenerationStreamer, DashProvider
 from .metric_wrapper import _MetricsWrapper
 from .monitor import BaseMonitor, StepTimeMonitor, _MultiMonitors, TGSMonitor, MemoryMonitor, \
-    LossMonitor, EvalMonitor, LRMonitor, NetworkIOMonitor, DiskIOMonitor, CPUMemoryMonitor
+    LossMonitor, EvalMonitor, LRMonitor, NetworkIOMonitor, DiskIOMonitor, CPUMemoryMonitor, \
+    DataWaitTimeMonitor
 from .padder import ColliePadder
 
 __all__ = [
@@ -53,6 +54,7 @@ __all__ = [
     "NetworkIOMonitor",
     "DiskIOMonitor",
     "CPUMemoryMonitor",
+    "DataWaitTimeMonitor",
 
     # padder
     "ColliePadder",
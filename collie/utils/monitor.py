@@ -11,7 +11,8 @@ __all__ = [
     "EvalMonitor",
     "NetworkIOMonitor",
     "DiskIOMonitor",
-    "CPUMemoryMonitor"
+    "CPUMemoryMonitor",
+    "DataWaitTimeMonitor"
 ]
 from deepspeed.monitor.monitor import MonitorMaster, Monitor
 
@@ -84,6 +85,7 @@ class BaseMonitor:
                     ...
                 },
                 "memory_allocated": 7000000000,
+                "data_wait_time": 0.01,
                 "mode": "train"
             }
         
@@ -216,6 +218,13 @@ class LRMonitor(BaseMonitor):
         if 'loss' in self.item.keys() and self.item["mode"] == "train":
             self.monitor.write_events([(f"Learning Rate", self.item['lr'], self.item['global_batch_idx'])])  
         
+class DataWaitTimeMonitor(BaseMonitor):
+    """用来记录每个step中训练循环等待数据的时间
+    """
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if 'data_wait_time' in self.item.keys() and self.item["mode"] == "train":
+            self.monitor.write_events([(f"Data Wait Time", self.item['data_wait_time'], self.item['global_batch_idx'])])
+
 class _MultiMonitors:
     def __init__(self, monitors: Sequence[BaseMonitor]) -> None:
         self.monitors = monitors
@@ -1,10 +1,10 @@
 """ **CoLLie** 中的通用 ``collate_fn`` 构造器
 """
-from typing import Any, Dict, List, Sequence, Tuple
+from typing import Any, Dict, List, Optional, Sequence, Tuple, Union
 
 import numpy as np
 import torch
-import torch.nn.functional as F
+from torch.utils.data import get_worker_info
 
 __all__ = ["ColliePadder"]
 
@@ -12,69 +12,137 @@ __all__ = ["ColliePadder"]
 class ColliePadder:
     """**CoLLie** 中的通用 ``collate_fn`` 构造器
 
+    每个字段的数据会被直接写入一块预先分配好的 CPU 缓冲区中完成填充，整个 batch
+    只在主进程中向 ``device`` 搬运一次；在 ``DataLoader`` 的子进程中调用时返回 CPU
+    上的张量，由 :class:`~collie.data.CollieDataLoader` 在主进程中调用 :meth:`to_device`。
+
+    样本中没有 ``attention_mask`` 时会根据 ``input_ids`` 的长度生成。``int32`` 的
+    张量在搬运到设备后会被转换为 ``int64``。
+
     :param padding_token: 用于填充模型输入数据 (input_ids) 的 token，为一个 ``Dict`` 决定不同的字段使用不同 id
     :param labels_padding_token: 用于填充模型标签数据 (labels) 的 token
     :param padding_left: 是否在左侧填充
+    :param pad_to_multiple_of: 将序列长度（样本的第一维）填充到该值的整数倍
+    :param pin_memory: 是否将缓冲区分配在锁页内存上，以便异步地拷贝到 GPU
+    :param device: 填充后的 batch 所在的设备，为 ``None`` 时使用当前的 cuda 设备，没有可用的
+        cuda 设备时使用 CPU
     """
 
+    _MASK_KEYS = {"input_ids": "attention_mask", "option_ids": "option_attention_mask"}
+
     def __init__(
         self,
         padding_token_id: dict = {"attention_mask": 0, "labels": -100},
         padding_left: bool = False,
+        pad_to_multiple_of: int = 1,
+        pin_memory: bool = False,
+        device: Optional[Union[str, torch.device]] = None,
     ) -> None:
         self.padding_token_id = padding_token_id
         self.padding_left = padding_left
+        self.pad_to_multiple_of = pad_to_multiple_of
+        self.pin_memory = pin_memory
+        self.device = device
         self.key = "input_ids"
 
+    @staticmethod
+    def _shape(x: Any) -> tuple:
+        if isinstance(x, (torch.Tensor, np.ndarray)):
+            shape = tuple(x.shape)
+        elif isinstance(x, (int, float)):
+            shape = ()
+        elif isinstance(x, list):
+            shape = np.shape(x) if x and isinstance(x[0], (list, tuple)) else (len(x),)
+        else:
+            raise TypeError(f"Unsupported type: {type(x)}")
+        # 去掉长度为 1 的维度
+        return tuple(s for s in shape if s > 1) or (1,)
+
+    @staticmethod
+    def _dtype(x: Any) -> torch.dtype:
+        if isinstance(x, torch.Tensor):
+            return x.dtype
+        if isinstance(x, np.ndarray):
+            return torch.from_numpy(np.empty(0, dtype=x.dtype)).dtype
+        return torch.tensor(x).dtype
+
+    def _layout(self, batch: Sequence[Any]) -> Tuple[List[tuple], List[int]]:
+        shapes = [self._shape(x) for x in batch]
+        if len({len(shape) for shape in shapes}) > 1:
+            raise ValueError(f"Samples of field `{self.key}` have different ranks.")
+        max_shape = list(np.max(shapes, axis=0))
+        multiple = self.pad_to_multiple_of
+        if multiple > 1:
+            max_shape[0] = -(-max_shape[0] // multiple) * multiple
+        return shapes, max_shape
+
+    def _index(self, shape: tuple, max_shape: List[int]) -> tuple:
+        if self.padding_left:
+            return tuple(slice(m - s, m) for m, s in zip(max_shape, shape))
+        return tuple(slice(0, s) for s in shape)
+
+    def _buffer(self, shape: Sequence[int], fill_value, dtype: torch.dtype) -> torch.Tensor:
+        return torch.full(
+            tuple(shape),
+            fill_value,
+            dtype=dtype,
+            pin_memory=self.pin_memory and torch.cuda.is_available(),
+        )
+
     def collate_fn(self, batch: Sequence[Any]) -> torch.Tensor:
         """用于填充的 ``collate_fn``
 
         :param batch: 一个 batch 的数据
-        :return: 填充后的 batch
+        :return: 填充后的 batch，位于 CPU 上
         """
         padding_token_id = self.padding_token_id.get(self.key, 0)
         batch = list(batch)
-        if isinstance(batch[0], torch.Tensor):
-            pass
-        elif isinstance(batch[0], (int, float)):
-            batch = [torch.tensor(x).cuda() for x in batch]
-        elif isinstance(batch[0], np.ndarray):
-            batch = [torch.from_numpy(x).cuda() for x in batch]
-        elif isinstance(batch[0], list):
-            batch = [torch.tensor(x).cuda() for x in batch]
-        else:
-            raise TypeError(f"Unsupported type: {type(batch[0])}")
-        for i in range(len(batch)):
-            sample = batch[i]
-            shape = []
-            for s in sample.shape:
-                if s > 1:
-                    shape.append(s)
-            if not shape:
-                shape.append(1)
-            sample = sample.view(*shape)
-            batch[i] = sample
-        max_shape = max([x.shape for x in batch])
-        for i in range(len(batch)):
-            shape = (
-                (torch.tensor(max_shape) - torch.tensor(batch[i].shape)).cpu().tolist()
-            )
-            if self.padding_left:
-                batch[i] = F.pad(
-                    batch[i],
-                    [shape.pop() if d % 2 == 0 else 0 for d in range(len(shape) * 2)],
-                    value=padding_token_id,
-                )
-            else:
-                batch[i] = F.pad(
-                    batch[i],
-                    [
-                        shape.pop() if (d + 1) % 2 == 0 else 0
-                        for d in range(len(shape) * 2)
-                    ],
-                    value=padding_token_id,
+        shapes, max_shape = self._layout(batch)
+        buffer = self._buffer(
+            (len(batch), *max_shape), padding_token_id, self._dtype(batch[0])
+        )
+        # 通过 numpy 视图逐行写入，避免为每个样本构造张量
+        view = buffer.numpy()
+        for i, (x, shape) in enumerate(zip(batch, shapes)):
+            if isinstance(x, torch.Tensor):
+                x = x.detach().cpu().numpy()
+            view[i][self._index(shape, max_shape)] = np.reshape(x, shape)
+        return buffer
+
+    def mask_fn(self, batch: Sequence[Any]) -> torch.Tensor:
+        """根据 batch 中每个样本的长度生成对应的 ``attention_mask``
+
+        :param batch: 一个 batch 的 ``input_ids``
+        :return: 与 :meth:`collate_fn` 的结果形状相同的 ``attention_mask``，位于 CPU 上
+        """
+        shapes, max_shape = self._layout(batch)
+        buffer = self._buffer((len(batch), *max_shape), 0, torch.int64)
+        view = buffer.numpy()
+        for i, shape in enumerate(shapes):
+            view[i][self._index(shape, max_shape)] = 1
+        return buffer
+
+    def to_device(self, batch: Any) -> Any:
+        """将 batch 中所有的张量搬运到 ``device`` 上。
+
+        :param batch: :meth:`__call__` 返回的 batch
+        """
+        if isinstance(batch, torch.Tensor):
+            device = self.device
+            if device is None:
+                device = (
+                    torch.device("cuda", torch.cuda.current_device())
+                    if torch.cuda.is_available()
+                    else torch.device("cpu")
                 )
-        return torch.stack(batch, dim=0).cuda()
+            batch = batch.to(device, non_blocking=batch.is_pinned())
+            # token 以 int32 传输，在设备上转换为模型需要的 int64
+            return batch.long() if batch.dtype == torch.int32 else batch
+        if isinstance(batch, dict):
+            return {key: self.to_device(value) for key, value in batch.items()}
+        if isinstance(batch, (list, tuple)):
+            return type(batch)(self.to_device(value) for value in batch)
+        return batch
 
     def __call__(self, batch: List[Any]) -> Any:
         padded_batch = None
@@ -105,7 +173,21 @@ class ColliePadder:
                     padded_dict[key] = [x[key] for x in batch]
                 else:
                     raise TypeError(f"Unsupported type: {type(batch[0][key])}")
+            # 样本中没有 attention_mask 时根据长度生成
+            for ids_key, mask_key in self._MASK_KEYS.items():
+                if ids_key not in batch[0].keys() or mask_key in batch[0].keys():
+                    continue
+                self.key = mask_key
+                if isinstance(batch[0][ids_key], tuple):
+                    padded_dict[mask_key] = [
+                        self.mask_fn([x[ids_key][j] for x in batch])
+                        for j in range(len(batch[0][ids_key]))
+                    ]
+                else:
+                    padded_dict[mask_key] = self.mask_fn([x[ids_key] for x in batch])
             padded_batch = padded_dict
         else:
             raise TypeError(f"Unsupported type: {type(batch[0])}")
+        if get_worker_info() is None:
+            padded_batch = self.to_device(padded_batch)
         return padded_batch
@@ -241,6 +241,21 @@ def _split_batch(batch, micro_batch_size, micro_batch_num):
     :param micro_batch_num:
     :return: tuple
     """
+    # 按 token 数目组 batch 时 batch 大小不固定，此时将其均分为 micro_batch_num 份
+    if isinstance(batch, torch.Tensor):
+        batch_size = batch.shape[0]
+    elif isinstance(batch, dict):
+        batch_size = next(
+            (value.shape[0] for key, value in batch.items()
+             if key != "past_key_values" and isinstance(value, torch.Tensor)),
+            micro_batch_size * micro_batch_num
+        )
+    else:
+        batch_size = micro_batch_size * micro_batch_num
+    if batch_size != micro_batch_size * micro_batch_num:
+        assert batch_size % micro_batch_num == 0, \
+            f"Batch size {batch_size} is not divisible by {micro_batch_num} micro batches."
+        micro_batch_size = batch_size // micro_batch_num
     if isinstance(batch, torch.Tensor):
         batch_split = torch.split(batch, micro_batch_size)
     elif isinstance(batch, dict):
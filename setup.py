@@ -11,6 +11,9 @@ setup(
     author_email="yanhang@pjlab.org.cn",
     packages=find_packages(),
     install_requires=reqs.splitlines(),
+    extras_require={
+        "zstd": ["zstandard"],
+    },
     python_requires=">=3.8",
     entry_points={
         "console_scripts": [
@@ -0,0 +1,162 @@
+import sys
+
+import numpy as np
+from torch.utils.data import DistributedSampler
+
+sys.path.append("../..")
+from collie.data import CollieBatchSampler, CollieDistributedSampler, CollieTokenBatchSampler
+from collie.data.permutation import _IndexPermutation
+
+
+def _batches(lengths, rank, epoch, last_batch="fill", batch_size=8):
+    sampler = DistributedSampler(range(len(lengths)), num_replicas=2,
+                                 rank=rank, shuffle=True)
+    batch_sampler = CollieBatchSampler(sampler, batch_size, last_batch,
+                                       lengths=lengths, mega_batch_multiplier=4,
+                                       seed=1)
+    batch_sampler.set_epoch(epoch)
+    return batch_sampler, list(batch_sampler)
+
+
+class TestCollieBatchSampler:
+
+    def test_bucketing_deterministic(self):
+        lengths = np.random.RandomState(0).randint(1, 500, size=1003)
+        _, batches = _batches(lengths, rank=0, epoch=1)
+        assert batches == _batches(lengths, rank=0, epoch=1)[1]
+        assert batches != _batches(lengths, rank=0, epoch=2)[1]
+
+    def test_bucketing_last_batch(self):
+        lengths = np.random.RandomState(0).randint(1, 500, size=1003)
+        for last_batch in ("fill", "drop", "normal"):
+            batch_sampler, batches = _batches(lengths, rank=1, epoch=0,
+                                              last_batch=last_batch)
+            assert len(batches) == len(batch_sampler)
+            if last_batch != "normal":
+                assert all(len(batch) == 8 for batch in batches)
+
+    def test_bucketing_groups_lengths(self):
+        lengths = np.random.RandomState(0).randint(1, 500, size=1003)
+        _, batches = _batches(lengths, rank=0, epoch=0)
+        bucketed = np.mean([np.ptp(lengths[batch]) for batch in batches])
+        sampler = DistributedSampler(range(len(lengths)), num_replicas=2, rank=0)
+        plain = np.mean([np.ptp(lengths[batch])
+                         for batch in CollieBatchSampler(sampler, 8, "fill")])
+        assert bucketed < plain / 2
+
+    def test_bucketing_reads_lazily(self):
+        lengths = np.random.RandomState(0).randint(1, 500, size=1003)
+        batch_sampler, batches = _batches(lengths, rank=0, epoch=0)
+        read = []
+        sampler = batch_sampler.sampler
+        batch_sampler.sampler = type("CountingSampler", (), {
+            "__iter__": lambda self: (read.append(idx) or idx for idx in sampler),
+            "__len__": lambda self: len(sampler),
+        })()
+        iterator = iter(batch_sampler)
+        next(iterator)
+        # 只读取了第一个 mega batch 的下标
+        assert len(read) == 8 * 4
+        # 跳过整个 mega batch 时也与完整迭代的结果一致
+        for start_batch in (3, 4, 9, len(batches) - 1):
+            batch_sampler.seek(start_batch)
+            assert list(batch_sampler) == batches[start_batch:]
+
+    def test_seek(self):
+        lengths = np.random.RandomState(0).randint(1, 500, size=1003)
+        for last_batch in ("fill", "drop", "normal"):
+            for bucket_lengths in (lengths, None):
+                sampler = DistributedSampler(range(len(lengths)), num_replicas=2,
+                                             rank=1, shuffle=True)
+                batch_sampler = CollieBatchSampler(sampler, 8, last_batch,
+                                                   lengths=bucket_lengths, seed=1)
+                batch_sampler.set_epoch(1)
+                batches = list(batch_sampler)
+                batch_sampler.seek(7)
+                assert list(batch_sampler) == batches[7:]
+                # 只对下一次迭代生效
+                assert list(batch_sampler) == batches
+
+
+class TestCollieTokenBatchSampler:
+
+    def test_token_budget(self):
+        lengths = np.random.RandomState(0).randint(1, 200, size=1001)
+        samplers = [CollieTokenBatchSampler(lengths, max_tokens=1024, num_replicas=4,
+                                            rank=rank, seed=1, batch_size_multiple=2)
+                    for rank in range(4)]
+        for sampler in samplers:
+            sampler.set_epoch(3)
+        batches = [list(sampler) for sampler in samplers]
+        # 每个 rank 的 step 数相同
+        assert len(set(len(rank_batches) for rank_batches in batches)) == 1
+        assert all(len(rank_batches) == len(samplers[0]) for rank_batches in batches)
+        seen = set()
+        for rank_batches in batches:
+            for batch in rank_batches:
+                assert len(batch) % 2 == 0
+                assert len(batch) == 2 or lengths[batch].max() * len(batch) <= 1024
+                seen.update(batch)
+        assert seen == set(range(len(lengths)))
+
+    def test_greedy(self):
+        lengths = np.random.RandomState(0).randint(0, 200, size=1001)
+        for max_batch_size in (None, 12):
+            sampler = CollieTokenBatchSampler(lengths, max_tokens=1024, seed=1,
+                                              max_batch_size=max_batch_size)
+            batches = sampler._build_batches()
+            assert sorted(sum(batches, [])) == list(range(len(lengths)))
+            for batch, next_batch in zip(batches, batches[1:]):
+                assert lengths[batch].max() * len(batch) <= 1024
+                # 再加入下一个样本就会超出预算
+                size = len(batch) + 1
+                assert lengths[next_batch[0]] * size > 1024 or size > (max_batch_size or size)
+
+    def test_epoch_shuffle(self):
+        lengths = np.random.RandomState(0).randint(1, 200, size=1001)
+        sampler = CollieTokenBatchSampler(lengths, max_tokens=1024, seed=1)
+        sampler.set_epoch(0)
+        first = list(sampler)
+        sampler.set_epoch(1)
+        second = list(sampler)
+        assert first != second
+        assert sorted(map(tuple, first)) == sorted(map(tuple, second))
+
+    def test_seek(self):
+        lengths = np.random.RandomState(0).randint(1, 200, size=1001)
+        sampler = CollieTokenBatchSampler(lengths, max_tokens=1024, num_replicas=2,
+                                          rank=1, seed=1)
+        batches = list(sampler)
+        sampler.seek(5)
+        assert list(sampler) == batches[5:]
+        assert list(sampler) == batches
+
+
+class TestCollieDistributedSampler:
+
+    def test_permutation(self):
+        for n in (0, 1, 2, 7, 1000, 4097):
+            permutation = _IndexPermutation(n, seed=1, epoch=2)
+            assert sorted(permutation) == list(range(n))
+            assert list(permutation) == list(_IndexPermutation(n, seed=1, epoch=2))
+            assert permutation[n // 3 : n // 2].tolist() == list(permutation)[n // 3 : n // 2]
+        assert list(_IndexPermutation(1000, seed=1, epoch=2)) != \
+            list(_IndexPermutation(1000, seed=1, epoch=3))
+
+    def test_partition(self):
+        for drop_last in (True, False):
+            samplers = [CollieDistributedSampler(range(1003), num_replicas=4, rank=rank,
+                                                 seed=1, drop_last=drop_last)
+                        for rank in range(4)]
+            for sampler in samplers:
+                sampler.set_epoch(5)
+            indices = [list(sampler) for sampler in samplers]
+            torch_samplers = [DistributedSampler(range(1003), num_replicas=4, rank=rank,
+                                                 drop_last=drop_last) for rank in range(4)]
+            assert [len(x) for x in indices] == [len(list(x)) for x in torch_samplers]
+            assert all(len(x) == len(samplers[0]) for x in indices)
+            flat = sum(indices, [])
+            if drop_last:
+                assert len(set(flat)) == len(flat) == 1000
+            else:
+                assert set(flat) == set(range(1003))
@@ -0,0 +1,398 @@
+import os
+import sys
+import json
+import pickle
+
+import numpy as np
+import torch
+import pytest
+
+sys.path.append("../..")
+from collie.data import CollieDatasetForTraining, CollieDatasetForGeneration, \
+    CollieDatasetForClassification, ColliePackedDataset, CollieStreamingDataset, \
+    CollieDataLoader
+from collie.driver.io import FileIODriver
+
+
+def _make_samples(num=200):
+    samples = []
+    for i in range(num):
+        tokens = list(range(1, 4 + i % 7))
+        samples.append({"tokens": tokens, "labels": [-100] * 2 + tokens[2:]})
+    return samples
+
+
+class _PidDataset:
+    def __len__(self):
+        return 12
+
+    def __getitem__(self, index):
+        return index, os.getpid()
+
+
+def _make_tokenizer():
+    from tokenizers import Tokenizer, models, pre_tokenizers, processors
+    from transformers import PreTrainedTokenizerFast
+    vocab = {"[PAD]": 0, "<s>": 1, "</s>": 2, "[UNK]": 3}
+    for i, word in enumerate("abcdefghijklmnopqrstuvwxyz"):
+        vocab[word] = i + 4
+    tokenizer = Tokenizer(models.WordLevel(vocab, unk_token="[UNK]"))
+    tokenizer.pre_tokenizer = pre_tokenizers.Whitespace()
+    tokenizer.post_processor = processors.TemplateProcessing(
+        single="<s> $A", special_tokens=[("<s>", 1)])
+    return PreTrainedTokenizerFast(tokenizer_object=tokenizer, bos_token="<s>",
+                                   eos_token="</s>", pad_token="[PAD]", unk_token="[UNK]")
+
+
+class TestProcessedDataset:
+
+    def test_binary_round_trip(self, tmp_path):
+        samples = _make_samples()
+        dataset = CollieDatasetForTraining(samples)
+        dataset.save_propressed(str(tmp_path), shard_size=0.001,
+                                format="binary", dtype="uint16")
+        loaded = CollieDatasetForTraining.from_processed(str(tmp_path))
+        assert len(loaded) == len(samples)
+        for i, sample in enumerate(samples):
+            assert loaded[i]["input_ids"].tolist() == sample["tokens"]
+            assert loaded[i]["labels"].tolist() == sample["labels"]
+        # memmap 不应随 dataset 一起被序列化
+        container = pickle.loads(pickle.dumps(loaded.dataset))
+        assert container[0]["tokens"].tolist() == samples[0]["tokens"]
+
+    def test_binary_through_io_driver(self, tmp_path, monkeypatch):
+        from collie.driver.io import IODriver
+
+        samples = _make_samples(20)
+        saved = []
+
+        def record(obj, path):
+            saved.append(os.path.basename(path))
+            FileIODriver.save_buffer(obj, path)
+
+        # 非本地的存储后端先写入临时文件，再通过 save_buffer 保存
+        remote = type("RemoteIODriver", (FileIODriver,), {"save_buffer": staticmethod(record)})
+        monkeypatch.setattr(IODriver, "from_protocol", staticmethod(lambda protocol: remote))
+        monkeypatch.setattr("collie.data.dataset._BinaryShardWriter._SPOOL_SIZE", 16)
+        CollieDatasetForTraining(samples).save_propressed(str(tmp_path), format="binary",
+                                                          dtype="uint16", protocol="remote")
+        assert sorted(saved) == [f"collie-dataset-shard-0{suffix}"
+                                 for suffix in (".idx", ".labels", ".tokens")]
+        loaded = CollieDatasetForTraining.from_processed(str(tmp_path), protocol="remote")
+        # 非本地的存储后端可以读取样本长度，但不能通过 memmap 读取样本
+        assert loaded.dataset.lengths.tolist() == [len(sample["tokens"]) for sample in samples]
+        with pytest.raises(ValueError, match="local path"):
+            loaded[0]
+        monkeypatch.undo()
+        loaded = CollieDatasetForTraining.from_processed(str(tmp_path))
+        assert [loaded[i]["input_ids"].tolist() for i in range(len(samples))] == \
+            [sample["tokens"] for sample in samples]
+
+    def test_incomplete_io_driver(self):
+        from collie.driver.io import IODriver
+
+        with pytest.raises(TypeError, match="save_buffer"):
+            type("IncompleteIODriver", (IODriver,), {
+                name: staticmethod(lambda *args, **kwargs: None)
+                for name in IODriver.__abstractmethods__ if name != "save_buffer"
+            })
+
+    def test_convert_json_to_binary(self, tmp_path, monkeypatch):
+        # json 格式的 .meta 文件由 torch.save 保存 numpy 数组
+        monkeypatch.setenv("TORCH_FORCE_NO_WEIGHTS_ONLY_LOAD", "1")
+        samples = _make_samples()
+        dataset = CollieDatasetForTraining(samples)
+        dataset.save_propressed(str(tmp_path / "json"), shard_size=0.001)
+        CollieDatasetForTraining.convert_processed(str(tmp_path / "json"),
+                                                   str(tmp_path / "binary"))
+        json_dataset = CollieDatasetForTraining.from_processed(str(tmp_path / "json"))
+        binary_dataset = CollieDatasetForTraining.from_processed(str(tmp_path / "binary"))
+        assert binary_dataset.dataset.dtype == np.uint16
+        assert len(json_dataset) == len(binary_dataset)
+        for i in range(len(json_dataset)):
+            assert list(json_dataset[i]["input_ids"]) == binary_dataset[i]["input_ids"].tolist()
+            assert list(json_dataset[i]["labels"]) == binary_dataset[i]["labels"].tolist()
+
+    def test_json_index(self, tmp_path, monkeypatch):
+        monkeypatch.setenv("TORCH_FORCE_NO_WEIGHTS_ONLY_LOAD", "1")
+        samples = _make_samples()
+        CollieDatasetForTraining(samples).save_propressed(str(tmp_path), shard_size=0.001)
+        loaded = CollieDatasetForTraining.from_processed(str(tmp_path))
+        # 索引以 mmap 的方式加载
+        assert isinstance(loaded.dataset.offsets, np.memmap)
+        assert [loaded[i]["input_ids"].tolist() for i in range(len(samples))] == \
+            [sample["tokens"] for sample in samples]
+        # 没有索引文件时从 .meta 文件构造
+        for file in tmp_path.glob("collie-dataset-index.*"):
+            file.unlink()
+        rebuilt = CollieDatasetForTraining.from_processed(str(tmp_path))
+        assert rebuilt.dataset.lengths.tolist() == [len(sample["tokens"]) for sample in samples]
+        assert [rebuilt[i]["input_ids"].tolist() for i in range(len(samples))] == \
+            [sample["tokens"] for sample in samples]
+
+    def test_zstd_frames(self, tmp_path, monkeypatch):
+        pytest.importorskip("zstandard")
+        monkeypatch.setenv("TORCH_FORCE_NO_WEIGHTS_ONLY_LOAD", "1")
+        samples = _make_samples(2000)
+        CollieDatasetForTraining(samples).save_propressed(
+            str(tmp_path), shard_size=0.002, compression="zstd", frame_size=0.001)
+        assert len(list(tmp_path.glob("*.bin.zst"))) > 1
+        for rebuild in (False, True):
+            if rebuild:
+                # 没有索引文件时从 .meta 文件中读取 frame 的位置
+                for file in tmp_path.glob("collie-dataset-index.*"):
+                    file.unlink()
+            loaded = CollieDatasetForTraining.from_processed(str(tmp_path))
+            for i in np.random.RandomState(0).permutation(len(samples)):
+                assert loaded[i]["input_ids"].tolist() == samples[i]["tokens"]
+                assert loaded[i]["labels"].tolist() == samples[i]["labels"]
+            assert len(loaded.dataset.threadlocal.frame_cache) <= loaded.dataset.frame_cache_size
+
+    def test_parallel_preprocess(self, tmp_path):
+        samples = _make_samples()
+        dataset = CollieDatasetForTraining(samples, shuffle=True)
+        stats = dataset.save_propressed(str(tmp_path), format="binary", dtype="uint16",
+                                        num_proc=2, batch_size=16)
+        assert stats["samples"] == len(samples)
+        assert stats["tokens"] == sum(len(sample["tokens"]) for sample in samples)
+        loaded = CollieDatasetForTraining.from_processed(str(tmp_path))
+        for i in range(len(dataset)):
+            assert loaded[i]["input_ids"].tolist() == list(dataset[i]["input_ids"])
+            assert loaded[i]["labels"].tolist() == list(dataset[i]["labels"])
+
+
+class TestPackedDataset:
+
+    def test_pack(self):
+        samples = _make_samples(50)
+        # 空样本
+        samples.insert(7, {"tokens": [], "labels": []})
+        dataset = CollieDatasetForTraining(samples)
+        packed = ColliePackedDataset(dataset, max_length=16)
+        assert packed.lengths.max() <= 16
+        assert packed.lengths.sum() == sum(len(sample["tokens"]) for sample in samples)
+        flat_input_ids = []
+        for i in range(len(packed)):
+            sample = packed[i]
+            assert len(sample["input_ids"]) == len(sample["position_ids"]) == len(sample["labels"])
+            starts = np.nonzero(sample["position_ids"] == 0)[0]
+            # 每个样本开头的 label 被忽略
+            assert (sample["labels"][starts] == -100).all()
+            flat_input_ids.extend(sample["input_ids"].tolist())
+        assert flat_input_ids == sum([sample["tokens"] for sample in samples], [])
+
+
+class TestTokenizationCache:
+
+    def test_cache_reuse(self, tmp_path):
+        tokenizer = _make_tokenizer()
+        samples = [{"input": "a b c", "output": " d e"}, {"input": "f", "output": " g h i"}]
+        dataset = CollieDatasetForTraining(samples, tokenizer=tokenizer,
+                                           cache_dir=str(tmp_path))
+        expected = [CollieDatasetForTraining(samples, tokenizer=tokenizer)[i]
+                    for i in range(len(samples))]
+        expected = _to_list(expected)
+        assert _to_list([dataset[i] for i in range(len(samples))]) == expected
+        # 缓存命中时不再调用 tokenizer
+        reloaded = pickle.loads(pickle.dumps(
+            CollieDatasetForTraining(samples, tokenizer=tokenizer, cache_dir=str(tmp_path))))
+        reloaded._process = None
+        assert _to_list([reloaded[i] for i in range(len(samples))]) == expected
+        # 处理参数不同的数据集不会读到旧的缓存
+        truncated = CollieDatasetForTraining(samples, tokenizer=tokenizer,
+                                             cache_dir=str(tmp_path), max_length=2)
+        assert truncated[0]["input_ids"].tolist() == expected[0]["input_ids"][:2]
+
+
+def _to_list(value):
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, (list, tuple)):
+        return [_to_list(x) for x in value]
+    if isinstance(value, dict):
+        return {key: _to_list(x) for key, x in value.items()}
+    return value
+
+
+class TestBatchTokenize:
+
+    def _check(self, dataset):
+        records = [dataset._get_record(i) for i in range(len(dataset))]
+        samples = dataset._get_samples(records)
+        for i, sample in enumerate(samples):
+            expected = dataset[i]
+            assert sample.keys() == expected.keys()
+            for key in expected.keys():
+                assert _to_list(sample[key]) == _to_list(expected[key])
+
+    def test_batch_tokenize(self, tmp_path):
+        tokenizer = _make_tokenizer()
+        self._check(CollieDatasetForTraining(
+            [{"input": "a b c", "output": " d e"}, {"input": "f", "output": " g h i j"}],
+            tokenizer=tokenizer, max_length=4, batch_tokenize=True))
+        self._check(CollieDatasetForTraining(
+            [{"text": "a b c"}, {"text": "d"}], tokenizer=tokenizer,
+            cache_dir=str(tmp_path), batch_tokenize=True))
+        self._check(CollieDatasetForGeneration(
+            [{"text": "a b", "target": "c"}, {"text": "d", "target": ["e", "f g"]}, {"text": "h"}],
+            tokenizer=tokenizer, batch_tokenize=True))
+        classification = [{"input": "a b", "output": [" c", " d e"], "target": 1},
+                          {"input": "f", "output": [" g", " h", " i j k"], "target": 0}]
+        self._check(CollieDatasetForClassification(
+            classification, tokenizer=tokenizer, batch_tokenize=True))
+        self._check(CollieDatasetForClassification(
+            classification, tokenizer=tokenizer, style="helm", batch_tokenize=True))
+        self._check(CollieDatasetForClassification(
+            classification, tokenizer=tokenizer, batch_tokenize=True, shared_prefix=True))
+
+    def test_shared_prefix(self):
+        tokenizer = _make_tokenizer()
+        data = [{"input": "a b c", "output": [" d", " d e", " f"], "target": 1}]
+        full = CollieDatasetForClassification(data, tokenizer=tokenizer)[0]
+        shared = CollieDatasetForClassification(data, tokenizer=tokenizer,
+                                                shared_prefix=True)[0]
+        assert shared["input_ids"].tolist() == [1, 4, 5, 6]
+        for j in range(3):
+            assert _to_list(shared["input_ids"]) + _to_list(shared["option_ids"][j]) == \
+                _to_list(full["input_ids"][j])
+            # 前缀中不包含需要计算 loss 的 token
+            assert [-100] * 4 + _to_list(shared["option_labels"][j]) == _to_list(full["labels"][j])
+
+
+class TestStreamingDataset:
+
+    def _write_shards(self, path, num_shards=4, num_samples=25):
+        path.mkdir()
+        for shard in range(num_shards):
+            with open(path / f"part-{shard}.jsonl", "w") as f:
+                for i in range(num_samples):
+                    f.write(json.dumps({"tokens": [shard * num_samples + i] * (1 + i % 3)}) + "\n")
+
+    @pytest.mark.parametrize("num_workers", [0, 2])
+    @pytest.mark.parametrize("prefetch_batches", [0, 2])
+    def test_resume(self, tmp_path, num_workers, prefetch_batches):
+        self._write_shards(tmp_path / "data")
+
+        def make_loader():
+            dataset = CollieStreamingDataset(str(tmp_path / "data"), shuffle=True,
+                                             shuffle_buffer_size=8)
+            return CollieDataLoader(dataset, 3, num_workers=num_workers,
+                                    collate_fn=lambda batch: [x["input_ids"][0] for x in batch],
+                                    prefetch_batches=prefetch_batches)
+
+        loader = make_loader()
+        loader.sampler.set_epoch(1)
+        expected = list(loader)
+        assert sorted(sum(expected, [])) == list(range(100))
+        loader = make_loader()
+        loader.sampler.set_epoch(1)
+        iterator = iter(loader)
+        consumed = [next(iterator) for _ in range(10)]
+        state_dict = json.loads(json.dumps(loader.state_dict()))
+        resumed = make_loader()
+        resumed.load_state_dict(state_dict)
+        assert consumed + list(resumed) == expected
+        # 下一个 epoch 从头开始读取
+        resumed.sampler.set_epoch(2)
+        assert sorted(sum(list(resumed), [])) == list(range(100))
+
+    def test_resume_from_offset(self, tmp_path, monkeypatch):
+        self._write_shards(tmp_path / "data")
+
+        def make_dataset():
+            return CollieStreamingDataset(str(tmp_path / "data"), shuffle=True,
+                                          shuffle_buffer_size=8, num_replicas=1, rank=0)
+
+        expected = [sample["input_ids"][0] for sample in make_dataset()]
+        dataset = make_dataset()
+        iterator = iter(dataset)
+        consumed = [next(iterator)["input_ids"][0] for _ in range(37)]
+        state_dict = {"epoch": 0, "consumed": [dataset.consumed]}
+        opened = []
+        open_stream = FileIODriver.open_stream
+
+        def record(path, offset=0):
+            opened.append((path, offset))
+            return open_stream(path, offset)
+
+        monkeypatch.setattr(FileIODriver, "open_stream", staticmethod(record))
+        resumed = make_dataset()
+        resumed.load_state_dict(state_dict)
+        assert consumed + [sample["input_ids"][0] for sample in resumed] == expected
+        # 从记录的位置开始读取，而不是从第一个分片的开头
+        shard, offset, _ = state_dict["consumed"][0]
+        assert opened[0] == (resumed._shards(0, 1)[shard], offset) and offset > 0
+
+
+class TestCollieDataLoader:
+
+    def test_persistent_workers(self):
+        loader = CollieDataLoader(_PidDataset(), 4, shuffle=True, num_workers=2,
+                                  collate_fn=lambda batch: batch)
+        epochs, pids = [], set()
+        for epoch in range(3):
+            loader.set_epoch(epoch)
+            batches = list(loader)
+            epochs.append([index for batch in batches for index, _ in batch])
+            pids |= {pid for batch in batches for _, pid in batch}
+        assert len(pids) == 2
+        assert all(sorted(indices) == list(range(12)) for indices in epochs)
+        assert epochs[0] != epochs[1]
+
+    def test_prefetcher_released(self):
+        loader = CollieDataLoader(list(range(12)), 2, collate_fn=lambda batch: batch,
+                                  prefetch_batches=2)
+        assert list(loader) == [[2 * i, 2 * i + 1] for i in range(6)]
+        # 迭代结束时后台线程退出
+        assert not loader.prefetcher.thread.is_alive()
+        iterator = iter(loader)
+        next(iterator)
+        prefetcher = loader.prefetcher
+        loader.close()
+        assert loader.prefetcher is None
+        assert not prefetcher.thread.is_alive() and prefetcher.queue.empty()
+
+    @pytest.mark.parametrize("prefetch_batches", [0, 2])
+    def test_padder_on_cpu(self, monkeypatch, prefetch_batches):
+        from collie.utils import ColliePadder
+
+        # 没有 cuda 设备时搬运到 CPU
+        monkeypatch.setattr("torch.cuda.is_available", lambda: False)
+        samples = [{"input_ids": list(range(1, 2 + i % 3))} for i in range(6)]
+        loader = CollieDataLoader(samples, 2, collate_fn=ColliePadder(),
+                                  prefetch_batches=prefetch_batches)
+        batches = list(loader)
+        assert len(batches) == 3
+        for batch in batches:
+            assert batch["input_ids"].device.type == "cpu"
+            assert batch["input_ids"].dtype == torch.int64
+            assert batch["attention_mask"].shape == batch["input_ids"].shape
+
+
+class TestLengths:
+
+    def test_processed(self, tmp_path):
+        dataset = CollieDatasetForTraining(_make_samples(), shuffle=True)
+        expected = [len(dataset[i]["input_ids"]) for i in range(len(dataset))]
+        assert dataset.lengths.tolist() == expected
+        for format in ("json", "binary"):
+            dataset.save_propressed(str(tmp_path / format), shard_size=0.001, format=format,
+                                    dtype="uint16")
+            processed = CollieDatasetForTraining.from_processed(str(tmp_path / format),
+                                                               shuffle=True, seed=1)
+            assert processed.lengths.tolist() == \
+                [len(processed[i]["input_ids"]) for i in range(len(processed))]
+
+    @pytest.mark.parametrize("num_proc", [1, 2])
+    def test_cache(self, tmp_path, num_proc):
+        data = [{"text": " ".join("abcdef"[: 1 + i % 6])} for i in range(50)]
+        dataset = CollieDatasetForTraining(data, tokenizer=_make_tokenizer(),
+                                           cache_dir=str(tmp_path), max_length=5)
+        lengths = dataset.get_lengths(num_proc=num_proc, batch_size=8)
+        assert lengths.tolist() == [len(dataset[i]["input_ids"]) for i in range(len(dataset))]
+        assert len(list(tmp_path.glob("collie-lengths-*.npy"))) == 1
+        # 之后的运行直接读取缓存
+        dataset = CollieDatasetForTraining(data, tokenizer=None, cache_dir=str(tmp_path))
+        dataset.tokenizer, dataset.max_length = _make_tokenizer(), 5
+        dataset._record_lengths = None
+        assert dataset.lengths.tolist() == lengths.tolist()
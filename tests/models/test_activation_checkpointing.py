@@ -0,0 +1,89 @@
+from types import SimpleNamespace
+
+import torch
+from torch import nn
+
+from collie.models.utils import ActivationCheckpointing
+
+
+class _Layer(nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.attention = nn.Linear(4, 4)
+        self.mlp = nn.Sequential(nn.Linear(4, 16), nn.GELU(), nn.Linear(16, 4))
+
+    def _attention_forward(self, hidden_states):
+        return hidden_states + self.attention(hidden_states).tanh(), None
+
+    def _mlp_forward(self, hidden_states):
+        return hidden_states + self.mlp(hidden_states)
+
+    def _forward(self, hidden_states):
+        hidden_states, new_layer_past = self._attention_forward(hidden_states)
+        return self._mlp_forward(hidden_states), new_layer_past
+
+
+def _config(**kwargs):
+    config = dict(
+        checkpointing=True,
+        checkpointing_policy="full",
+        checkpointing_interval=1,
+        checkpointing_budget=0.0,
+    )
+    config.update(kwargs)
+    return SimpleNamespace(**config)
+
+
+def _run(layers, checkpointing, hidden_states):
+    for layer in layers:
+        layer.zero_grad()
+    for idx, layer in enumerate(layers):
+        hidden_states, _ = checkpointing(layer, idx, hidden_states)
+    hidden_states.sum().backward()
+    return torch.cat([p.grad.flatten() for layer in layers for p in layer.parameters()])
+
+
+def test_activation_checkpointing_policies():
+    torch.manual_seed(0)
+    layers = [_Layer() for _ in range(4)]
+    hidden_states = torch.randn(2, 3, 4, requires_grad=True)
+    expected = _run(layers, ActivationCheckpointing(_config(checkpointing=False)), hidden_states)
+    for policy in ("full", "attention", "mlp"):
+        config = _config(checkpointing_policy=policy, checkpointing_interval=2)
+        checkpointing = ActivationCheckpointing(config)
+        assert [checkpointing.mode(i) for i in range(4)] == [policy, "none", policy, "none"]
+        assert torch.allclose(_run(layers, checkpointing, hidden_states), expected)
+
+
+def test_activation_checkpointing_auto():
+    torch.manual_seed(0)
+    layers = [_Layer() for _ in range(4)]
+    hidden_states = torch.randn(2, 3, 4, requires_grad=True)
+    checkpointing = ActivationCheckpointing(_config(checkpointing_policy="auto"))
+    # 第一次前向测量每一层的激活大小，全部使用检查点
+    _run(layers, checkpointing, hidden_states)
+    assert checkpointing.plan is None and len(checkpointing.sizes) == 4
+    activations, inputs = checkpointing.sizes[0]
+    assert activations > inputs == hidden_states.numel() * hidden_states.element_size()
+    # 预算只够两层不使用检查点
+    checkpointing.config.checkpointing_budget = (4 * inputs + 2 * (activations - inputs) + 1) / 1024**3
+    _run(layers, checkpointing, hidden_states)
+    assert len(checkpointing.plan) == 2
+    assert [checkpointing.mode(i) for i in range(4)].count("full") == 2
+
+
+def test_share_activation_checkpointing():
+    from collie.models.base import CollieModelForCausalLM
+
+    config = _config(checkpointing_policy="auto")
+    model = nn.ModuleList([_Layer() for _ in range(3)])
+    for layer in model:
+        layer.activation_checkpointing = ActivationCheckpointing(config)
+    CollieModelForCausalLM._share_activation_checkpointing(model, config)
+    shared = {id(layer.activation_checkpointing) for layer in model}
+    assert len(shared) == 1
+    hidden_states = torch.randn(2, 3, 4, requires_grad=True)
+    # 所有层的激活大小记录在同一个对象中
+    for idx, layer in enumerate(model):
+        hidden_states, _ = layer.activation_checkpointing(layer, idx, hidden_states)
+    assert len(model[0].activation_checkpointing.sizes) == 3
@@ -0,0 +1,71 @@
+import math
+
+import torch
+
+from collie.models.utils import repeat_kv_heads, sdpa_attention
+
+
+def _eager(query, key, value, attention_mask, start_pos):
+    query, key, value = (x.transpose(1, 2) for x in (query, key, value))
+    score = query @ key.transpose(2, 3) / math.sqrt(query.shape[-1])
+    seq_len = query.shape[2]
+    causal = torch.full((seq_len, seq_len + start_pos), float("-inf")).triu(start_pos + 1)
+    padding = (1.0 - attention_mask[:, None, None, :]) * torch.finfo(score.dtype).min
+    output = torch.softmax(score + causal + padding, dim=-1) @ value
+    return output.transpose(1, 2).flatten(2)
+
+
+def test_sdpa_attention():
+    torch.manual_seed(0)
+    query, key, value = (torch.randn(2, 5, 3, 4) for _ in range(3))
+    attention_mask = torch.ones(2, 5)
+    attention_mask[1, :2] = 0
+    output = sdpa_attention(query, key, value, attention_mask)
+    expected = _eager(query, key, value, attention_mask, 0)
+    # 左侧 padding 处的输出不参与计算，但不能是 nan
+    assert not output.isnan().any()
+    valid = attention_mask.bool()
+    assert torch.allclose(output[valid], expected[valid], atol=1e-6)
+    # 没有 padding 时使用 is_causal
+    output = sdpa_attention(query, key, value, torch.ones(2, 5))
+    assert torch.allclose(output, _eager(query, key, value, torch.ones(2, 5), 0), atol=1e-6)
+
+
+def test_sdpa_attention_with_cache():
+    torch.manual_seed(0)
+    query = torch.randn(2, 2, 3, 4)
+    key, value = torch.randn(2, 6, 3, 4), torch.randn(2, 6, 3, 4)
+    attention_mask = torch.ones(2, 6)
+    attention_mask[0, 0] = 0
+    output = sdpa_attention(query, key, value, attention_mask, start_pos=4)
+    expected = _eager(query, key, value, attention_mask, 4)
+    assert torch.allclose(output, expected, atol=1e-6)
+
+
+def test_sdpa_attention_grouped_query():
+    torch.manual_seed(0)
+    query = torch.randn(2, 5, 4, 8)
+    key, value = torch.randn(2, 5, 2, 8), torch.randn(2, 5, 2, 8)
+    attention_mask = torch.ones(2, 5)
+    attention_mask[0, :1] = 0
+    output = sdpa_attention(query, key, value, attention_mask)
+    key, value = repeat_kv_heads(key, value, 4)
+    expected = _eager(query, key, value, attention_mask, 0)
+    valid = attention_mask.bool()
+    assert torch.allclose(output[valid], expected[valid], atol=1e-6)
+
+
+def test_sdpa_attention_mask_cache():
+    torch.manual_seed(0)
+    query, key, value = (torch.randn(2, 5, 3, 4) for _ in range(3))
+    attention_mask = torch.ones(2, 5)
+    attention_mask[1, :2] = 0
+    # 同一次前向中只有第一层构造 mask
+    mask_cache = {}
+    first = sdpa_attention(query, key, value, attention_mask, mask_cache=mask_cache)
+    mask, is_causal = mask_cache["mask"]
+    assert mask.shape == (2, 1, 5, 5) and not is_causal
+    second = sdpa_attention(query, key, value, attention_mask, mask_cache=mask_cache)
+    assert mask_cache["mask"][0] is mask
+    assert torch.equal(first, second)
+    assert torch.equal(first, sdpa_attention(query, key, value, attention_mask))
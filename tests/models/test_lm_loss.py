@@ -0,0 +1,38 @@
+import torch
+
+from collie.module import GPTLMLoss, chunked_lm_loss
+
+
+def test_chunked_lm_loss():
+    torch.manual_seed(0)
+    hidden_states = torch.randn(2, 7, 8, requires_grad=True)
+    weight = torch.randn(12, 8, requires_grad=True)
+    bias = torch.randn(12, requires_grad=True)
+    labels = torch.randint(0, 12, (2, 7))
+    labels[0, :3] = -100
+    expected = GPTLMLoss()(hidden_states @ weight.t() + bias, labels)
+    expected.backward()
+    grads = [x.grad.clone() for x in (hidden_states, weight, bias)]
+    for x in (hidden_states, weight, bias):
+        x.grad = None
+    # 块的大小不整除 token 数
+    loss = chunked_lm_loss(hidden_states, weight, labels, bias, chunk_size=4)
+    loss.backward()
+    assert torch.allclose(loss, expected, atol=1e-6)
+    for x, grad in zip((hidden_states, weight, bias), grads):
+        assert torch.allclose(x.grad, grad, atol=1e-6)
+
+
+def test_chunked_lm_loss_gradcheck():
+    torch.manual_seed(0)
+    hidden_states = torch.randn(1, 5, 4, dtype=torch.float64, requires_grad=True)
+    weight = torch.randn(6, 4, dtype=torch.float64, requires_grad=True)
+    labels = torch.tensor([[1, 5, -100, 0, 3]])
+    assert torch.autograd.gradcheck(
+        lambda h, w: chunked_lm_loss(h, w, labels, chunk_size=2), (hidden_states, weight)
+    )
+
+
+def test_gpt_lm_loss_passes_fused_loss():
+    loss = torch.tensor(1.5)
+    assert GPTLMLoss()(labels=torch.zeros(1, 3, dtype=torch.long), loss=loss) is loss
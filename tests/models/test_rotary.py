@@ -0,0 +1,41 @@
+import torch
+
+from collie.models.utils import get_complex_rotary_table, get_rotary_table
+
+
+def test_rotary_table_shared_and_grown():
+    builds = []
+
+    def build(length):
+        builds.append(length)
+        return torch.arange(length)
+
+    key = ("test", torch.device("cpu"))
+    assert get_rotary_table(key, 10, build).tolist() == list(range(10))
+    get_rotary_table(key, 2048, build)
+    assert builds == [2048]
+    # 长度不足时按 2 的幂扩展
+    assert get_rotary_table(key, 3000, build).shape[0] == 3000
+    assert builds == [2048, 4096]
+
+
+def test_complex_rotary_table():
+    inv_freq = 1.0 / (10000.0 ** (torch.arange(0, 8, 2).float() / 8))
+    table = get_complex_rotary_table(inv_freq, 16)
+    freqs = torch.outer(torch.arange(16), inv_freq).float()
+    assert torch.equal(table, torch.polar(torch.ones_like(freqs), freqs))
+    assert table.data_ptr() == get_complex_rotary_table(inv_freq.clone(), 4).data_ptr()
+
+
+def test_rotary_position_ids_with_cache():
+    from collie.models.llama.model import RotaryPositionEmbedding
+
+    rotary = RotaryPositionEmbedding(8)
+    query, key = torch.randn(2, 3, 2, 8), torch.randn(2, 3, 2, 8)
+    # 使用 kv cache 时，左侧 padding 的样本从较小的位置继续
+    position_ids = torch.tensor([[4, 5, 6], [1, 2, 3]])
+    query_out, key_out = rotary(query, key, 3, 4, position_ids)
+    for i, start_pos in enumerate((4, 1)):
+        expected = rotary(query[i : i + 1], key[i : i + 1], 3, start_pos)
+        assert torch.allclose(query_out[i : i + 1], expected[0])
+        assert torch.allclose(key_out[i : i + 1], expected[1])
@@ -0,0 +1,37 @@
+import torch
+
+from collie.models.utils import StaticKVCache
+
+
+class TestStaticKVCache:
+    def test_update(self):
+        cache = StaticKVCache(batch_size=2, max_length=4)
+        prompt = torch.randn(2, 3, 2, 4)
+        key, value = cache.update(0, prompt, -prompt)
+        assert cache.start_pos(0) == 3
+        assert torch.equal(key, prompt) and torch.equal(value, -prompt)
+        step = torch.randn(2, 1, 2, 4)
+        key, value = cache.update(0, step, -step)
+        # 写入的是同一块预先分配的内存
+        assert key.data_ptr() == cache.keys[0].data_ptr()
+        assert torch.equal(key, torch.cat([prompt, step], dim=1))
+        assert [k.shape[1] for k, _ in cache] == [4]
+
+    def test_grow(self):
+        cache = StaticKVCache(batch_size=1, max_length=2)
+        first = torch.randn(1, 2, 1, 4)
+        cache.update(0, first, first)
+        second = torch.randn(1, 1, 1, 4)
+        key, _ = cache.update(0, second, second)
+        assert torch.equal(key, torch.cat([first, second], dim=1))
+        assert cache.keys[0].shape[1] >= 3
+
+    def test_micro_batches(self):
+        # 流水线中每个 micro batch 依次写入对应的行
+        cache = StaticKVCache(batch_size=2, max_length=4)
+        rows = torch.randn(2, 2, 1, 4)
+        for i in range(2):
+            assert cache.start_pos(0) == 0
+            cache.update(0, rows[i : i + 1], rows[i : i + 1])
+        assert cache.start_pos(0) == 2
+        assert torch.equal(cache[0][0], rows)
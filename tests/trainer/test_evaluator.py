@@ -0,0 +1,107 @@
+import math
+from types import SimpleNamespace
+
+import torch
+from torch import nn
+
+from collie.controller.evaluator import EvaluatorForClassfication
+from collie.module import GPTLMLoss
+
+
+def _per_sample_scores(loss_fn, logits, labels):
+    pred = torch.zeros(logits.shape[0])
+    for i in range(logits.shape[0]):
+        pred[i] = loss_fn(logits[i : i + 1], labels[i : i + 1]).detach().cpu().item()
+    return pred
+
+
+class _ScaledLoss(GPTLMLoss):
+    def forward(self, logits=None, labels=None, loss=None):
+        return 2 * super().forward(logits, labels, loss)
+
+
+def test_option_scores_match_loss_fn():
+    torch.manual_seed(0)
+    logits = torch.randn(3, 6, 10)
+    labels = torch.randint(0, 10, (3, 6))
+    labels[0, :2] = -100
+    # 没有有效 token 的样本得分为 nan
+    labels[2] = -100
+    for loss_fn in (GPTLMLoss(), _ScaledLoss(), lambda logits, labels: logits.sum()):
+        expected = _per_sample_scores(loss_fn, logits, labels)
+        scores = EvaluatorForClassfication._option_scores(loss_fn, logits, labels)
+        assert torch.allclose(scores, expected, equal_nan=True, atol=1e-6)
+    assert torch.isnan(EvaluatorForClassfication._option_scores(GPTLMLoss(), logits, labels)[2])
+
+
+class _TinyLM(nn.Module):
+    """单层 attention 的语言模型，位置编码按 ``position_ids`` 给出的绝对位置计算。"""
+
+    def __init__(self, vocab_size=16, hidden_size=8, max_length=32):
+        super().__init__()
+        self.embed = nn.Embedding(vocab_size, hidden_size)
+        self.position = nn.Embedding(max_length, hidden_size)
+        self.qkv = nn.Linear(hidden_size, 3 * hidden_size)
+        self.lm_head = nn.Linear(hidden_size, vocab_size)
+        self.use_cache = False
+
+    def set_cache(self, use_cache):
+        self.use_cache = use_cache
+
+    def clean_cache(self):
+        pass
+
+    def forward(self, input_ids, attention_mask=None, position_ids=None, past_key_values=None):
+        start_pos = 0 if past_key_values is None else past_key_values[0].shape[1]
+        seq_len = input_ids.shape[1]
+        if position_ids is None:
+            position_ids = torch.arange(start_pos, start_pos + seq_len).unsqueeze(0)
+        hidden_states = self.embed(input_ids) + self.position(position_ids)
+        query, key, value = self.qkv(hidden_states).chunk(3, dim=-1)
+        if past_key_values is not None:
+            key = torch.cat([past_key_values[0], key], dim=1)
+            value = torch.cat([past_key_values[1], value], dim=1)
+        score = query @ key.transpose(1, 2) / math.sqrt(query.shape[-1])
+        mask = torch.ones(seq_len, start_pos + seq_len).tril(start_pos).bool()
+        if attention_mask is not None:
+            mask = mask & attention_mask[:, None, :].bool()
+        score = score.masked_fill(~mask, torch.finfo(score.dtype).min)
+        hidden_states = hidden_states + score.softmax(-1) @ value
+        return {
+            "logits": self.lm_head(hidden_states),
+            "past_key_values": (key, value) if self.use_cache else None,
+        }
+
+
+class _Engine:
+    def __init__(self, module):
+        self.module = module
+
+    def __call__(self, **kwargs):
+        return self.module(**kwargs)
+
+
+def test_shared_prefix_scores_match_full_sequences():
+    torch.manual_seed(0)
+    model = _TinyLM().eval()
+    evaluator = SimpleNamespace(engine=_Engine(model), loss_fn=GPTLMLoss())
+    prefixes = [[3, 4, 5, 6], [7, 8]]
+    options = [[[9, 10], [11]], [[12], [13, 14, 15]]]
+    batch = {
+        # 前缀左侧 padding，选项右侧 padding
+        "input_ids": torch.tensor([[3, 4, 5, 6], [0, 0, 7, 8]]),
+        "attention_mask": torch.tensor([[1, 1, 1, 1], [0, 0, 1, 1]]),
+        "option_ids": [torch.tensor([[9, 10, 0], [12, 0, 0]]), torch.tensor([[11, 0, 0], [13, 14, 15]])],
+        "option_attention_mask": [torch.tensor([[1, 1, 0], [1, 0, 0]]), torch.tensor([[1, 0, 0], [1, 1, 1]])],
+        "option_labels": [torch.tensor([[9, 10, 0], [12, 0, 0]]), torch.tensor([[11, 0, 0], [13, 14, 15]])],
+        "target": torch.tensor([[0], [1]]),
+    }
+    with torch.no_grad():
+        scores = EvaluatorForClassfication._score_shared_prefix(evaluator, batch)
+        for i, prefix in enumerate(prefixes):
+            for j, option in enumerate(options[i]):
+                # 没有 padding 的完整序列
+                input_ids = torch.tensor([prefix + option])
+                labels = torch.tensor([[-100] * len(prefix) + option])
+                expected = GPTLMLoss()(model(input_ids)["logits"], labels)
+                assert torch.allclose(scores[i, j], expected, atol=1e-5)
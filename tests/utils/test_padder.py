@@ -0,0 +1,53 @@
+import numpy as np
+import torch
+
+from collie.utils import ColliePadder
+
+
+class TestColliePadder:
+    def test_pad(self):
+        padder = ColliePadder(device="cpu")
+        batch = [
+            {"input_ids": [1, 2, 3], "labels": np.array([1, 2, 3]), "target": 0},
+            {"input_ids": [4], "labels": np.array([4]), "target": 1},
+        ]
+        padded = padder(batch)
+        assert padded["input_ids"].tolist() == [[1, 2, 3], [4, 0, 0]]
+        assert padded["labels"].tolist() == [[1, 2, 3], [4, -100, -100]]
+        assert padded["target"].tolist() == [[0], [1]]
+        assert padded["input_ids"].dtype == torch.int64
+
+    def test_padding_left_and_multiple(self):
+        padder = ColliePadder(padding_left=True, pad_to_multiple_of=4, device="cpu")
+        batch = [
+            {"input_ids": torch.tensor([1, 2, 3, 4, 5], dtype=torch.int32),
+             "options": ([1, 2], [3])},
+            {"input_ids": torch.tensor([6], dtype=torch.int32),
+             "options": ([4], [5, 6, 7])},
+        ]
+        padded = padder(batch)
+        # int32 在搬运到设备后转换为 int64
+        assert padded["input_ids"].dtype == torch.int64
+        assert padded["input_ids"].tolist() == [
+            [0, 0, 0, 1, 2, 3, 4, 5],
+            [0, 0, 0, 0, 0, 0, 0, 6],
+        ]
+        assert [x.tolist() for x in padded["options"]] == [
+            [[0, 0, 1, 2], [0, 0, 0, 4]],
+            [[0, 0, 0, 3], [0, 5, 6, 7]],
+        ]
+
+    def test_attention_mask(self):
+        padder = ColliePadder(padding_left=True, device="cpu")
+        batch = [
+            {"input_ids": np.array([1, 2, 3], dtype=np.int32),
+             "option_ids": (np.array([4], dtype=np.int32), np.array([5, 6], dtype=np.int32))},
+            {"input_ids": np.array([7], dtype=np.int32),
+             "option_ids": (np.array([8, 9], dtype=np.int32), np.array([1], dtype=np.int32))},
+        ]
+        padded = padder(batch)
+        assert padded["attention_mask"].tolist() == [[1, 1, 1], [0, 0, 1]]
+        assert [x.tolist() for x in padded["option_attention_mask"]] == [
+            [[0, 1], [1, 1]],
+            [[1, 1], [0, 1]],
+        ]